@@ -1,76 +1,286 @@
+import atexit
 import json
-from datetime import datetime
-from threading import Lock
-from flask import Flask, jsonify, request
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from functools import wraps
+from flask import Flask, Response, g, jsonify, request, send_file
 from flask_cors import CORS
 
+import config
+from exportacao import COMPRESSOES, FORMATOS, codificar, gerar_exportacao
+from limite_taxa import LimitadorTaxa
+from metricas import metricas
+from sites import RegistroSites
+
 # Inicializa a aplicação Flask
 app = Flask(__name__)
 CORS(app)  # Permite requisições de outras origens
 
-# Nome do arquivo onde as visitas serão armazenadas em formato JSON
-ARQUIVO = 'visitas.json'
+# Backend de armazenamento das visitas: 'json', 'jsonl', 'sqlite' ou 'binario'
+FORMATO_ARMAZENAMENTO = config.FORMATO_ARMAZENAMENTO
+
+# 'imediata' (grava antes de responder) ou 'lote' (fila + gravação em segundo plano)
+DURABILIDADE = config.DURABILIDADE
 
-# Trava para evitar problemas de acesso concorrente ao arquivo
-bloqueio = Lock()
+# Sites atendidos: o padrão (/api/visitas/...) e os de /api/sites/<site>/...,
+# cada um com seu armazenamento, contadores e travas
+sites = RegistroSites(FORMATO_ARMAZENAMENTO, DURABILIDADE)
+
+# Limite de registros por IP (RATE_LIMIT_ENABLED); None quando desligado
+limitador = (LimitadorTaxa(config.RATE_LIMIT_PER_MINUTE, config.RATE_LIMIT_MAX_IPS)
+             if config.RATE_LIMIT_ENABLED else None)
 
 
 def carregar_visitas():
     """
-    Carrega a lista de visitas do arquivo JSON.
-    Retorna uma lista vazia se o arquivo não existir.
+    Carrega a lista de visitas do site padrão.
+    Retorna uma lista vazia se ainda não houver visitas.
     """
-    try:
-        with open(ARQUIVO, 'r') as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return []
+    return sites.obter().armazenamento.carregar()
 
 
-def salvar_visitas(visitas):
+def gerar_lista_json(visitas, tamanho_bloco=1000):
     """
-    Salva a lista de visitas no arquivo JSON,
-    formatando o arquivo com indentação para melhor leitura.
+    Gera o documento {"visitas": [...], "total": n} aos poucos,
+    sem montar a lista completa em memória.
     """
-    with open(ARQUIVO, 'w') as f:
-        json.dump(visitas, f, indent=2)
+    yield '{"visitas": ['
+    total = 0
+    bloco = []
+    for visita in visitas:
+        bloco.append(('' if total == 0 else ',') + json.dumps(visita))
+        total += 1
+        if len(bloco) >= tamanho_bloco:
+            yield ''.join(bloco)
+            bloco = []
+    yield ''.join(bloco) + f'], "total": {total}}}'
+
+
+def obter_site(nome=None):
+    """
+    Retorna o site `nome` para a requisição atual e o mantém em uso até
+    o fim da resposta (ver liberar_sites), para que a descarga de sites
+    ociosos não feche o armazenamento no meio de um streaming.
+    """
+    site = sites.obter(nome, em_uso=True)
+    g.setdefault('sites_em_uso', []).append(site)
+    return site
+
 
+def obter_ip_cliente():
+    """Obtém o IP do cliente (considerando proxies)"""
+    if request.headers.get('X-Forwarded-For'):
+        return request.headers.get('X-Forwarded-For').split(',')[0].strip()
+    return request.remote_addr
 
-def adicionar_visita(ip, user_agent):
+
+def ler_parametro_data(nome, padrao=None, fim_do_dia=False):
     """
-    Adiciona uma nova visita com IP e user agent,
-    registrando a data e hora atual no formato ISO.
-    A operação é protegida com um bloqueio para evitar
-    acessos simultâneos conflitantes.
+    Lê um parâmetro de data (AAAA-MM-DD) ou data/hora ISO.
+    Sem `padrao`, o parâmetro é obrigatório.
+    Com `fim_do_dia`, uma data sem hora inclui o dia inteiro.
+    Lança ValueError com uma mensagem clara se for inválido.
     """
-    with bloqueio:
-        visitas = carregar_visitas()
-        visitas.append({
-            'tempo': datetime.now().isoformat(),
-            'ip': ip,
-            'user_agent': user_agent
-        })
-        salvar_visitas(visitas)
+    valor = request.args.get(nome)
+    if not valor:
+        if padrao is not None:
+            return padrao
+        raise ValueError(f"Parâmetro '{nome}' é obrigatório")
+    try:
+        instante = datetime.fromisoformat(valor)
+    except ValueError:
+        raise ValueError(
+            f"Parâmetro '{nome}' deve ser uma data ISO "
+            "(AAAA-MM-DD ou AAAA-MM-DDTHH:MM:SS)")
+    if fim_do_dia and len(valor) == 10:
+        instante += timedelta(days=1)
+    return instante
 
 
-def contar_visitas_hoje():
+def ler_parametro_inteiro(nome, padrao, minimo=0, maximo=None):
     """
-    Conta quantas visitas foram feitas no dia atual,
-    comparando a data da visita com a data atual.
+    Lê um parâmetro inteiro da query string.
+    Lança ValueError com uma mensagem clara se for inválido.
     """
-    with bloqueio:
-        visitas = carregar_visitas()
-        hoje = datetime.now().date()
-        return sum(1 for v in visitas if datetime.fromisoformat(v['tempo']).date() == hoje)
+    valor = request.args.get(nome)
+    if valor is None:
+        return padrao
+    try:
+        valor = int(valor)
+    except ValueError:
+        raise ValueError(f"Parâmetro '{nome}' deve ser um número inteiro")
+    if valor < minimo or (maximo is not None and valor > maximo):
+        limites = f"entre {minimo} e {maximo}" if maximo is not None else f">= {minimo}"
+        raise ValueError(f"Parâmetro '{nome}' deve ser {limites}")
+    return valor
 
 
-def contar_total_visitas():
+def validar_visita(registro):
+    """
+    Valida um registro {tempo, ip, user_agent} recebido em lote e
+    retorna a visita normalizada: 'tempo' em ISO no horário local
+    (datas com fuso são convertidas) e User-Agent 'Desconhecido'
+    quando ausente. Lança ValueError com o motivo da rejeição.
+    """
+    if not isinstance(registro, dict):
+        raise ValueError("Registro deve ser um objeto JSON")
+    tempo = registro.get('tempo')
+    if not isinstance(tempo, str):
+        raise ValueError("Campo 'tempo' é obrigatório")
+    try:
+        instante = datetime.fromisoformat(tempo)
+    except ValueError:
+        raise ValueError("Campo 'tempo' deve ser uma data/hora ISO")
+    if instante.tzinfo is not None:
+        instante = instante.astimezone().replace(tzinfo=None)
+    ip = registro.get('ip')
+    user_agent = registro.get('user_agent', 'Desconhecido')
+    if ip is not None and not isinstance(ip, str):
+        raise ValueError("Campo 'ip' deve ser texto")
+    if not isinstance(user_agent, str):
+        raise ValueError("Campo 'user_agent' deve ser texto")
+    return {
+        'tempo': instante.isoformat(),
+        'ip': ip,
+        'user_agent': user_agent
+    }
+
+
+def ler_lote_visitas(corte=None):
     """
-    Conta o total de visitas registradas.
+    Lê o corpo de POST /api/visitas/registrar/lote: um array JSON ou
+    NDJSON (um registro por linha). Retorna (visitas válidas, rejeições),
+    onde cada rejeição é {'indice', 'erro'}. Visitas de dias anteriores
+    ao `corte` da retenção (AAAA-MM-DD) são rejeitadas: esses dias já
+    foram agregados. Lança ValueError se o corpo inteiro for inválido
+    ou exceder LOTE_INGESTAO_MAXIMO registros.
     """
-    with bloqueio:
-        visitas = carregar_visitas()
-        return len(visitas)
+    corpo = request.get_data(as_text=True)
+    if corpo.lstrip().startswith('['):
+        try:
+            registros = json.loads(corpo)
+        except ValueError:
+            raise ValueError("Corpo não é um array JSON válido")
+    else:
+        registros = []
+        for linha in corpo.splitlines():
+            if not linha.strip():
+                continue
+            try:
+                registros.append(json.loads(linha))
+            except ValueError:
+                registros.append(None)
+
+    if len(registros) > config.LOTE_INGESTAO_MAXIMO:
+        raise ValueError(
+            f"Máximo de {config.LOTE_INGESTAO_MAXIMO} visitas por lote")
+
+    visitas = []
+    rejeicoes = []
+    for indice, registro in enumerate(registros):
+        if registro is None:
+            rejeicoes.append({'indice': indice, 'erro': 'Linha não é um JSON válido'})
+            continue
+        try:
+            visita = validar_visita(registro)
+        except ValueError as e:
+            rejeicoes.append({'indice': indice, 'erro': str(e)})
+            continue
+        if corte is not None and visita['tempo'] < corte:
+            rejeicoes.append({
+                'indice': indice,
+                'erro': f"Visita anterior ao corte da retenção ({corte})"
+            })
+            continue
+        visitas.append(visita)
+    return visitas, rejeicoes
+
+
+def resposta_em_cache(visao):
+    """
+    Cache HTTP das rotas de leitura que só mudam com novas visitas ou
+    na virada do dia (total e hoje):
+    - ETag fraco derivado do número de sequência de visitas do site,
+      do dia atual e do formato. Um If-None-Match igual responde 304
+      sem montar a resposta.
+    - Last-Modified acompanha a última visita (ou a meia-noite). Sem
+      If-None-Match, um If-Modified-Since igual ou posterior responde
+      304. Como o cabeçalho tem resolução de um segundo, Last-Modified
+      só é enviado depois que o segundo da última alteração passou: uma
+      visita no mesmo segundo não pode ficar escondida atrás de um 304.
+    - Opcionalmente, a resposta pronta fica em cache no servidor por
+      CACHE_TTL_SEGUNDOS[formato] segundos e é servida como bytes. A
+      chave inclui o dia, para 'hoje' não servir o corpo de ontem.
+    Respostas de erro não entram no cache.
+    """
+    @wraps(visao)
+    def envoltorio(site=None):
+        if site is None and not sites.pronto():
+            # Ainda carregando: sem cache, a própria rota responde
+            return visao(site)
+        try:
+            dados_site = obter_site(site)
+            sequencia, alteracao = dados_site.versao()
+        except ValueError:
+            # Nome de site inválido: a própria rota responde o erro
+            return visao(site)
+
+        formato = request.args.get('formato', 'real')
+        agora = datetime.now()
+        dia = agora.strftime('%Y-%m-%d')
+        chave = (request.path, formato, dia)
+        ttl = config.CACHE_TTL_SEGUNDOS.get(formato, 0)
+
+        entrada = dados_site.cache_respostas.get(chave)
+        if entrada is not None and time.monotonic() >= entrada['expira']:
+            entrada = None
+        if entrada is not None:
+            etag, alteracao = entrada['etag'], entrada['alteracao']
+        else:
+            etag = f'{sequencia}-{dia}-{formato}'
+            # Na virada do dia 'hoje' muda mesmo sem visitas novas
+            meia_noite = agora.replace(hour=0, minute=0, second=0, microsecond=0)
+            alteracao = max(alteracao, meia_noite.timestamp())
+
+        # Resolução do Last-Modified: segundos inteiros
+        segundo = int(alteracao)
+        ultima_modificacao = None
+        if segundo < int(time.time()):
+            ultima_modificacao = datetime.fromtimestamp(segundo, timezone.utc)
+
+        if request.if_none_match:
+            nao_modificada = request.if_none_match.contains_weak(etag)
+        else:
+            desde = request.if_modified_since
+            nao_modificada = (ultima_modificacao is not None and desde is not None
+                              and ultima_modificacao <= desde)
+
+        if nao_modificada:
+            resposta = Response(status=304)
+        elif entrada is not None:
+            resposta = Response(entrada['corpo'], mimetype='application/json')
+        else:
+            resposta = app.make_response(visao(site))
+            if resposta.status_code == 200 and ttl > 0:
+                # Entradas de outros dias não são mais servidas
+                for antiga in list(dados_site.cache_respostas):
+                    if antiga[2] != dia:
+                        dados_site.cache_respostas.pop(antiga, None)
+                dados_site.cache_respostas[chave] = {
+                    'etag': etag,
+                    'alteracao': alteracao,
+                    'corpo': resposta.get_data(),
+                    'expira': time.monotonic() + ttl
+                }
+
+        resposta.set_etag(etag, weak=True)
+        if ultima_modificacao is not None:
+            resposta.last_modified = ultima_modificacao
+        resposta.cache_control.no_cache = True
+        return resposta
+
+    return envoltorio
 
 
 def formatar_numero(n):
@@ -92,22 +302,91 @@ def formatar_numero(n):
         return f"{n/1_000_000_000:.1f}G"
 
 
+atexit.register(sites.fechar_todos)
+sites.iniciar_manutencao()
+
+
+@app.before_request
+def iniciar_medicao():
+    g.inicio_requisicao = time.perf_counter()
+
+
+@app.after_request
+def registrar_medicao(resposta):
+    """
+    Soma a requisição às métricas de /metrics, pela regra da rota (sem
+    os valores de <site>). Em respostas em streaming mede até o início
+    do corpo.
+    """
+    inicio = g.get('inicio_requisicao')
+    if inicio is not None:
+        rota = request.url_rule.rule if request.url_rule else 'desconhecida'
+        metricas.registrar_requisicao(request.method, rota, resposta.status_code,
+                                      time.perf_counter() - inicio)
+    return resposta
+
+
+@app.after_request
+def liberar_sites(resposta):
+    """
+    Libera os sites usados pela requisição quando a resposta termina de
+    ser enviada: em streaming, só depois do último bloco do corpo.
+    """
+    em_uso = g.pop('sites_em_uso', [])
+    if em_uso:
+        def liberar():
+            for site in em_uso:
+                sites.liberar(site)
+        resposta.call_on_close(liberar)
+    return resposta
+
+
+@app.teardown_request
+def liberar_sites_restantes(erro=None):
+    """Libera os sites de uma requisição que terminou sem resposta (exceção)."""
+    for site in g.pop('sites_em_uso', []):
+        sites.liberar(site)
+
+
 # Rotas da API
 
 
+# Corpo e ETag de GET /, serializados uma única vez (ver info_api)
+resposta_info = None
+
+
 @app.route('/')
 def info_api():
     """Informações da API"""
+    global resposta_info
+    if resposta_info is None:
+        resposta_info = montar_info_api().get_data()
+    resposta = Response(resposta_info, mimetype='application/json')
+    resposta.add_etag()
+    return resposta.make_conditional(request)
+
+
+def montar_info_api():
+    """Monta a resposta de GET /, que não muda enquanto a API roda."""
     return jsonify({
         'nome': 'API Contador de Visitas',
         'versao': '1.0.0',
         'descricao': 'API para contagem e registro de visitas',
         'endpoints': {
             'POST /api/visitas/registrar': 'Registra uma nova visita',
+            'POST /api/visitas/registrar/lote': 'Registra um lote de visitas (array JSON ou NDJSON de {tempo, ip, user_agent})',
             'GET /api/visitas/total': 'Retorna total de visitas',
             'GET /api/visitas/hoje': 'Retorna visitas do dia atual',
             'GET /api/visitas/todas': 'Lista todas as visitas',
-            'GET /api/status': 'Status da API'
+            'GET /api/visitas/exportar': 'Exporta todas as visitas em arquivo (?formato=ndjson|csv&compressao=gzip)',
+            'GET /api/visitas/exportar/segmentos': 'Lista os segmentos da exportação, baixados um a um (com Range) em .../segmentos/<n>',
+            'GET /api/visitas/intervalo': 'Retorna visitas entre duas datas (?de=...&ate=...)',
+            'GET /api/visitas/historico': 'Histórico por hora ou por dia (?granularidade=hora|dia)',
+            'GET /api/visitas/unicos': 'Estimativa de visitantes únicos (?periodo=hoje|mes|intervalo)',
+            'GET /api/visitas/top': 'IPs ou User-Agents mais frequentes do dia (?campo=ip|user_agent&n=20)',
+            'GET /api/status': 'Status da API',
+            'GET /api/sites/<site>/...': 'Os mesmos endpoints de /api/visitas/... e /api/status, separados por site',
+            'GET /metrics': 'Métricas no formato de texto do Prometheus'
         },
         'parametros': {
             'formato': {
@@ -129,26 +408,77 @@ def info_api():
 
 
 @app.route('/api/visitas/registrar', methods=['POST'])
-def registrar_visita():
+@app.route('/api/sites/<site>/visitas/registrar', methods=['POST'])
+def registrar_visita(site=None):
     """Registra uma nova visita"""
     try:
-        # Obtém o IP do cliente (considerando proxies)
-        if request.headers.get('X-Forwarded-For'):
-            ip = request.headers.get('X-Forwarded-For').split(',')[0].strip()
-        else:
-            ip = request.remote_addr
+        ip = obter_ip_cliente()
+
+        # Recusa antes de carregar o site ou tocar no armazenamento
+        if limitador is not None:
+            espera = limitador.permitir((site, ip))
+            if espera:
+                resposta = jsonify({
+                    'sucesso': False,
+                    'erro': 'Limite de registros por minuto excedido'
+                })
+                resposta.headers['Retry-After'] = str(max(1, round(espera)))
+                return resposta, 429
+
+        site = obter_site(site)
 
         # Obtém o User-Agent
         user_agent = request.headers.get('User-Agent', 'Desconhecido')
 
-        # Registra a visita
-        adicionar_visita(ip, user_agent)
+        # Registra a visita (a não ser que seja repetida dentro da janela)
+        if not site.adicionar_visita(ip, user_agent):
+            return jsonify({
+                'sucesso': True,
+                'mensagem': 'Visita repetida dentro da janela de deduplicação; não contabilizada',
+                'duplicada': True,
+                'ip': ip
+            })
 
         return jsonify({
             'sucesso': True,
             'mensagem': 'Visita registrada com sucesso',
             'ip': ip
         })
+    except ValueError as e:
+        return jsonify({
+            'sucesso': False,
+            'erro': str(e)
+        }), 400
+    except Exception as e:
+        return jsonify({
+            'sucesso': False,
+            'erro': str(e)
+        }), 500
+
+
+@app.route('/api/visitas/registrar/lote', methods=['POST'])
+@app.route('/api/sites/<site>/visitas/registrar/lote', methods=['POST'])
+def registrar_visitas_em_lote(site=None):
+    """Registra um lote de visitas encaminhadas (array JSON ou NDJSON)"""
+    try:
+        site = obter_site(site)
+        visitas, rejeicoes = ler_lote_visitas(site.agregados.corte)
+
+        # Um único registro no armazenamento e nos contadores
+        site.adicionar_visitas(visitas)
+
+        return jsonify({
+            'sucesso': True,
+            'aceitas': len(visitas),
+            'rejeitadas': len(rejeicoes),
+            # Detalha só as primeiras rejeições para limitar a resposta
+            'erros': rejeicoes[:100]
+        })
+    except ValueError as e:
+        return jsonify({
+            'sucesso': False,
+            'erro': str(e)
+        }), 400
     except Exception as e:
         return jsonify({
             'sucesso': False,
@@ -157,10 +487,13 @@ def registrar_visita():
 
 
 @app.route('/api/visitas/total')
-def obter_total_visitas():
+@app.route('/api/sites/<site>/visitas/total')
+@resposta_em_cache
+def obter_total_visitas(site=None):
     """Retorna o total de visitas"""
     try:
-        total = contar_total_visitas()
+        site = obter_site(site)
+        total = site.contar_total_visitas()
         # Verifica se deve formatar ou não
         formato = request.args.get('formato', 'real')  # 'real' ou 'compacto'
 
@@ -175,6 +508,10 @@ def obter_total_visitas():
             response['visitas'] = str(total)
 
         return jsonify(response)
+    except ValueError as e:
+        return jsonify({
+            'erro': str(e)
+        }), 400
     except Exception as e:
         return jsonify({
             'erro': str(e)
@@ -182,10 +519,13 @@ def obter_total_visitas():
 
 
 @app.route('/api/visitas/hoje')
-def obter_visitas_hoje():
+@app.route('/api/sites/<site>/visitas/hoje')
+@resposta_em_cache
+def obter_visitas_hoje(site=None):
     """Retorna as visitas de hoje"""
     try:
-        hoje = contar_visitas_hoje()
+        site = obter_site(site)
+        hoje = site.contar_visitas_hoje()
         # Verifica se deve formatar ou não
         formato = request.args.get('formato', 'real')  # 'real' ou 'compacto'
 
@@ -201,6 +541,10 @@ def obter_visitas_hoje():
             response['visitas'] = str(hoje)
 
         return jsonify(response)
+    except ValueError as e:
+        return jsonify({
+            'erro': str(e)
+        }), 400
     except Exception as e:
         return jsonify({
             'erro': str(e)
@@ -208,14 +552,343 @@ def obter_visitas_hoje():
 
 
 @app.route('/api/visitas/todas')
-def obter_todas_visitas():
-    """Retorna todas as visitas (para debugging)"""
+@app.route('/api/sites/<site>/visitas/todas')
+def obter_todas_visitas(site=None):
+    """Retorna as visitas (paginadas, em stream NDJSON ou todas)"""
     try:
-        visitas = carregar_visitas()
+        site = obter_site(site)
+        cursor = ler_parametro_inteiro('cursor', 0)
+        limite = request.args.get('limite')
+        formato = request.args.get('formato')
+
+        # Página única: ?limite=N&cursor=C
+        if limite is not None:
+            limite = ler_parametro_inteiro(
+                'limite', None, 1, config.PAGINA_LIMITE_MAXIMO)
+            visitas, proximo_cursor = site.paginar_visitas(cursor, limite)
+            return jsonify({
+                'visitas': visitas,
+                'quantidade': len(visitas),
+                'total': site.contar_total_visitas(),
+                'cursor': cursor,
+                'proximo_cursor': proximo_cursor,
+                'tem_mais': len(visitas) == limite
+            })
+
+        visitas = site.iterar_visitas(cursor)
+
+        # Stream NDJSON: uma visita por linha, memória constante
+        if formato == 'ndjson':
+            return Response(codificar(visitas, 'ndjson'),
+                            mimetype='application/x-ndjson')
+
+        # Lista completa, gerada aos poucos no mesmo formato de antes
+        return Response(gerar_lista_json(visitas),
+                        mimetype='application/json')
+    except ValueError as e:
         return jsonify({
-            'visitas': visitas,
-            'total': len(visitas)
+            'erro': str(e)
+        }), 400
+    except Exception as e:
+        return jsonify({
+            'erro': str(e)
+        }), 500
+
+
+def ler_parametros_exportacao():
+    """
+    Lê ?formato=ndjson|csv (padrão ndjson) e ?compressao=gzip (opcional)
+    das rotas de exportação. Lança ValueError se forem inválidos.
+    """
+    formato = request.args.get('formato', 'ndjson')
+    if formato not in FORMATOS:
+        raise ValueError("Parâmetro 'formato' deve ser 'ndjson' ou 'csv'")
+    compressao = request.args.get('compressao') or None
+    if compressao is not None and compressao not in COMPRESSOES:
+        raise ValueError("Parâmetro 'compressao' deve ser 'gzip'")
+    return formato, compressao
+
+
+def nome_exportacao(site, formato, compressao, numero=None):
+    """Nome do arquivo baixado, como visitas-blog.csv.gz."""
+    nome = 'visitas' if site.nome is None else f'visitas-{site.nome}'
+    if numero is not None:
+        nome += f'-{numero:06d}'
+    return f"{nome}.{formato}" + ('.gz' if compressao else '')
+
+
+def tipo_exportacao(formato, compressao):
+    return 'application/gzip' if compressao else FORMATOS[formato]
+
+
+@app.route('/api/visitas/exportar')
+@app.route('/api/sites/<site>/visitas/exportar')
+def exportar_visitas(site=None):
+    """
+    Exporta todas as visitas em um arquivo NDJSON ou CSV, opcionalmente
+    em gzip. Os segmentos selados são copiados do disco como estão; só
+    o segmento ativo é codificado na hora. Com ?desde_segmento=N, pula
+    os N primeiros segmentos (já baixados por .../segmentos/<n>).
+    """
+    try:
+        site = obter_site(site)
+        formato, compressao = ler_parametros_exportacao()
+        desde = ler_parametro_inteiro('desde_segmento', 0)
+        segmentos, arquivos, cursor = site.exportar(formato, compressao)
+        if desde > len(segmentos):
+            raise ValueError(f"Há só {len(segmentos)} segmentos selados")
+
+        resposta = Response(
+            gerar_exportacao(arquivos[desde:], formato, compressao,
+                             site.armazenamento.iterar(cursor)),
+            mimetype=tipo_exportacao(formato, compressao))
+        resposta.headers['Content-Disposition'] = (
+            f'attachment; filename="{nome_exportacao(site, formato, compressao)}"')
+        return resposta
+    except ValueError as e:
+        return jsonify({
+            'erro': str(e)
+        }), 400
+    except Exception as e:
+        return jsonify({
+            'erro': str(e)
+        }), 500
+
+
+@app.route('/api/visitas/exportar/segmentos')
+@app.route('/api/sites/<site>/visitas/exportar/segmentos')
+def listar_segmentos_exportacao(site=None):
+    """
+    Lista os segmentos selados da exportação, com tamanho e endereço
+    de cada arquivo, e onde baixar o segmento ativo
+    """
+    try:
+        site = obter_site(site)
+        formato, compressao = ler_parametros_exportacao()
+        segmentos, arquivos, _ = site.exportar(formato, compressao)
+        parametros = f'formato={formato}' + (f'&compressao={compressao}' if compressao else '')
+        base = request.path.rsplit('/segmentos', 1)[0]
+
+        return jsonify({
+            'formato': formato,
+            'compressao': compressao,
+            'segmentos': [{
+                'numero': numero,
+                'visitas': segmento['visitas'],
+                'bytes': os.path.getsize(arquivo),
+                'url': f'{request.path}/{numero}?{parametros}'
+            } for numero, (segmento, arquivo) in enumerate(zip(segmentos, arquivos))],
+            'ativo': {
+                'url': f'{base}?{parametros}&desde_segmento={len(segmentos)}'
+            }
         })
+    except ValueError as e:
+        return jsonify({
+            'erro': str(e)
+        }), 400
+    except Exception as e:
+        return jsonify({
+            'erro': str(e)
+        }), 500
+
+
+@app.route('/api/visitas/exportar/segmentos/<int:numero>')
+@app.route('/api/sites/<site>/visitas/exportar/segmentos/<int:numero>')
+def baixar_segmento_exportacao(numero, site=None):
+    """
+    Serve o arquivo de um segmento selado direto do disco (send_file:
+    sendfile no servidor, ETag, If-Range e requisições Range)
+    """
+    try:
+        site = obter_site(site)
+        formato, compressao = ler_parametros_exportacao()
+        segmentos, arquivos, _ = site.exportar(formato, compressao, numero)
+        if numero >= len(segmentos):
+            return jsonify({
+                'erro': f"Segmento {numero} não existe ou ainda não foi selado"
+            }), 404
+        return send_file(os.path.abspath(arquivos[numero]),
+                         mimetype=tipo_exportacao(formato, compressao),
+                         as_attachment=True,
+                         download_name=nome_exportacao(site, formato, compressao, numero),
+                         conditional=True, etag=True)
+    except ValueError as e:
+        return jsonify({
+            'erro': str(e)
+        }), 400
+    except Exception as e:
+        return jsonify({
+            'erro': str(e)
+        }), 500
+
+
+@app.route('/api/visitas/intervalo')
+@app.route('/api/sites/<site>/visitas/intervalo')
+def obter_visitas_intervalo(site=None):
+    """Retorna as visitas entre duas datas/horas"""
+    try:
+        site = obter_site(site)
+        de = ler_parametro_data('de')
+        ate = ler_parametro_data('ate', datetime.now() + timedelta(seconds=1),
+                                 fim_do_dia=True)
+        if ate < de:
+            raise ValueError("Parâmetro 'ate' deve ser posterior a 'de'")
+        total = site.contar_visitas_intervalo(de, ate)
+        formato = request.args.get('formato', 'real')  # 'real' ou 'compacto'
+
+        response = {
+            'de': de.isoformat(),
+            'ate': ate.isoformat(),
+            'total': total,
+            'formato': formato
+        }
+
+        if formato == 'compacto':
+            response['visitas'] = formatar_numero(total)
+        else:
+            response['visitas'] = str(total)
+
+        # Lista opcional das visitas do intervalo: ?listar=true&limite=N
+        if request.args.get('listar', '').lower() == 'true':
+            limite = ler_parametro_inteiro(
+                'limite', 100, 1, config.PAGINA_LIMITE_MAXIMO)
+            response['registros'] = site.listar_visitas_intervalo(de, ate, limite)
+
+        return jsonify(response)
+    except ValueError as e:
+        return jsonify({
+            'erro': str(e)
+        }), 400
+    except Exception as e:
+        return jsonify({
+            'erro': str(e)
+        }), 500
+
+
+@app.route('/api/visitas/historico')
+@app.route('/api/sites/<site>/visitas/historico')
+def obter_historico_visitas(site=None):
+    """Retorna o histórico de visitas por hora ou por dia"""
+    try:
+        site = obter_site(site)
+        granularidade = request.args.get('granularidade', 'hora')
+        if granularidade not in ('hora', 'dia'):
+            raise ValueError("Parâmetro 'granularidade' deve ser 'hora' ou 'dia'")
+        dias = ler_parametro_inteiro(
+            'dias', 30, 1, config.HISTORICO_DIAS_MAXIMO)
+        formato = request.args.get('formato', 'real')  # 'real' ou 'compacto'
+
+        serie = site.obter_historico(granularidade, dias)
+        total = sum(visitas for _, visitas in serie)
+
+        response = {
+            'granularidade': granularidade,
+            'dias': dias,
+            'total': total,
+            'formato': formato,
+            'historico': [
+                {'periodo': periodo, 'visitas': visitas}
+                for periodo, visitas in serie
+            ]
+        }
+
+        if formato == 'compacto':
+            response['visitas'] = formatar_numero(total)
+        else:
+            response['visitas'] = str(total)
+
+        return jsonify(response)
+    except ValueError as e:
+        return jsonify({
+            'erro': str(e)
+        }), 400
+    except Exception as e:
+        return jsonify({
+            'erro': str(e)
+        }), 500
+
+
+@app.route('/api/visitas/unicos')
+@app.route('/api/sites/<site>/visitas/unicos')
+def obter_visitantes_unicos(site=None):
+    """Retorna a estimativa de visitantes únicos"""
+    try:
+        site = obter_site(site)
+        periodo = request.args.get('periodo', 'hoje')  # 'hoje', 'mes' ou 'intervalo'
+        hoje = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+
+        if periodo == 'hoje':
+            de = ate = hoje
+            total = site.contar_unicos_hoje()
+        elif periodo == 'mes':
+            de, ate = hoje.replace(day=1), hoje
+            total = site.contar_unicos_mes()
+        elif periodo == 'intervalo':
+            de = ler_parametro_data('de')
+            ate = ler_parametro_data('ate', hoje)
+            if ate < de:
+                raise ValueError("Parâmetro 'ate' deve ser posterior a 'de'")
+            if (ate - de).days >= config.HISTORICO_DIAS_MAXIMO:
+                raise ValueError(
+                    f"Intervalo máximo de {config.HISTORICO_DIAS_MAXIMO} dias")
+            total = site.contar_unicos(de, ate)
+        else:
+            raise ValueError(
+                "Parâmetro 'periodo' deve ser 'hoje', 'mes' ou 'intervalo'")
+
+        formato = request.args.get('formato', 'real')  # 'real' ou 'compacto'
+
+        response = {
+            'periodo': periodo,
+            'de': de.strftime('%Y-%m-%d'),
+            'ate': ate.strftime('%Y-%m-%d'),
+            'unicos': total,
+            'aproximado': True,
+            'formato': formato
+        }
+
+        if formato == 'compacto':
+            response['visitantes'] = formatar_numero(total)
+        else:
+            response['visitantes'] = str(total)
+
+        return jsonify(response)
+    except ValueError as e:
+        return jsonify({
+            'erro': str(e)
+        }), 400
+    except Exception as e:
+        return jsonify({
+            'erro': str(e)
+        }), 500
+
+
+@app.route('/api/visitas/top')
+@app.route('/api/sites/<site>/visitas/top')
+def obter_mais_frequentes(site=None):
+    """Retorna os IPs ou User-Agents mais frequentes de um dia"""
+    try:
+        site = obter_site(site)
+        campo = request.args.get('campo', 'ip')  # 'ip' ou 'user_agent'
+        n = ler_parametro_inteiro('n', 20, minimo=1, maximo=config.TOP_CAPACIDADE)
+        dia = ler_parametro_data('dia', datetime.now()).strftime('%Y-%m-%d')
+        itens, exato = site.obter_mais_frequentes(campo, n, dia)
+
+        return jsonify({
+            'campo': campo,
+            'dia': dia,
+            'n': n,
+            'top': [
+                {'valor': valor, 'visitas': visitas, 'erro_maximo': erro}
+                for valor, visitas, erro in itens
+            ],
+            'exato': exato,
+            'visitas_dia': site.contar_visitas_no_dia(dia)
+        })
+    except ValueError as e:
+        return jsonify({
+            'erro': str(e)
+        }), 400
     except Exception as e:
         return jsonify({
             'erro': str(e)
@@ -223,23 +896,58 @@ def obter_todas_visitas():
 
 
 @app.route('/api/status')
-def status_api():
-    """Status da API"""
+@app.route('/api/sites/<site>/status')
+def status_api(site=None):
+    """
+    Status da API. Fica fora de `resposta_em_cache`: durabilidade,
+    deduplicação, limite de taxa e timestamp mudam sem novas visitas,
+    então a resposta é sempre montada na hora.
+    """
     try:
-        total = contar_total_visitas()
-        hoje = contar_visitas_hoje()
+        if site is None and not sites.pronto():
+            # Sinal de prontidão: 503 até o estado do site padrão estar em memória
+            return jsonify({
+                'status': 'iniciando',
+                'pronto': False,
+                'timestamp': datetime.now().isoformat()
+            }), 503
+
+        site = obter_site(site)
+        # Contagens e únicos do mesmo instantâneo, sempre coerentes entre si
+        instantaneo = site.instantaneo_atual()
+        total, hoje = instantaneo.total, instantaneo.visitas_dia
         formato = request.args.get('formato', 'real')  # 'real' ou 'compacto'
 
         response = {
             'status': 'online',
+            'pronto': True,
             'timestamp': datetime.now().isoformat(),
             'formato': formato,
             'estatisticas': {
                 'total_visitas': total,
-                'visitas_hoje': hoje
-            }
+                'visitas_hoje': hoje,
+                'unicos_hoje': instantaneo.unicos_dia,
+                'unicos_mes': instantaneo.unicos_mes
+            },
+            'durabilidade': site.estado_durabilidade(),
+            'carga': site.estado_carga,
+            'sites_carregados': len(sites.carregados())
         }
 
+        if site.deduplicacao is not None:
+            response['deduplicacao'] = site.deduplicacao.estado()
+
+        retencao = site.estado_retencao()
+        if retencao is not None:
+            response['retencao'] = retencao
+
+        if limitador is not None:
+            response['limite_taxa'] = dict(
+                por_minuto=config.RATE_LIMIT_PER_MINUTE, **limitador.estado())
+
+        if site.nome is not None:
+            response['site'] = site.nome
+
         # Adiciona formatação baseada no parâmetro
         if formato == 'compacto':
             response['estatisticas']['total_exibicao'] = formatar_numero(total)
@@ -248,7 +956,14 @@ def status_api():
             response['estatisticas']['total_exibicao'] = str(total)
             response['estatisticas']['hoje_exibicao'] = str(hoje)
 
-        return jsonify(response)
+        resposta = jsonify(response)
+        resposta.cache_control.no_store = True
+        return resposta
+    except ValueError as e:
+        return jsonify({
+            'status': 'erro',
+            'erro': str(e)
+        }), 400
     except Exception as e:
         return jsonify({
             'status': 'erro',
@@ -256,10 +971,31 @@ def status_api():
         }), 500
 
 
+@app.route('/metrics')
+def metricas_api():
+    """Métricas no formato de texto do Prometheus"""
+    try:
+        carregados = [
+            (site.nome or 'padrao', site.contar_total_visitas(),
+             site.armazenamento.tamanho_em_disco())
+            for site in sites.carregados() if site.aberto
+        ]
+        return Response(metricas.formatar(carregados),
+                        mimetype='text/plain; version=0.0.4')
+    except Exception as e:
+        return jsonify({
+            'erro': str(e)
+        }), 500
+
+
 # Executa o servidor Flask
 if __name__ == '__main__':
-    import os
-    
+    import signal
+    import sys
+
+    # Encerra via SystemExit no SIGTERM para que a fila seja descarregada
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
     # Configurações para deploy
     port = int(os.environ.get('PORT', 5000))
     host = os.environ.get('HOST', '0.0.0.0')
@@ -269,10 +1005,19 @@ if __name__ == '__main__':
     print(" Endpoints disponíveis:")
     print("   - GET  / (info da API)")
     print("   - POST /api/visitas/registrar")
+    print("   - POST /api/visitas/registrar/lote")
     print("   - GET  /api/visitas/total")
     print("   - GET  /api/visitas/hoje")
     print("   - GET  /api/visitas/todas")
+    print("   - GET  /api/visitas/exportar")
+    print("   - GET  /api/visitas/exportar/segmentos[/<n>]")
+    print("   - GET  /api/visitas/intervalo")
+    print("   - GET  /api/visitas/historico")
+    print("   - GET  /api/visitas/unicos")
+    print("   - GET  /api/visitas/top")
     print("   - GET  /api/status")
+    print("   - GET  /metrics")
+    print("   - /api/sites/<site>/... (os mesmos endpoints, por site)")
     print(f" API rodando em: http://{host}:{port}")
     
     app.run(debug=debug, host=host, port=port)
@@ -0,0 +1,1190 @@
+"""
+Backends de armazenamento das visitas
+
+Cada backend oferece a mesma interface:
+- preparar(): ajustes feitos uma vez na inicialização
+- abrir_leitura(): alternativa a preparar() para quem só lê ao lado
+  da API (backup): não grava nada nem faz a recuperação após queda
+- carregar(): lista com todas as visitas, em ordem de registro
+- gravar(novas, desde): grava um lote de visitas e retorna
+  (posições das novas, visitas alheias, fim); veja abaixo
+- ler_desde(cursor): gerador de (posição, próxima posição, visita)
+  a partir de `cursor`
+- fim(): cursor logo após a última visita completa
+- paginar(cursor, limite): até `limite` visitas a partir da posição
+  `cursor`, mais o cursor da próxima página
+- iterar(cursor): gerador das visitas a partir de `cursor`
+- obter(posicoes): visitas nas posições informadas, na mesma ordem
+- contagem_por_dia(): dicionário {AAAA-MM-DD: visitas}
+- descartar_anteriores(corte): apaga as visitas com tempo < corte
+  (AAAA-MM-DD), já resumidas pela retenção; as posições das visitas
+  mantidas podem mudar e devem ser relidas (ver sites.py)
+- tamanho_em_disco(): bytes ocupados pelos arquivos do backend
+- fechar(): libera recursos abertos
+
+O cursor (ou posição) é um inteiro opaco para o cliente, com significado
+próprio de cada backend (índice na lista, byte no log, id no banco ou
+número do registro binário).
+O cursor 0 sempre aponta para a primeira visita.
+
+Vários processos podem gravar no mesmo armazenamento: a gravação é feita
+sob uma trava exclusiva entre processos (flock em um arquivo '.lock' ou
+transação IMMEDIATE no SQLite). Quem grava informa em `desde` até onde
+já conhece o armazenamento; as visitas gravadas por outros processos a
+partir desse ponto são devolvidas como `alheias` [(posição, visita)],
+para que os contadores em memória de cada processo fiquem completos.
+"""
+
+import bisect
+import ipaddress
+import json
+import mmap
+import os
+import sqlite3
+import struct
+import sys
+import urllib.parse
+from array import array
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timedelta
+from itertools import chain, islice
+from threading import Lock, Thread
+
+import config
+from metricas import metricas
+
+try:
+    import fcntl
+except ImportError:  # Windows: sem trava entre processos
+    fcntl = None
+
+
+def serializar_visita(visita):
+    """Serializa uma visita como uma linha JSON compacta."""
+    return json.dumps(visita, separators=(',', ':')) + '\n'
+
+
+@contextmanager
+def trava_entre_processos(arquivo, exclusiva=True):
+    """
+    Trava consultiva (flock) em `arquivo`.lock, compartilhada por
+    todos os processos que usam o mesmo armazenamento.
+    """
+    with open(arquivo + '.lock', 'a') as f:
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusiva else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def truncar_linha_incompleta(caminho):
+    """
+    Descarta o trecho após a última quebra de linha de um arquivo
+    JSON Lines (uma gravação interrompida), para que a próxima
+    linha comece no lugar certo.
+    """
+    with open(caminho, 'rb+') as f:
+        fim = f.seek(0, os.SEEK_END)
+        posicao = fim
+        while posicao > 0:
+            inicio = max(0, posicao - 4096)
+            f.seek(inicio)
+            bloco = f.read(posicao - inicio)
+            quebra = bloco.rfind(b'\n')
+            if quebra != -1:
+                posicao = inicio + quebra + 1
+                break
+            posicao = inicio
+        if posicao != fim:
+            f.truncate(posicao)
+
+
+def tamanho_dos_campos(linhas):
+    """Bytes de texto em linhas de campos (estimativa de E/S do SQLite)."""
+    return sum(len(campo) for linha in linhas for campo in linha
+               if isinstance(campo, str))
+
+
+class CursorInvalido(ValueError):
+    """Cursor de paginação que não aponta para o início de uma visita."""
+
+
+class Armazenamento:
+    """
+    Base dos backends, com implementações genéricas construídas
+    sobre ler_desde(). Os backends sobrescrevem o que puderem
+    responder de forma mais eficiente.
+    """
+
+    nome = None
+
+    def preparar(self):
+        pass
+
+    def abrir_leitura(self):
+        pass
+
+    def carregar(self):
+        return list(self.iterar())
+
+    def iterar(self, cursor=0):
+        for _, _, visita in self.ler_desde(cursor):
+            yield visita
+
+    def paginar(self, cursor, limite):
+        visitas = []
+        for _, proxima, visita in islice(self.ler_desde(cursor), limite):
+            visitas.append(visita)
+            cursor = proxima
+        return visitas, cursor
+
+    def obter(self, posicoes):
+        return [self.paginar(posicao, 1)[0][0] for posicao in posicoes]
+
+    def contagem_por_dia(self):
+        por_dia = {}
+        for visita in self.iterar():
+            dia = visita['tempo'][:10]
+            por_dia[dia] = por_dia.get(dia, 0) + 1
+        return por_dia
+
+    def tamanho_em_disco(self):
+        return 0
+
+    def fechar(self):
+        pass
+
+
+class SnapshotIndexado:
+    """
+    Snapshot do formato 'json' lido do disco sob demanda. O snapshot é
+    gravado com uma visita por linha ('[' + ',\\n'.join(visitas) + ']\\n'),
+    então basta guardar onde começa e termina cada visita (16 bytes por
+    visita) em vez de manter a lista inteira decodificada em memória.
+    O arquivo fica aberto: leituras em andamento continuam vendo o mesmo
+    snapshot mesmo depois que a compactação o substitui.
+    Comporta-se como uma lista somente leitura (len, [i]).
+    """
+
+    def __init__(self, arquivo, inicios, fins):
+        self._arquivo = arquivo
+        self._inicios = inicios
+        self._fins = fins
+        self._bloqueio = Lock()
+
+    @classmethod
+    def abrir(cls, caminho):
+        """
+        Indexa o snapshot em `caminho` sem decodificar as visitas.
+        Retorna None se ele não estiver no formato de uma visita por
+        linha (como um visitas.json antigo, gravado com indentação).
+        """
+        arquivo = open(caminho, 'rb')
+        inicios, fins = array('q'), array('q')
+        posicao = 0
+        completo = False
+        for linha in arquivo:
+            if completo or (posicao == 0 and not linha.startswith(b'[')):
+                # Algo depois do ']' final, ou não é um array
+                completo = False
+                break
+            inicio = posicao + 1 if posicao == 0 else posicao
+            corpo = linha[inicio - posicao:]
+            posicao += len(linha)
+            if corpo == b']\n' and not inicios:
+                completo = True
+                continue
+            if not corpo.startswith(b'{') or corpo[-3:-1] not in (b'},', b'}]') \
+                    or not corpo.endswith(b'\n'):
+                break
+            inicios.append(inicio)
+            fins.append(posicao - 2)
+            completo = corpo.endswith(b']\n')
+        metricas.contar_bytes('lidos', posicao)
+        snapshot = cls(arquivo, inicios, fins)
+        if completo and inicios:
+            # Uma linha com várias visitas (array compacto em uma linha só)
+            try:
+                completo = all(isinstance(snapshot[i], dict) for i in (0, -1))
+            except ValueError:
+                completo = False
+        if not completo or posicao != os.fstat(arquivo.fileno()).st_size:
+            arquivo.close()
+            return None
+        return snapshot
+
+    def __len__(self):
+        return len(self._inicios)
+
+    def _ler_bytes(self, inicio, tamanho):
+        metricas.contar_bytes('lidos', tamanho)
+        if hasattr(os, 'pread'):
+            return os.pread(self._arquivo.fileno(), tamanho, inicio)
+        with self._bloqueio:
+            self._arquivo.seek(inicio)
+            return self._arquivo.read(tamanho)
+
+    def __getitem__(self, i):
+        return json.loads(self._ler_bytes(self._inicios[i],
+                                          self._fins[i] - self._inicios[i]))
+
+    def linhas(self, inicio=0, tamanho_bloco=1 << 20):
+        """Gera o JSON (bytes) de cada visita a partir de `inicio`, lendo em blocos."""
+        total = len(self._inicios)
+        i = inicio
+        while i < total:
+            base = self._inicios[i]
+            j = max(i + 1, bisect.bisect_right(self._fins, base + tamanho_bloco, i))
+            dados = self._ler_bytes(base, self._fins[j - 1] - base)
+            for k in range(i, j):
+                yield dados[self._inicios[k] - base:self._fins[k] - base]
+            i = j
+
+    def iterar(self, inicio=0):
+        for linha in self.linhas(inicio):
+            yield json.loads(linha)
+
+    def fechar(self):
+        self._arquivo.close()
+
+
+def linhas_da_parte(parte, inicio=0):
+    """JSON compacto (bytes) das visitas de uma parte do formato 'json'."""
+    if isinstance(parte, SnapshotIndexado):
+        return parte.linhas(inicio)
+    return (json.dumps(visita, separators=(',', ':')).encode()
+            for visita in islice(parte, inicio, None))
+
+
+class ArmazenamentoJSON(Armazenamento):
+    """
+    Snapshot compacto em um arquivo JSON (a lista de visitas do formato
+    original) mais um log de escrita antecipada (WAL, em JSON Lines)
+    com as visitas recentes. Gravar um lote é uma única escrita no fim
+    do WAL; o snapshot nunca é reescrito no lugar, então uma queda
+    não corrompe o histórico.
+
+    Quando o WAL passa de WAL_COMPACTAR_A_CADA visitas, uma thread em
+    segundo plano o incorpora ao snapshot, sem bloquear as gravações:
+    1. sob a trava, o WAL é selado (renomeado para '.wal.selado') e as
+       novas visitas passam a ir para um WAL novo;
+    2. sem trava, o novo snapshot é escrito em um arquivo temporário;
+    3. sob a trava, o temporário substitui o snapshot e o WAL selado
+       é apagado.
+    Cada WAL começa com uma linha {"base": n}, o número de visitas que o
+    antecedem. Um WAL com base menor que o tamanho do snapshot já foi
+    incorporado (queda entre os dois passos finais) e é ignorado.
+
+    O snapshot não fica decodificado em memória: é indexado (início e
+    fim de cada visita, ver SnapshotIndexado) e lido do disco sob
+    demanda; só o WAL, limitado pela compactação, fica em memória.
+    Um snapshot em outro formato (visitas.json antigo, com indentação)
+    é regravado com uma visita por linha em preparar(). O cursor é o
+    índice da visita na sequência snapshot + WAL selado + WAL.
+    """
+
+    nome = 'json'
+
+    def __init__(self, arquivo):
+        self.arquivo = arquivo
+        self.arquivo_wal = arquivo + '.wal'
+        self.arquivo_selado = arquivo + '.wal.selado'
+        # Snapshot completo gerado pela retenção, antes de substituir o atual
+        self.arquivo_retencao = arquivo + '.retencao'
+        # Estado lido dos arquivos (protegido por `_bloqueio`)
+        self._bloqueio = Lock()
+        self._assinaturas = None
+        self._assinatura_snapshot = None
+        self._snapshot = []
+        self._segmentos = {}
+        self._partes = [[]]
+        self._compactacao = None
+
+    def preparar(self):
+        """
+        Recuperação após uma queda: conclui uma retenção interrompida,
+        descarta linhas incompletas no fim dos WALs e apaga um WAL selado
+        que já esteja no snapshot.
+        Se o WAL já passou do limite, agenda uma compactação.
+        """
+        with trava_entre_processos(self.arquivo):
+            if os.path.exists(self.arquivo_retencao):
+                # Queda no meio da retenção: o novo snapshot já está completo
+                self._concluir_retencao()
+            for caminho in (self.arquivo_selado, self.arquivo_wal):
+                if os.path.exists(caminho):
+                    truncar_linha_incompleta(caminho)
+            self._atualizar(travado=True)
+            with self._bloqueio:
+                selado = self._segmentos.get(self.arquivo_selado)
+                if selado and selado['base'] is not None and \
+                        selado['base'] < len(self._snapshot):
+                    os.remove(self.arquivo_selado)
+                legado = self._snapshot if isinstance(self._snapshot, list) else None
+            if legado:
+                # Snapshot fora do formato de uma visita por linha: regrava
+                # para poder indexá-lo em vez de mantê-lo decodificado
+                os.replace(self._escrever_snapshot(linhas_da_parte(legado)),
+                           self.arquivo)
+                self._esquecer_snapshot()
+                self._atualizar(travado=True)
+        self._talvez_compactar()
+
+    def _assinatura(self, caminho):
+        try:
+            estado = os.stat(caminho)
+        except FileNotFoundError:
+            return None
+        return (estado.st_ino, estado.st_size, estado.st_mtime_ns)
+
+    def _ler_segmento(self, caminho):
+        """
+        Lê (de forma incremental) um WAL e retorna (base, visitas), ou
+        None se ele não existir ou ainda não tiver cabeçalho.
+        Deve ser chamada com `_bloqueio` adquirido.
+        """
+        assinatura = self._assinatura(caminho)
+        if assinatura is None:
+            self._segmentos.pop(caminho, None)
+            return None
+        inode, tamanho, _ = assinatura
+        cache = self._segmentos.get(caminho)
+        if cache is None or cache['inode'] != inode or tamanho < cache['lido']:
+            cache = self._segmentos[caminho] = {
+                'inode': inode, 'lido': 0, 'base': None, 'visitas': []}
+        if tamanho > cache['lido']:
+            lido_antes = cache['lido']
+            with open(caminho, 'rb') as f:
+                f.seek(cache['lido'])
+                for linha in f:
+                    if not linha.endswith(b'\n'):
+                        # Linha ainda sendo escrita: fica para a próxima leitura
+                        break
+                    cache['lido'] += len(linha)
+                    if not linha.strip():
+                        continue
+                    registro = json.loads(linha)
+                    if cache['base'] is None:
+                        cache['base'] = registro['base']
+                    else:
+                        cache['visitas'].append(registro)
+            metricas.contar_bytes('lidos', cache['lido'] - lido_antes)
+        if cache['base'] is None:
+            return None
+        return cache['base'], cache['visitas']
+
+    def _atualizar(self, travado=False):
+        """
+        Retorna as partes da sequência de visitas ([snapshot, WAL selado,
+        WAL], sem os WALs já incorporados), relendo só o que mudou.
+        Se nenhum arquivo mudou, não toma a trava entre processos.
+        Com `travado`, o chamador já tem a trava exclusiva.
+        """
+        caminhos = (self.arquivo, self.arquivo_selado, self.arquivo_wal)
+        with self._bloqueio:
+            if not travado and self._assinaturas == tuple(
+                    self._assinatura(c) for c in caminhos):
+                return self._partes
+
+        # Ordem de aquisição: trava entre processos -> _bloqueio
+        trava = (trava_entre_processos(self.arquivo, exclusiva=False)
+                 if not travado else nullcontext())
+        with trava, self._bloqueio:
+            assinaturas = tuple(self._assinatura(c) for c in caminhos)
+            if assinaturas[0] != self._assinatura_snapshot:
+                self._snapshot = []
+                if assinaturas[0] is not None:
+                    self._snapshot = SnapshotIndexado.abrir(self.arquivo)
+                    if self._snapshot is None:
+                        # Formato antigo: decodificado até preparar() regravá-lo
+                        with open(self.arquivo, 'r') as f:
+                            self._snapshot = json.load(f)
+                        metricas.contar_bytes('lidos', assinaturas[0][1])
+                self._assinatura_snapshot = assinaturas[0]
+
+            partes = [self._snapshot]
+            total = len(self._snapshot)
+            for caminho in (self.arquivo_selado, self.arquivo_wal):
+                segmento = self._ler_segmento(caminho)
+                if segmento is None:
+                    continue
+                base, visitas = segmento
+                if base < total:
+                    # Já incorporado ao snapshot
+                    continue
+                partes.append(visitas)
+                total += len(visitas)
+
+            self._partes = partes
+            self._assinaturas = assinaturas
+            return partes
+
+    def gravar(self, novas, desde=None):
+        linhas = [serializar_visita(v).encode() for v in novas]
+        with trava_entre_processos(self.arquivo):
+            partes = self._atualizar(travado=True)
+            total = sum(len(parte) for parte in partes)
+            alheias = []
+            if desde is not None:
+                alheias = [(posicao, visita) for posicao, _, visita
+                           in self._ler(partes, desde)]
+            with open(self.arquivo_wal, 'ab') as f:
+                if f.seek(0, os.SEEK_END) == 0:
+                    linhas.insert(0, serializar_visita({'base': total}).encode())
+                metricas.contar_bytes('gravados', f.write(b''.join(linhas)))
+            tamanho_wal = len(partes[-1]) if len(partes) > 1 else 0
+        if tamanho_wal + len(novas) >= config.WAL_COMPACTAR_A_CADA:
+            self._talvez_compactar()
+        return list(range(total, total + len(novas))), alheias, total + len(novas)
+
+    def _talvez_compactar(self):
+        """Inicia a compactação em segundo plano se o WAL passou do limite."""
+        partes = self._atualizar()
+        if len(partes) == 1 or len(partes[-1]) < config.WAL_COMPACTAR_A_CADA:
+            if not os.path.exists(self.arquivo_selado):
+                return
+        with self._bloqueio:
+            if self._compactacao is not None and self._compactacao.is_alive():
+                return
+            self._compactacao = Thread(target=self.compactar, daemon=True)
+            self._compactacao.start()
+
+    def compactar(self):
+        """
+        Incorpora o WAL ao snapshot (passos descritos na classe).
+        Compactações de processos diferentes são serializadas por uma
+        trava própria, separada da trava das gravações.
+        """
+        with trava_entre_processos(self.arquivo + '.compactacao'):
+            with trava_entre_processos(self.arquivo):
+                if not os.path.exists(self.arquivo_selado):
+                    if len(self._atualizar(travado=True)) == 1:
+                        return
+                    os.rename(self.arquivo_wal, self.arquivo_selado)
+                self._atualizar(travado=True)
+                with self._bloqueio:
+                    snapshot = self._snapshot
+                    segmento = self._ler_segmento(self.arquivo_selado)
+                if segmento is None or segmento[0] < len(snapshot):
+                    # WAL selado vazio ou já incorporado
+                    os.remove(self.arquivo_selado)
+                    return
+                visitas = list(segmento[1])
+
+            # Snapshot e WAL selado não mudam mais: escreve sem trava,
+            # copiando o JSON das visitas do snapshot sem decodificá-lo
+            temporario = self._escrever_snapshot(chain(
+                linhas_da_parte(snapshot), linhas_da_parte(visitas)))
+
+            with trava_entre_processos(self.arquivo):
+                os.replace(temporario, self.arquivo)
+                os.remove(self.arquivo_selado)
+                self._esquecer_snapshot()
+
+    def _escrever_snapshot(self, linhas):
+        """
+        Escreve (com fsync) um snapshot temporário, uma visita por linha,
+        a partir do JSON (bytes) de cada visita, e retorna o caminho.
+        """
+        temporario = f'{self.arquivo}.{os.getpid()}.tmp'
+        with open(temporario, 'wb') as f:
+            f.write(b'[')
+            for i, linha in enumerate(linhas):
+                if i:
+                    f.write(b',\n')
+                f.write(linha)
+            f.write(b']\n')
+            metricas.contar_bytes('gravados', f.tell())
+            f.flush()
+            os.fsync(f.fileno())
+        return temporario
+
+    def _esquecer_snapshot(self):
+        """Faz a próxima leitura reindexar o snapshot que acabou de ser substituído."""
+        with self._bloqueio:
+            self._snapshot = []
+            self._assinatura_snapshot = None
+            self._segmentos = {}
+            self._assinaturas = None
+
+    def descartar_anteriores(self, corte):
+        """
+        Reescreve o snapshot só com as visitas a partir de `corte`:
+        1. o novo snapshot é escrito e renomeado para '.retencao';
+        2. os WALs (já incluídos nele) são apagados;
+        3. '.retencao' substitui o snapshot.
+        Uma queda depois do passo 1 é concluída por preparar().
+        """
+        with trava_entre_processos(self.arquivo + '.compactacao'):
+            with trava_entre_processos(self.arquivo):
+                partes = self._atualizar(travado=True)
+                descartadas = 0
+
+                def mantidas():
+                    nonlocal descartadas
+                    for _, _, visita in self._ler(partes, 0):
+                        if visita['tempo'] >= corte:
+                            yield json.dumps(visita, separators=(',', ':')).encode()
+                        else:
+                            descartadas += 1
+
+                temporario = self._escrever_snapshot(mantidas())
+                if not descartadas:
+                    os.remove(temporario)
+                    return 0
+                os.replace(temporario, self.arquivo_retencao)
+                self._concluir_retencao()
+                self._esquecer_snapshot()
+        return descartadas
+
+    def _concluir_retencao(self):
+        """Passos 2 e 3 da retenção. Chamada com a trava entre processos."""
+        for caminho in (self.arquivo_selado, self.arquivo_wal):
+            if os.path.exists(caminho):
+                os.remove(caminho)
+        os.replace(self.arquivo_retencao, self.arquivo)
+
+    def _ler(self, partes, cursor):
+        inicio = 0
+        for parte in partes:
+            fim = inicio + len(parte)
+            if cursor < fim:
+                desde = max(cursor, inicio) - inicio
+                visitas = (parte.iterar(desde) if isinstance(parte, SnapshotIndexado)
+                           else islice(parte, desde, None))
+                for posicao, visita in enumerate(visitas, inicio + desde):
+                    yield posicao, posicao + 1, visita
+            inicio = fim
+
+    def ler_desde(self, cursor=0):
+        return self._ler(self._atualizar(), cursor)
+
+    def fim(self):
+        return sum(len(parte) for parte in self._atualizar())
+
+    def obter(self, posicoes):
+        partes = self._atualizar()
+        visitas = []
+        for posicao in posicoes:
+            for parte in partes:
+                if posicao < len(parte):
+                    visitas.append(parte[posicao])
+                    break
+                posicao -= len(parte)
+        return visitas
+
+    def tamanho_em_disco(self):
+        return sum(assinatura[1] for assinatura in (
+            self._assinatura(caminho) for caminho in
+            (self.arquivo, self.arquivo_selado, self.arquivo_wal))
+            if assinatura)
+
+    def fechar(self):
+        if self._compactacao is not None:
+            self._compactacao.join()
+        if isinstance(self._snapshot, SnapshotIndexado):
+            self._snapshot.fechar()
+
+
+class ArmazenamentoJSONL(Armazenamento):
+    """
+    Log somente de anexação no formato JSON Lines (uma visita por linha).
+    Gravar um lote custa uma única escrita no final do arquivo.
+    O cursor é o byte de início da linha, então cada página
+    começa com um seek direto, sem reler o início do log.
+    """
+
+    nome = 'jsonl'
+
+    def __init__(self, arquivo, arquivo_legado=None):
+        self.arquivo = arquivo
+        self.arquivo_legado = arquivo_legado
+
+    def preparar(self):
+        """
+        Prepara o log na inicialização:
+        - se o log ainda não existe, importa o arquivo JSON legado;
+        - se a última linha ficou incompleta, descarta esse trecho
+          para que a próxima visita comece em uma linha nova.
+        Feito sob a trava entre processos, para não cortar a linha
+        que outro processo esteja gravando.
+        """
+        with trava_entre_processos(self.arquivo):
+            if not os.path.exists(self.arquivo):
+                if self.arquivo_legado:
+                    self._importar_legado()
+                return
+
+            truncar_linha_incompleta(self.arquivo)
+
+    def _importar_legado(self):
+        legado = ArmazenamentoJSON(self.arquivo_legado)
+        if legado.fim() == 0:
+            return
+        temporario = self.arquivo + '.tmp'
+        with open(temporario, 'w') as f:
+            for visita in legado.iterar():
+                f.write(serializar_visita(visita))
+        os.replace(temporario, self.arquivo)
+
+    def gravar(self, novas, desde=None):
+        linhas = [serializar_visita(v).encode() for v in novas]
+        with trava_entre_processos(self.arquivo):
+            alheias = []
+            if desde is not None:
+                alheias = [(posicao, visita) for posicao, _, visita
+                           in self.ler_desde(desde)]
+            with open(self.arquivo, 'ab') as f:
+                posicao = f.seek(0, os.SEEK_END)
+                metricas.contar_bytes('gravados', f.write(b''.join(linhas)))
+        posicoes = []
+        for linha in linhas:
+            posicoes.append(posicao)
+            posicao += len(linha)
+        return posicoes, alheias, posicao
+
+    def _posicionar(self, f, cursor):
+        """Posiciona o arquivo no cursor, que deve ser início de linha."""
+        if cursor > 0:
+            f.seek(cursor - 1)
+            if f.read(1) != b'\n':
+                raise CursorInvalido(f"Cursor inválido: {cursor}")
+
+    def ler_desde(self, cursor=0):
+        inicio = cursor
+        try:
+            with open(self.arquivo, 'rb') as f:
+                self._posicionar(f, cursor)
+                for linha in f:
+                    if not linha.endswith(b'\n'):
+                        # Linha ainda sendo escrita: fica para a próxima leitura
+                        return
+                    proxima = cursor + len(linha)
+                    if linha.strip():
+                        yield cursor, proxima, json.loads(linha)
+                    cursor = proxima
+        except FileNotFoundError:
+            return
+        finally:
+            metricas.contar_bytes('lidos', cursor - inicio)
+
+    def fim(self):
+        try:
+            return os.path.getsize(self.arquivo)
+        except FileNotFoundError:
+            return 0
+
+    def obter(self, posicoes):
+        visitas = []
+        lidos = 0
+        with open(self.arquivo, 'rb') as f:
+            for posicao in posicoes:
+                f.seek(posicao)
+                linha = f.readline()
+                lidos += len(linha)
+                visitas.append(json.loads(linha))
+        metricas.contar_bytes('lidos', lidos)
+        return visitas
+
+    def descartar_anteriores(self, corte):
+        """Reescreve o log só com as visitas a partir de `corte`."""
+        removidas = 0
+        temporario = f'{self.arquivo}.{os.getpid()}.tmp'
+        with trava_entre_processos(self.arquivo):
+            try:
+                origem = open(self.arquivo, 'rb')
+            except FileNotFoundError:
+                return 0
+            with origem, open(temporario, 'wb') as destino:
+                for linha in origem:
+                    if not linha.strip():
+                        continue
+                    if json.loads(linha)['tempo'] < corte:
+                        removidas += 1
+                    else:
+                        destino.write(linha)
+                metricas.contar_bytes('gravados', destino.tell())
+                destino.flush()
+                os.fsync(destino.fileno())
+            if removidas:
+                os.replace(temporario, self.arquivo)
+            else:
+                os.remove(temporario)
+        return removidas
+
+    def tamanho_em_disco(self):
+        return self.fim()
+
+
+class ArmazenamentoSQLite(Armazenamento):
+    """
+    Banco SQLite em modo WAL com índice na coluna 'tempo'.
+    Contagens por dia e por intervalo são varreduras de faixa no
+    índice, sem carregar as visitas para o Python. O cursor é o id
+    da visita, então cada página é uma busca pela chave primária.
+    Entre processos, as gravações são serializadas pelo próprio
+    SQLite (BEGIN IMMEDIATE, com espera de até 30 s pela trava).
+    """
+
+    nome = 'sqlite'
+
+    # Visitas lidas por consulta ao percorrer o banco
+    TAMANHO_PAGINA = 1000
+
+    def __init__(self, arquivo):
+        self.arquivo = arquivo
+        self._bloqueio = Lock()
+        self._conexao = None
+
+    def preparar(self):
+        self._conexao = sqlite3.connect(
+            self.arquivo, timeout=30, isolation_level=None,
+            check_same_thread=False)
+        with self._bloqueio:
+            self._conexao.execute('PRAGMA journal_mode=WAL')
+            self._conexao.execute('PRAGMA synchronous=NORMAL')
+            self._conexao.execute(
+                'CREATE TABLE IF NOT EXISTS visitas ('
+                'id INTEGER PRIMARY KEY, '
+                'tempo TEXT NOT NULL, '
+                'ip TEXT, '
+                'user_agent TEXT)')
+            self._conexao.execute(
+                'CREATE INDEX IF NOT EXISTS idx_visitas_tempo '
+                'ON visitas (tempo)')
+
+    def abrir_leitura(self):
+        """Conexão somente leitura (mode=ro), sem criar nem alterar o banco."""
+        uri = 'file:' + urllib.parse.quote(os.path.abspath(self.arquivo)) + '?mode=ro'
+        self._conexao = sqlite3.connect(
+            uri, uri=True, timeout=30, isolation_level=None,
+            check_same_thread=False)
+
+    def carregar(self):
+        with self._bloqueio:
+            linhas = self._conexao.execute(
+                'SELECT tempo, ip, user_agent FROM visitas ORDER BY id'
+            ).fetchall()
+        return [{'tempo': tempo, 'ip': ip, 'user_agent': user_agent}
+                for tempo, ip, user_agent in linhas]
+
+    def _selecionar_desde(self, cursor, limite):
+        linhas = self._conexao.execute(
+            'SELECT id, tempo, ip, user_agent FROM visitas '
+            'WHERE id >= ? ORDER BY id LIMIT ?',
+            (cursor, limite)
+        ).fetchall()
+        metricas.contar_bytes('lidos', tamanho_dos_campos(linhas))
+        return linhas
+
+    def gravar(self, novas, desde=None):
+        posicoes = []
+        alheias = []
+        with self._bloqueio:
+            self._conexao.execute('BEGIN IMMEDIATE')
+            try:
+                if desde is not None:
+                    for id_, tempo, ip, user_agent in self._selecionar_desde(
+                            desde, -1):
+                        alheias.append((id_, {'tempo': tempo, 'ip': ip,
+                                              'user_agent': user_agent}))
+                metricas.contar_bytes('gravados', tamanho_dos_campos(
+                    (v['tempo'], v.get('ip'), v.get('user_agent')) for v in novas))
+                for v in novas:
+                    cursor = self._conexao.execute(
+                        'INSERT INTO visitas (tempo, ip, user_agent) '
+                        'VALUES (?, ?, ?)',
+                        (v['tempo'], v.get('ip'), v.get('user_agent')))
+                    posicoes.append(cursor.lastrowid)
+                self._conexao.execute('COMMIT')
+            except BaseException:
+                self._conexao.execute('ROLLBACK')
+                raise
+        fim = posicoes[-1] + 1 if posicoes else self.fim()
+        return posicoes, alheias, fim
+
+    def ler_desde(self, cursor=0):
+        while True:
+            with self._bloqueio:
+                linhas = self._selecionar_desde(cursor, self.TAMANHO_PAGINA)
+            for id_, tempo, ip, user_agent in linhas:
+                cursor = id_ + 1
+                yield id_, cursor, {'tempo': tempo, 'ip': ip,
+                                    'user_agent': user_agent}
+            if len(linhas) < self.TAMANHO_PAGINA:
+                return
+
+    def fim(self):
+        with self._bloqueio:
+            (maximo,) = self._conexao.execute(
+                'SELECT MAX(id) FROM visitas').fetchone()
+        return maximo + 1 if maximo is not None else 0
+
+    def obter(self, posicoes):
+        posicoes = list(posicoes)
+        por_id = {}
+        with self._bloqueio:
+            # Consulta em blocos para respeitar o limite de parâmetros do SQLite
+            for i in range(0, len(posicoes), 500):
+                bloco = posicoes[i:i + 500]
+                linhas = self._conexao.execute(
+                    'SELECT id, tempo, ip, user_agent FROM visitas '
+                    f'WHERE id IN ({",".join("?" * len(bloco))})',
+                    bloco
+                ).fetchall()
+                metricas.contar_bytes('lidos', tamanho_dos_campos(linhas))
+                for id_, tempo, ip, user_agent in linhas:
+                    por_id[id_] = {'tempo': tempo, 'ip': ip,
+                                   'user_agent': user_agent}
+        return [por_id[posicao] for posicao in posicoes if posicao in por_id]
+
+    def contagem_por_dia(self):
+        with self._bloqueio:
+            linhas = self._conexao.execute(
+                'SELECT substr(tempo, 1, 10) AS dia, COUNT(*) '
+                'FROM visitas GROUP BY dia'
+            ).fetchall()
+        return dict(linhas)
+
+    def descartar_anteriores(self, corte):
+        """Apaga as visitas anteriores a `corte`; os ids das demais não mudam."""
+        with self._bloqueio:
+            cursor = self._conexao.execute(
+                'DELETE FROM visitas WHERE tempo < ?', (corte,))
+        return cursor.rowcount
+
+    def tamanho_em_disco(self):
+        return sum(os.path.getsize(caminho) for caminho in
+                   (self.arquivo, self.arquivo + '-wal')
+                   if os.path.exists(caminho))
+
+    def fechar(self):
+        if self._conexao is not None:
+            with self._bloqueio:
+                self._conexao.close()
+                self._conexao = None
+
+
+class ArmazenamentoBinario(Armazenamento):
+    """
+    Registros binários de largura fixa (32 bytes) em um arquivo somente
+    de anexação:
+    - instante em microssegundos desde 1970-01-01, no mesmo horário
+      local (sem fuso) do campo 'tempo' das visitas;
+    - família do IP (4, 6, ausente ou texto) e o endereço empacotado
+      em 16 bytes;
+    - id do User-Agent em uma tabela de textos internados.
+    A tabela de textos ('.textos') é um arquivo JSON Lines com um texto
+    por linha (o id é o número da linha), lido de forma incremental e
+    mantido em memória. Também guarda os IPs que não são endereços
+    válidos ou que não voltariam idênticos do formato empacotado.
+
+    As leituras usam mmap: contagens por dia, por hora e por intervalo
+    percorrem só os instantes dos registros, sem criar uma visita por
+    registro. O cursor é o número do registro.
+    """
+
+    nome = 'binario'
+
+    # instante, família do IP, (3 bytes de alinhamento), IP, id do User-Agent
+    REGISTRO = struct.Struct('<qB3x16sI')
+    PALAVRAS_POR_REGISTRO = REGISTRO.size // 8
+
+    IP_AUSENTE, IP_TEXTO, IP_V4, IP_V6 = 0, 1, 4, 6
+    SEM_TEXTO = 0xFFFFFFFF
+
+    # Registros decodificados por fatia lida do mmap
+    TAMANHO_BLOCO = 1000
+
+    EPOCA = datetime(1970, 1, 1)
+    MICROSSEGUNDO = timedelta(microseconds=1)
+    MICROSSEGUNDOS_DIA = 24 * 3600 * 10 ** 6
+
+    def __init__(self, arquivo, arquivo_legado=None):
+        self.arquivo = arquivo
+        self.arquivo_textos = arquivo + '.textos'
+        self.arquivo_legado = arquivo_legado
+        # Tabela de textos lida do arquivo (protegida por `_bloqueio`)
+        self._bloqueio = Lock()
+        self._textos = []
+        self._ids = {}
+        self._textos_lidos = 0
+
+    def preparar(self):
+        """
+        Recuperação após uma queda: descarta a linha incompleta no fim
+        da tabela de textos e o registro incompleto no fim do arquivo.
+        Se o arquivo ainda não existe, importa o arquivo JSON legado.
+        """
+        with trava_entre_processos(self.arquivo):
+            if os.path.exists(self.arquivo_textos):
+                truncar_linha_incompleta(self.arquivo_textos)
+            if not os.path.exists(self.arquivo):
+                if self.arquivo_legado:
+                    self._importar_legado()
+            else:
+                tamanho = os.path.getsize(self.arquivo)
+                if tamanho % self.REGISTRO.size:
+                    os.truncate(self.arquivo,
+                                tamanho - tamanho % self.REGISTRO.size)
+            self._atualizar_textos()
+
+    def _importar_legado(self):
+        legado = ArmazenamentoJSON(self.arquivo_legado)
+        if legado.fim() == 0:
+            return
+        self._atualizar_textos()
+        temporario = self.arquivo + '.tmp'
+        with open(temporario, 'wb') as f:
+            lote = []
+            for visita in chain(legado.iterar(), [None]):
+                if visita is not None:
+                    lote.append(visita)
+                if len(lote) >= self.TAMANHO_BLOCO or (visita is None and lote):
+                    registros, linhas = self._codificar(lote)
+                    self._anexar_textos(linhas)
+                    f.write(registros)
+                    lote = []
+        os.replace(temporario, self.arquivo)
+
+    def _atualizar_textos(self):
+        """Lê as linhas da tabela de textos gravadas desde a última leitura."""
+        with self._bloqueio:
+            try:
+                with open(self.arquivo_textos, 'rb') as f:
+                    f.seek(self._textos_lidos)
+                    for linha in f:
+                        if not linha.endswith(b'\n'):
+                            break
+                        texto = json.loads(linha)
+                        self._ids.setdefault(texto, len(self._textos))
+                        self._textos.append(texto)
+                        self._textos_lidos += len(linha)
+                        metricas.contar_bytes('lidos', len(linha))
+            except FileNotFoundError:
+                pass
+
+    def _texto(self, id_):
+        if id_ >= len(self._textos):
+            self._atualizar_textos()
+        return self._textos[id_]
+
+    def _internar(self, texto, linhas):
+        """Id de `texto`, incluindo-o na tabela (e em `linhas`) se for novo."""
+        id_ = self._ids.get(texto)
+        if id_ is None:
+            id_ = self._ids[texto] = len(self._textos)
+            self._textos.append(texto)
+            linhas.append(serializar_visita(texto).encode())
+        return id_
+
+    def _codificar(self, novas):
+        """
+        Codifica visitas em registros. Retorna (registros, linhas novas
+        da tabela de textos); os textos novos já entram na tabela em
+        memória e devem ser gravados antes dos registros.
+        Deve ser chamada com a trava entre processos adquirida.
+        """
+        # Converte tudo antes de internar, para não deixar na tabela em
+        # memória textos de um lote rejeitado
+        convertidas = []
+        for visita in novas:
+            instante = datetime.fromisoformat(visita['tempo'])
+            if instante.tzinfo is not None:
+                instante = instante.astimezone().replace(tzinfo=None)
+            convertidas.append((
+                (instante - self.EPOCA) // self.MICROSSEGUNDO,
+                visita.get('ip'), visita.get('user_agent')))
+
+        registros = []
+        linhas = []
+        with self._bloqueio:
+            for tempo, ip, user_agent in convertidas:
+                familia, endereco = self.IP_AUSENTE, b''
+                if ip is not None:
+                    try:
+                        ip_ = ipaddress.ip_address(ip)
+                    except ValueError:
+                        ip_ = None
+                    if ip_ is not None and str(ip_) == ip:
+                        familia, endereco = ip_.version, ip_.packed
+                    else:
+                        familia = self.IP_TEXTO
+                        endereco = struct.pack('<I', self._internar(ip, linhas))
+                agente = self.SEM_TEXTO if user_agent is None \
+                    else self._internar(user_agent, linhas)
+                registros.append(self.REGISTRO.pack(tempo, familia, endereco, agente))
+        return b''.join(registros), linhas
+
+    def _anexar_textos(self, linhas):
+        if not linhas:
+            return
+        dados = b''.join(linhas)
+        with open(self.arquivo_textos, 'ab') as f:
+            f.write(dados)
+        metricas.contar_bytes('gravados', len(dados))
+        with self._bloqueio:
+            self._textos_lidos += len(dados)
+
+    def _decodificar(self, tempo, familia, endereco, agente):
+        if familia == self.IP_V4:
+            ip = str(ipaddress.IPv4Address(endereco[:4]))
+        elif familia == self.IP_V6:
+            ip = str(ipaddress.IPv6Address(endereco))
+        elif familia == self.IP_TEXTO:
+            ip = self._texto(struct.unpack_from('<I', endereco)[0])
+        else:
+            ip = None
+        return {
+            'tempo': (self.EPOCA + tempo * self.MICROSSEGUNDO).isoformat(),
+            'ip': ip,
+            'user_agent': None if agente == self.SEM_TEXTO else self._texto(agente)
+        }
+
+    def gravar(self, novas, desde=None):
+        with trava_entre_processos(self.arquivo):
+            alheias = []
+            if desde is not None:
+                alheias = [(posicao, visita) for posicao, _, visita
+                           in self.ler_desde(desde)]
+            self._atualizar_textos()
+            registros, linhas = self._codificar(novas)
+            # A tabela primeiro: todo registro visível tem seus textos gravados
+            self._anexar_textos(linhas)
+            with open(self.arquivo, 'ab') as f:
+                inicio = f.seek(0, os.SEEK_END) // self.REGISTRO.size
+                metricas.contar_bytes('gravados', f.write(registros))
+        return list(range(inicio, inicio + len(novas))), alheias, inicio + len(novas)
+
+    @contextmanager
+    def _mapear(self):
+        """
+        Mapeia (somente leitura) os registros completos do arquivo.
+        Fornece (mapa, quantidade de registros); o mapa é None se vazio.
+        """
+        try:
+            f = open(self.arquivo, 'rb')
+        except FileNotFoundError:
+            yield None, 0
+            return
+        with f:
+            total = os.fstat(f.fileno()).st_size // self.REGISTRO.size
+            if total == 0:
+                yield None, 0
+                return
+            with mmap.mmap(f.fileno(), total * self.REGISTRO.size,
+                           access=mmap.ACCESS_READ) as mapa:
+                yield mapa, total
+
+    @contextmanager
+    def _tempos(self):
+        """Vista dos instantes de todos os registros, sem copiar o arquivo."""
+        with self._mapear() as (mapa, total):
+            if mapa is None:
+                yield ()
+                return
+            if sys.byteorder != 'little':
+                # Registros são little-endian: sem a vista direta nesta máquina
+                yield (campos[0] for campos in self.REGISTRO.iter_unpack(mapa))
+            else:
+                with memoryview(mapa) as bruto, bruto.cast('q') as palavras, \
+                        palavras[::self.PALAVRAS_POR_REGISTRO] as tempos:
+                    yield tempos
+            metricas.contar_bytes('lidos', total * 8)
+
+    def ler_desde(self, cursor=0):
+        if cursor < 0:
+            raise CursorInvalido(f"Cursor inválido: {cursor}")
+        with self._mapear() as (mapa, total):
+            tamanho = self.REGISTRO.size
+            for inicio in range(cursor, total, self.TAMANHO_BLOCO):
+                fim = min(total, inicio + self.TAMANHO_BLOCO)
+                bloco = mapa[inicio * tamanho:fim * tamanho]
+                metricas.contar_bytes('lidos', len(bloco))
+                for posicao, campos in enumerate(
+                        self.REGISTRO.iter_unpack(bloco), inicio):
+                    yield posicao, posicao + 1, self._decodificar(*campos)
+
+    def fim(self):
+        try:
+            return os.path.getsize(self.arquivo) // self.REGISTRO.size
+        except FileNotFoundError:
+            return 0
+
+    def obter(self, posicoes):
+        with self._mapear() as (mapa, total):
+            metricas.contar_bytes('lidos', len(posicoes) * self.REGISTRO.size)
+            return [self._decodificar(*self.REGISTRO.unpack_from(
+                mapa, posicao * self.REGISTRO.size)) for posicao in posicoes]
+
+    def _para_microssegundos(self, tempo):
+        return (datetime.fromisoformat(tempo) - self.EPOCA) // self.MICROSSEGUNDO
+
+    def contagem_por_dia(self):
+        with self._tempos() as tempos:
+            por_dia = Counter(tempo // self.MICROSSEGUNDOS_DIA for tempo in tempos)
+        return {(self.EPOCA + timedelta(days=dia)).strftime('%Y-%m-%d'): total
+                for dia, total in sorted(por_dia.items())}
+
+    def descartar_anteriores(self, corte):
+        """
+        Reescreve o arquivo só com os registros a partir de `corte`,
+        copiando os bytes sem decodificar as visitas. A tabela de textos
+        é mantida (os ids dos registros continuam valendo).
+        """
+        corte = self._para_microssegundos(corte)
+        tamanho = self.REGISTRO.size
+        removidas = 0
+        temporario = f'{self.arquivo}.{os.getpid()}.tmp'
+        with trava_entre_processos(self.arquivo):
+            with self._mapear() as (mapa, total), open(temporario, 'wb') as destino:
+                for inicio in range(0, total, self.TAMANHO_BLOCO):
+                    bloco = mapa[inicio * tamanho:min(total, inicio + self.TAMANHO_BLOCO) * tamanho]
+                    mantidos = [bloco[i:i + tamanho] for i in range(0, len(bloco), tamanho)
+                                if struct.unpack_from('<q', bloco, i)[0] >= corte]
+                    removidas += len(bloco) // tamanho - len(mantidos)
+                    destino.write(b''.join(mantidos))
+                metricas.contar_bytes('gravados', destino.tell())
+                destino.flush()
+                os.fsync(destino.fileno())
+            if removidas:
+                os.replace(temporario, self.arquivo)
+            else:
+                os.remove(temporario)
+        return removidas
+
+    def tamanho_em_disco(self):
+        return sum(os.path.getsize(caminho) for caminho in
+                   (self.arquivo, self.arquivo_textos)
+                   if os.path.exists(caminho))
+
+
+def criar_armazenamento(formato, pasta=None, importar_legado=True):
+    """
+    Cria o backend correspondente ao formato configurado
+    ('json', 'jsonl', 'sqlite' ou 'binario'). Com `pasta`, os arquivos
+    ficam nela (com os mesmos nomes), como nos sites de
+    PASTA_SITES; sem ela, nos caminhos configurados. Sem
+    `importar_legado`, um armazenamento novo começa vazio em vez de
+    importar o ARQUIVO_VISITAS legado (ver migrar.py).
+    """
+    def caminho(arquivo):
+        if pasta is None:
+            return arquivo
+        return os.path.join(pasta, os.path.basename(arquivo))
+
+    legado = caminho(config.ARQUIVO_VISITAS) if importar_legado else None
+
+    if formato == 'json':
+        return ArmazenamentoJSON(caminho(config.ARQUIVO_VISITAS))
+    if formato == 'jsonl':
+        return ArmazenamentoJSONL(caminho(config.ARQUIVO_LOG_VISITAS), legado)
+    if formato == 'sqlite':
+        return ArmazenamentoSQLite(caminho(config.ARQUIVO_SQLITE))
+    if formato == 'binario':
+        return ArmazenamentoBinario(caminho(config.ARQUIVO_BINARIO), legado)
+    raise ValueError(f"Formato de armazenamento desconhecido: {formato}")
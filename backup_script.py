@@ -1,82 +1,388 @@
 #!/usr/bin/env python3
 """
 Script para fazer backup dos dados de visitas
+
+Cada backup é um arquivo NDJSON compactado com gzip
+(`visitas_backup_<timestamp>.jsonl.gz`) acompanhado de um arquivo de
+metadados (`visitas_backup_<timestamp>.meta.json`) com a quantidade de
+visitas, o intervalo de tempo, a posição no armazenamento e o SHA-256
+do arquivo compactado.
+
+Cada site tem sua própria cadeia de backups: o site padrão usa os nomes
+acima, e cada site de PASTA_SITES o prefixo `<site>.` (o nome do site
+também fica nos metadados). Sem --site, o backup percorre o site padrão
+e todas as pastas de PASTA_SITES.
+
+O primeiro backup é completo; os seguintes são incrementais e copiam só
+as visitas gravadas depois da posição final do último backup. A cadeia,
+do completo ao mais recente, descompactada e concatenada é um NDJSON com
+todas as visitas, que migrar.py grava no formato configurado (com a API
+parada e o armazenamento atual movido para fora do caminho):
+    zcat $(python backup_script.py cadeia) > restaurar.jsonl
+    python migrar.py --origem restaurar.jsonl
+    zcat $(python backup_script.py cadeia --site loja) > loja.jsonl
+    python migrar.py --origem loja.jsonl --pasta sites/loja
+
+As visitas são lidas pelo backend configurado sem a trava de gravação,
+então o backup pode rodar com a API no ar: ele copia tudo o que estava
+gravado no início da cópia, e as visitas que chegarem depois ficam para
+o próximo backup. O armazenamento é aberto só para leitura
+(abrir_leitura): nada é recuperado, regravado ou compactado.
+
+Com a retenção ligada (RETENCAO_DIAS), cada backup leva também uma cópia
+compactada dos agregados diários (`visitas_backup_<timestamp>.agregados.json.gz`),
+e a retenção espera o backup terminar. Depois de uma retenção as posições
+no armazenamento mudam, então o backup seguinte é completo.
+
+Uso:
+    python backup_script.py            # incremental (completo se não houver backup)
+    python backup_script.py completo   # força um backup completo
+    python backup_script.py list       # lista os backups pelos metadados
+    python backup_script.py cadeia     # arquivos necessários para restaurar
+    python backup_script.py --site loja         # só o site 'loja'
+    python backup_script.py cadeia --site loja  # cadeia do site 'loja'
 """
 
+import argparse
+import gzip
+import hashlib
 import json
-import shutil
-from datetime import datetime
 import os
+from contextlib import nullcontext
+from datetime import datetime
 
+import config
+from armazenamento import (CursorInvalido, criar_armazenamento,
+                           serializar_visita, trava_entre_processos)
+from sites import validar_nome_site
 
-def fazer_backup():
-    """Faz backup do arquivo de visitas"""
-    try:
-        # Nome do arquivo original
-        arquivo_original = 'visitas.json'
+PREFIXO_BACKUP = 'visitas_backup_'
+EXTENSAO_DADOS = '.jsonl.gz'
+EXTENSAO_METADADOS = '.meta.json'
+EXTENSAO_AGREGADOS = '.agregados.json.gz'
+
+
+class ArquivoComHash:
+    """Arquivo de saída que calcula o SHA-256 dos bytes gravados."""
+
+    def __init__(self, arquivo):
+        self.arquivo = arquivo
+        self.hash = hashlib.sha256()
 
-        # Verifica se o arquivo existe
-        if not os.path.exists(arquivo_original):
-            print(" Arquivo visitas.json não encontrado!")
-            return False
+    def write(self, dados):
+        self.hash.update(dados)
+        return self.arquivo.write(dados)
 
-        # Gera nome do backup com timestamp
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        arquivo_backup = f'visitas_backup_{timestamp}.json'
+    def flush(self):
+        self.arquivo.flush()
 
-        # Copia o arquivo
-        shutil.copy2(arquivo_original, arquivo_backup)
 
-        # Verifica o número de visitas
-        with open(arquivo_original, 'r') as f:
-            visitas = json.load(f)
+def listar_sites():
+    """O site padrão (None) e os sites com pasta em PASTA_SITES."""
+    nomes = []
+    if os.path.isdir(config.PASTA_SITES):
+        for nome in sorted(os.listdir(config.PASTA_SITES)):
+            try:
+                validar_nome_site(nome)
+            except ValueError:
+                continue
+            if os.path.isdir(os.path.join(config.PASTA_SITES, nome)):
+                nomes.append(nome)
+    return [None] + nomes
+
+
+def pasta_do_site(site):
+    """Pasta dos arquivos do site (None: caminhos configurados, site padrão)."""
+    return None if site is None else os.path.join(config.PASTA_SITES, site)
+
+
+def arquivo_agregados(site):
+    """Arquivo de agregados da retenção do site, como em RegistroSites."""
+    if site is None:
+        return config.ARQUIVO_AGREGADOS
+    return os.path.join(pasta_do_site(site), os.path.basename(config.ARQUIVO_AGREGADOS))
+
+
+def prefixo_backup(site):
+    """Prefixo dos arquivos de backup do site."""
+    return PREFIXO_BACKUP if site is None else f'{site}.{PREFIXO_BACKUP}'
+
+
+def ler_metadados(pasta='.', site=None):
+    """
+    Lê os metadados dos backups de `site`, do mais antigo ao mais recente.
+    Backups sem metadados (incompletos ou do formato antigo) ficam de fora.
+    """
+    prefixo = prefixo_backup(site)
+    backups = []
+    for nome in sorted(os.listdir(pasta)):
+        if nome.startswith(prefixo) and nome.endswith(EXTENSAO_METADADOS):
+            try:
+                with open(os.path.join(pasta, nome), 'r') as f:
+                    metadados = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"   {nome} (metadados ilegíveis: {e})")
+                continue
+            # Backups anteriores aos sites não têm o campo: são do site padrão
+            if metadados.get('site') == site:
+                backups.append(metadados)
+    return backups
+
+
+def ler_geracao(arquivo):
+    """Geração dos agregados da retenção (0 se nunca foi aplicada)."""
+    try:
+        with open(arquivo, 'r') as f:
+            return json.load(f)['geracao']
+    except FileNotFoundError:
+        return 0
 
-        print(f" Backup criado: {arquivo_backup}")
-        print(f"Total de visitas salvas: {len(visitas)}")
 
+def fazer_backups(completo=False, pasta='.', sites=None):
+    """
+    Faz o backup de cada site de `sites` (padrão: todos, ver
+    listar_sites). Retorna True se todos deram certo.
+    """
+    ok = True
+    for site in listar_sites() if sites is None else sites:
+        if site is not None:
+            print(f" Site {site}:")
+        ok = fazer_backup(completo, pasta, site) and ok
+    return ok
+
+
+def fazer_backup(completo=False, pasta='.', site=None):
+    """
+    Faz backup das visitas de `site` (None: o padrão) gravadas desde o
+    último backup (ou de todas, com `completo` ou quando não há backup
+    anterior do mesmo formato).
+    """
+    formato = config.FORMATO_ARMAZENAMENTO
+    armazenamento = criar_armazenamento(formato, pasta_do_site(site))
+    agregados = arquivo_agregados(site)
+    if armazenamento.tamanho_em_disco() == 0:
+        print(f" Nenhuma visita no formato '{formato}'")
         return True
+    # Compartilhada: as gravações seguem, mas a retenção não reescreve o
+    # armazenamento no meio da cópia
+    retencao = nullcontext()
+    if config.RETENCAO_DIAS:
+        retencao = trava_entre_processos(agregados, exclusiva=False)
+    try:
+        armazenamento.abrir_leitura()
+        with retencao:
+            geracao = ler_geracao(agregados)
+
+            anterior = None
+            if not completo:
+                anteriores = [b for b in ler_metadados(pasta, site)
+                              if b['formato'] == formato]
+                if anteriores:
+                    anterior = anteriores[-1]
+            if anterior and anterior.get('geracao', 0) != geracao:
+                print(" A retenção foi aplicada desde o último backup; fazendo backup completo")
+                anterior = None
+
+            # Fim do armazenamento no início da cópia: o backup para aqui
+            fim = armazenamento.fim()
+            inicio = anterior['cursor_fim'] if anterior else 0
+            if anterior and inicio > fim:
+                print(" O armazenamento encolheu desde o último backup; fazendo backup completo")
+                anterior, inicio = None, 0
+            if anterior and inicio == fim:
+                print(f" Nenhuma visita nova desde {anterior['arquivo']}")
+                return True
+
+            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_%f')
+            prefixo = prefixo_backup(site)
+            arquivo_backup = f'{prefixo}{timestamp}{EXTENSAO_DADOS}'
+            caminho = os.path.join(pasta, arquivo_backup)
+            temporario = caminho + '.tmp'
+
+            try:
+                quantidade, primeira, ultima, cursor, tamanho, checksum = copiar_visitas(
+                    armazenamento, inicio, fim, temporario)
+            except CursorInvalido:
+                os.remove(temporario)
+                print(" Posição do último backup inválida; fazendo backup completo")
+                anterior, inicio = None, 0
+                quantidade, primeira, ultima, cursor, tamanho, checksum = copiar_visitas(
+                    armazenamento, inicio, fim, temporario)
+            os.replace(temporario, caminho)
+
+            copia_agregados = None
+            if os.path.exists(agregados):
+                copia_agregados = f'{prefixo}{timestamp}{EXTENSAO_AGREGADOS}'
+                copiar_agregados(agregados, os.path.join(pasta, copia_agregados))
+
+            metadados = {
+                'arquivo': arquivo_backup,
+                'site': site,
+                'criado_em': datetime.now().isoformat(),
+                'formato': formato,
+                'tipo': 'incremental' if anterior else 'completo',
+                'base': anterior['arquivo'] if anterior else None,
+                'cursor_inicio': inicio,
+                'cursor_fim': cursor,
+                'visitas': quantidade,
+                'primeira_visita': primeira,
+                'ultima_visita': ultima,
+                'tamanho': tamanho,
+                'sha256': checksum,
+                'geracao': geracao,
+                'agregados': copia_agregados
+            }
+            # Os metadados são gravados por último: sem eles o backup não conta
+            arquivo_metadados = os.path.join(
+                pasta, f'{prefixo}{timestamp}{EXTENSAO_METADADOS}')
+            with open(arquivo_metadados + '.tmp', 'w') as f:
+                json.dump(metadados, f, indent=2, ensure_ascii=False)
+            os.replace(arquivo_metadados + '.tmp', arquivo_metadados)
+
+            print(f" Backup {metadados['tipo']} criado: {arquivo_backup}")
+            print(f"Total de visitas salvas: {quantidade} ({tamanho} bytes)")
+
+            return True
 
     except Exception as e:
         print(f" Erro ao fazer backup: {e}")
         return False
 
+    finally:
+        armazenamento.fechar()
+
+
+def copiar_visitas(armazenamento, inicio, fim, destino):
+    """
+    Grava em `destino` (NDJSON + gzip) as visitas de `inicio` até `fim`.
+    Retorna (quantidade, primeira, última, cursor final, tamanho, sha256).
+    """
+    quantidade = 0
+    primeira = ultima = None
+    cursor = inicio
+    with open(destino, 'wb') as bruto:
+        saida = ArquivoComHash(bruto)
+        with gzip.GzipFile(fileobj=saida, mode='wb') as compactado:
+            bloco = []
+            for posicao, proxima, visita in armazenamento.ler_desde(inicio):
+                if posicao >= fim:
+                    break
+                bloco.append(serializar_visita(visita))
+                if len(bloco) >= 1000:
+                    compactado.write(''.join(bloco).encode())
+                    bloco = []
+                if primeira is None:
+                    primeira = visita['tempo']
+                ultima = visita['tempo']
+                quantidade += 1
+                cursor = proxima
+            if bloco:
+                compactado.write(''.join(bloco).encode())
+        bruto.flush()
+        os.fsync(bruto.fileno())
+        tamanho = bruto.tell()
+    return quantidade, primeira, ultima, cursor, tamanho, saida.hash.hexdigest()
+
+
+def copiar_agregados(arquivo, destino):
+    """Grava em `destino` uma cópia compactada do arquivo de agregados."""
+    with open(arquivo, 'rb') as origem, \
+            gzip.open(destino + '.tmp', 'wb') as compactado:
+        compactado.write(origem.read())
+    os.replace(destino + '.tmp', destino)
+
+
+def cadeia_de_restauracao(pasta='.', site=None):
+    """
+    Retorna os arquivos do último backup completo até o mais recente do
+    formato configurado, de `site`, na ordem em que devem ser concatenados.
+    """
+    backups = [b for b in ler_metadados(pasta, site)
+               if b['formato'] == config.FORMATO_ARMAZENAMENTO]
+    cadeia = []
+    for backup in reversed(backups):
+        if cadeia and backup['arquivo'] != cadeia[-1]['base']:
+            continue
+        cadeia.append(backup)
+        if backup['tipo'] == 'completo':
+            break
+    return [backup['arquivo'] for backup in reversed(cadeia)]
+
+
+def sites_com_backup(pasta='.'):
+    """O site padrão (None) e os sites que têm backups em `pasta`."""
+    nomes = set()
+    for nome in os.listdir(pasta):
+        site, separador, resto = nome.partition('.')
+        if separador and resto.startswith(PREFIXO_BACKUP) and \
+                resto.endswith(EXTENSAO_METADADOS):
+            nomes.add(site)
+    return [None] + sorted(nomes)
+
+
+def listar_backups(pasta='.', sites=None):
+    """
+    Lista os backups disponíveis de cada site de `sites` (padrão: todos
+    os que têm backups), lendo só os metadados.
+    """
+    for site in sites_com_backup(pasta) if sites is None else sites:
+        if site is not None:
+            print(f"\n Site {site}:")
+        listar_backups_do_site(pasta, site)
+
 
-def listar_backups():
-    """Lista todos os backups disponíveis"""
-    backups = [f for f in os.listdir('.') if f.startswith(
-        'visitas_backup_') and f.endswith('.json')]
+def listar_backups_do_site(pasta='.', site=None):
+    """Lista os backups de `site` (None: o padrão), lendo só os metadados"""
+    backups = ler_metadados(pasta, site)
+    antigos = []
+    if site is None:
+        antigos = [f for f in os.listdir(pasta) if f.startswith(
+            PREFIXO_BACKUP) and f.endswith('.json') and not f.endswith(EXTENSAO_METADADOS)]
 
-    if not backups:
+    if not backups and not antigos:
         print(" Nenhum backup encontrado")
         return
 
-    print(f"Backups encontrados ({len(backups)}):")
-    backups.sort(reverse=True)  # Mais recente primeiro
+    print(f"Backups encontrados ({len(backups) + len(antigos)}):")
 
-    for backup in backups:
-        try:
-            # Pega informações do arquivo
-            stat = os.stat(backup)
-            tamanho = stat.st_size
-            modificado = datetime.fromtimestamp(stat.st_mtime)
+    for backup in reversed(backups):  # Mais recente primeiro
+        criado = datetime.fromisoformat(backup['criado_em'])
+        print(f"   {backup['arquivo']} ({backup['tipo']}, {backup['formato']})")
+        print(f"       {criado.strftime('%d/%m/%Y %H:%M:%S')}")
+        print(f"      {backup['visitas']} visitas ({backup['tamanho']} bytes)")
+        if backup['visitas']:
+            print(f"      de {backup['primeira_visita']} a {backup['ultima_visita']}")
+        print()
 
-            # Conta visitas no backup
-            with open(backup, 'r') as f:
-                visitas = json.load(f)
+    # Backups do formato antigo (cópias de visitas.json, sem metadados)
+    for backup in sorted(antigos, reverse=True):
+        stat = os.stat(os.path.join(pasta, backup))
+        modificado = datetime.fromtimestamp(stat.st_mtime)
+        print(f"   {backup} (formato antigo, sem metadados)")
+        print(f"       {modificado.strftime('%d/%m/%Y %H:%M:%S')}")
+        print(f"      {stat.st_size} bytes")
+        print()
 
-            print(f"   {backup}")
-            print(f"       {modificado.strftime('%d/%m/%Y %H:%M:%S')}")
-            print(f"      {len(visitas)} visitas ({tamanho} bytes)")
-            print()
 
-        except Exception as e:
-            print(f"   {backup} (erro: {e})")
+def ler_argumentos(argumentos=None):
+    parser = argparse.ArgumentParser(
+        description='Backup das visitas de cada site em NDJSON + gzip')
+    parser.add_argument('comando', nargs='?', choices=['completo', 'list', 'cadeia'],
+                        help='completo, list ou cadeia (padrão: backup incremental)')
+    parser.add_argument('--site', type=validar_nome_site,
+                        help='só este site de PASTA_SITES (padrão: todos; '
+                             'em cadeia, o site padrão)')
+    return parser.parse_args(argumentos)
 
 
 if __name__ == '__main__':
     import sys
 
-    if len(sys.argv) > 1 and sys.argv[1] == 'list':
-        listar_backups()
+    args = ler_argumentos()
+    sites = [args.site] if args.site else None
+    if args.comando == 'list':
+        listar_backups(sites=sites)
+    elif args.comando == 'cadeia':
+        print(' '.join(cadeia_de_restauracao(site=args.site)))
     else:
-        fazer_backup()
+        sys.exit(0 if fazer_backups(args.comando == 'completo', sites=sites) else 1)
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+"""
+Benchmark da API do Contador de Visitas
+
+Mede vazão e latência (p50/p95/p99) por endpoint com vários
+trabalhadores simultâneos e uma proporção configurável de escritas.
+Dois modos:
+- 'teste': cada cenário (formato de armazenamento x tamanho do
+  histórico) roda em um processo próprio, com o cliente de testes do
+  Flask e um histórico semeado em uma pasta temporária;
+- 'servidor': as requisições vão para uma API já rodando (--url).
+
+O resultado é um JSON, para comparar formatos e detectar regressões.
+
+Exemplos:
+    python benchmark.py
+    python benchmark.py --formatos jsonl,sqlite --historicos 1000,100000
+    python benchmark.py --modo servidor --url http://localhost:5000
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+# Endpoints de leitura sorteados pelos trabalhadores
+ENDPOINTS_LEITURA = [
+    ('GET', '/api/visitas/total'),
+    ('GET', '/api/visitas/hoje'),
+    ('GET', '/api/status'),
+    ('GET', '/api/visitas/historico?granularidade=dia&dias=30'),
+    ('GET', '/api/visitas/unicos?periodo=mes'),
+    ('GET', '/api/visitas/intervalo?de={hoje}'),
+    ('GET', '/api/visitas/todas?limite=100'),
+]
+
+ENDPOINT_ESCRITA = ('POST', '/api/visitas/registrar')
+
+# Visitas gravadas por chamada ao semear o histórico
+TAMANHO_LOTE_SEMENTE = 50000
+
+
+def percentil(valores_ordenados, p):
+    """Percentil `p` (0-100) pelo método do posto mais próximo."""
+    if not valores_ordenados:
+        return None
+    posto = max(1, round(p / 100 * len(valores_ordenados)))
+    return valores_ordenados[min(posto, len(valores_ordenados)) - 1]
+
+
+def resumir(latencias, erros, duracao):
+    """Resume as latências (em segundos) de um endpoint."""
+    ordenadas = sorted(latencias)
+    return {
+        'requisicoes': len(ordenadas),
+        'erros': erros,
+        'vazao_rps': round(len(ordenadas) / duracao, 1) if duracao else None,
+        'media_ms': round(sum(ordenadas) / len(ordenadas) * 1000, 3) if ordenadas else None,
+        'p50_ms': round(percentil(ordenadas, 50) * 1000, 3) if ordenadas else None,
+        'p95_ms': round(percentil(ordenadas, 95) * 1000, 3) if ordenadas else None,
+        'p99_ms': round(percentil(ordenadas, 99) * 1000, 3) if ordenadas else None,
+    }
+
+
+def executar_carga(criar_cliente, trabalhadores, requisicoes, proporcao_escrita,
+                   semente):
+    """
+    Dispara `requisicoes` requisições divididas entre `trabalhadores`
+    threads. `criar_cliente()` retorna uma função (metodo, caminho) ->
+    status HTTP, uma por thread. Retorna a duração e o resumo por endpoint.
+    """
+    hoje = datetime.now().strftime('%Y-%m-%d')
+    latencias = {}
+    erros = {}
+    bloqueio = threading.Lock()
+    largada = threading.Barrier(trabalhadores + 1)
+
+    def trabalhador(numero, quantidade):
+        sorteio = random.Random(semente + numero)
+        requisitar = criar_cliente()
+        minhas_latencias = {}
+        meus_erros = {}
+        largada.wait()
+        for _ in range(quantidade):
+            if sorteio.random() < proporcao_escrita:
+                metodo, caminho = ENDPOINT_ESCRITA
+            else:
+                metodo, caminho = sorteio.choice(ENDPOINTS_LEITURA)
+            nome = f"{metodo} {caminho.split('?')[0]}"
+            inicio = time.perf_counter()
+            try:
+                status = requisitar(metodo, caminho.format(hoje=hoje))
+            except Exception:
+                status = None
+            duracao = time.perf_counter() - inicio
+            minhas_latencias.setdefault(nome, []).append(duracao)
+            if status != 200:
+                meus_erros[nome] = meus_erros.get(nome, 0) + 1
+        with bloqueio:
+            for nome, valores in minhas_latencias.items():
+                latencias.setdefault(nome, []).extend(valores)
+            for nome, quantidade_erros in meus_erros.items():
+                erros[nome] = erros.get(nome, 0) + quantidade_erros
+
+    por_trabalhador = [requisicoes // trabalhadores] * trabalhadores
+    for i in range(requisicoes % trabalhadores):
+        por_trabalhador[i] += 1
+    threads = [threading.Thread(target=trabalhador, args=(i, quantidade))
+               for i, quantidade in enumerate(por_trabalhador)]
+    for thread in threads:
+        thread.start()
+    largada.wait()
+    inicio = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    duracao = time.perf_counter() - inicio
+
+    todas = [valor for valores in latencias.values() for valor in valores]
+    return {
+        'duracao_segundos': round(duracao, 3),
+        'geral': resumir(todas, sum(erros.values()), duracao),
+        'endpoints': {
+            nome: resumir(valores, erros.get(nome, 0), duracao)
+            for nome, valores in sorted(latencias.items())
+        }
+    }
+
+
+def semear_historico(formato, quantidade, semente, dias=30):
+    """
+    Grava `quantidade` visitas sintéticas, em ordem de tempo, espalhadas
+    pelos últimos `dias` dias, direto no armazenamento do diretório atual.
+    """
+    from armazenamento import criar_armazenamento
+
+    sorteio = random.Random(semente)
+    armazenamento = criar_armazenamento(formato)
+    armazenamento.preparar()
+    inicio = datetime.now() - timedelta(days=dias)
+    passo = timedelta(days=dias) / max(quantidade, 1)
+    agentes = [f'Mozilla/5.0 (bench {i})' for i in range(50)]
+
+    gravadas = 0
+    while gravadas < quantidade:
+        lote = []
+        for i in range(gravadas, min(quantidade, gravadas + TAMANHO_LOTE_SEMENTE)):
+            lote.append({
+                'tempo': (inicio + passo * i).isoformat(),
+                'ip': f'10.{sorteio.randrange(256)}.{sorteio.randrange(256)}.{sorteio.randrange(256)}',
+                'user_agent': sorteio.choice(agentes)
+            })
+        armazenamento.gravar(lote)
+        gravadas += len(lote)
+    if hasattr(armazenamento, 'compactar'):
+        armazenamento.fechar()
+        armazenamento.compactar()
+    armazenamento.fechar()
+
+
+def executar_cenario(formato, historico, trabalhadores, requisicoes,
+                     proporcao_escrita, semente):
+    """
+    Processo filho do modo 'teste': semeia o histórico em uma pasta
+    temporária, importa a API (medindo o tempo de carga) e executa a
+    carga com o cliente de testes do Flask.
+    """
+    diretorio_original = os.getcwd()
+    with tempfile.TemporaryDirectory() as pasta:
+        os.chdir(pasta)
+        os.environ['FORMATO_ARMAZENAMENTO'] = formato
+
+        inicio = time.perf_counter()
+        semear_historico(formato, historico, semente)
+        semeadura = time.perf_counter() - inicio
+
+        inicio = time.perf_counter()
+        import app
+        # O site padrão carrega em segundo plano: espera ele ficar pronto
+        app.sites.obter()
+        carga = time.perf_counter() - inicio
+
+        def criar_cliente():
+            cliente = app.app.test_client()
+            return lambda metodo, caminho: cliente.open(
+                caminho, method=metodo).status_code
+
+        resultado = executar_carga(criar_cliente, trabalhadores, requisicoes,
+                                   proporcao_escrita, semente)
+        app.sites.fechar_todos()
+        os.chdir(diretorio_original)
+
+    return dict({
+        'formato': formato,
+        'historico': historico,
+        'semeadura_segundos': round(semeadura, 3),
+        'carga_segundos': round(carga, 3),
+    }, **resultado)
+
+
+def executar_servidor(url, trabalhadores, requisicoes, proporcao_escrita,
+                      semente):
+    """Modo 'servidor': executa a carga contra uma API já rodando."""
+    import requests
+
+    def criar_cliente():
+        sessao = requests.Session()
+        return lambda metodo, caminho: sessao.request(
+            metodo, url + caminho).status_code
+
+    resultado = executar_carga(criar_cliente, trabalhadores, requisicoes,
+                               proporcao_escrita, semente)
+    return dict({'url': url}, **resultado)
+
+
+def ler_argumentos(argumentos=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark da API do Contador de Visitas')
+    parser.add_argument('--modo', choices=['teste', 'servidor'], default='teste',
+                        help="'teste' (cliente do Flask, em processo) ou 'servidor' (API rodando)")
+    parser.add_argument('--url', default='http://localhost:5000',
+                        help='URL da API no modo servidor')
+    parser.add_argument('--formatos', default='json,jsonl,sqlite,binario',
+                        help='formatos de armazenamento comparados no modo teste')
+    parser.add_argument('--historicos', default='1000,100000,1000000',
+                        help='tamanhos do histórico semeado no modo teste')
+    parser.add_argument('--trabalhadores', type=int, default=8,
+                        help='threads enviando requisições ao mesmo tempo')
+    parser.add_argument('--requisicoes', type=int, default=2000,
+                        help='requisições por cenário')
+    parser.add_argument('--proporcao-escrita', type=float, default=0.1,
+                        help='fração das requisições que registram visitas (0 a 1)')
+    parser.add_argument('--semente', type=int, default=42,
+                        help='semente dos sorteios (histórico e mistura de requisições)')
+    parser.add_argument('--saida', help='grava o JSON neste arquivo (padrão: stdout)')
+    return parser.parse_args(argumentos)
+
+
+def main(argumentos=None):
+    args = ler_argumentos(argumentos)
+    resultado = {
+        'meta': {
+            'data': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'plataforma': platform.platform(),
+            'modo': args.modo,
+            'trabalhadores': args.trabalhadores,
+            'requisicoes': args.requisicoes,
+            'proporcao_escrita': args.proporcao_escrita,
+            'semente': args.semente,
+        },
+        'cenarios': []
+    }
+
+    if args.modo == 'servidor':
+        resultado['cenarios'].append(executar_servidor(
+            args.url.rstrip('/'), args.trabalhadores, args.requisicoes,
+            args.proporcao_escrita, args.semente))
+    else:
+        # Um processo novo por cenário: a configuração é lida na importação
+        contexto = multiprocessing.get_context('spawn')
+        for formato in args.formatos.split(','):
+            for historico in (int(h) for h in args.historicos.split(',')):
+                print(f" Cenário {formato} / {historico} visitas...", file=sys.stderr)
+                with contexto.Pool(1) as pool:
+                    resultado['cenarios'].append(pool.apply(executar_cenario, (
+                        formato, historico, args.trabalhadores, args.requisicoes,
+                        args.proporcao_escrita, args.semente)))
+
+    saida = json.dumps(resultado, indent=2, ensure_ascii=False)
+    if args.saida:
+        with open(args.saida, 'w') as f:
+            f.write(saida + '\n')
+        print(f" Resultado gravado em {args.saida}", file=sys.stderr)
+    else:
+        print(saida)
+    return resultado
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+Checkpoint do estado em memória de um site
+
+Guarda o que a inicialização montaria lendo todo o armazenamento
+(total e visitas por dia, visitas por hora, mais frequentes e o índice
+temporal) junto com o cursor até onde esse estado vale. Ao iniciar, o
+site carrega o checkpoint e só relê as visitas gravadas depois do
+cursor (ver Site._montar_estado).
+
+Formato: uma linha JSON com o cabeçalho e, em seguida, os dois arrays
+do índice temporal em binário (instantes 'd' e posições 'q'), na ordem
+de bytes da máquina que os gravou, registrada no cabeçalho.
+"""
+
+import json
+import os
+import sys
+from array import array
+
+# Muda quando o formato do arquivo muda: checkpoints antigos são ignorados
+VERSAO = 1
+
+
+def salvar_checkpoint(arquivo, cabecalho, tempos, posicoes):
+    """
+    Grava o checkpoint (via arquivo temporário e troca atômica).
+    Retorna o tamanho do arquivo em bytes.
+    """
+    cabecalho = dict(cabecalho, versao=VERSAO, ordem_bytes=sys.byteorder,
+                     tamanho_indice=len(tempos))
+    temporario = f'{arquivo}.{os.getpid()}.tmp'
+    with open(temporario, 'wb') as f:
+        f.write(json.dumps(cabecalho, ensure_ascii=False).encode() + b'\n')
+        tempos.tofile(f)
+        posicoes.tofile(f)
+        f.flush()
+        os.fsync(f.fileno())
+        tamanho = f.tell()
+    os.replace(temporario, arquivo)
+    return tamanho
+
+
+def carregar_checkpoint(arquivo):
+    """
+    Lê o checkpoint. Retorna (cabeçalho, tempos, posições), ou None se
+    não houver arquivo ou se ele for de outra versão, de outra ordem de
+    bytes ou estiver incompleto.
+    """
+    try:
+        f = open(arquivo, 'rb')
+    except FileNotFoundError:
+        return None
+    with f:
+        try:
+            cabecalho = json.loads(f.readline())
+        except ValueError:
+            return None
+        if cabecalho.get('versao') != VERSAO or \
+                cabecalho.get('ordem_bytes') != sys.byteorder:
+            return None
+        tempos = array('d')
+        posicoes = array('q')
+        try:
+            tempos.fromfile(f, cabecalho['tamanho_indice'])
+            posicoes.fromfile(f, cabecalho['tamanho_indice'])
+        except EOFError:
+            return None
+    return cabecalho, tempos, posicoes
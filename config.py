@@ -6,6 +6,46 @@ import os
 
 # Configurações do arquivo de dados
 ARQUIVO_VISITAS = os.getenv('ARQUIVO_VISITAS', 'visitas.json')
+ARQUIVO_LOG_VISITAS = os.getenv('ARQUIVO_LOG_VISITAS', 'visitas.jsonl')
+ARQUIVO_SQLITE = os.getenv('ARQUIVO_SQLITE', 'visitas.db')
+ARQUIVO_BINARIO = os.getenv('ARQUIVO_BINARIO', 'visitas.bin')
+ARQUIVO_UNICOS = os.getenv('ARQUIVO_UNICOS', 'visitas_unicos.json')
+ARQUIVO_AGREGADOS = os.getenv('ARQUIVO_AGREGADOS', 'visitas_agregados.json')
+ARQUIVO_CHECKPOINT = os.getenv('ARQUIVO_CHECKPOINT', 'visitas_checkpoint.bin')
+
+# Formato de armazenamento das visitas:
+# 'json'   - snapshot em ARQUIVO_VISITAS + WAL (ARQUIVO_VISITAS.wal) com as
+#            visitas recentes, incorporado ao snapshot em segundo plano
+# 'jsonl'  - log somente de anexação em ARQUIVO_LOG_VISITAS (uma visita por linha)
+# 'sqlite' - banco SQLite em ARQUIVO_SQLITE (modo WAL, índice por tempo)
+# 'binario' - registros de 32 bytes em ARQUIVO_BINARIO + tabela de textos
+#            (User-Agents) em ARQUIVO_BINARIO.textos, lidos via mmap
+FORMATO_ARMAZENAMENTO = os.getenv('FORMATO_ARMAZENAMENTO', 'json')
+
+# Tamanho (em visitas) do WAL do formato 'json' que dispara a compactação
+WAL_COMPACTAR_A_CADA = int(os.getenv('WAL_COMPACTAR_A_CADA', 10000))
+
+# Durabilidade do registro de visitas:
+# 'imediata' - cada visita é gravada no arquivo antes da resposta
+# 'lote'     - visitas vão para uma fila em memória e são gravadas em lotes
+#              por uma thread em segundo plano (pode perder até um lote em falha)
+DURABILIDADE = os.getenv('DURABILIDADE', 'imediata')
+LOTE_TAMANHO_MAXIMO = int(os.getenv('LOTE_TAMANHO_MAXIMO', 500))
+LOTE_INTERVALO_SEGUNDOS = float(os.getenv('LOTE_INTERVALO_SEGUNDOS', 1.0))
+
+# Vários sites em uma mesma instância (/api/sites/<site>/...):
+# cada site guarda suas visitas em PASTA_SITES/<site>/, com os mesmos
+# nomes de arquivo acima. Sites sem acesso há SITES_OCIOSIDADE_SEGUNDOS
+# são descarregados da memória (verificação a cada SITES_VERIFICACAO_SEGUNDOS)
+PASTA_SITES = os.getenv('PASTA_SITES', 'sites')
+SITES_OCIOSIDADE_SEGUNDOS = float(os.getenv('SITES_OCIOSIDADE_SEGUNDOS', 600))
+SITES_VERIFICACAO_SEGUNDOS = float(os.getenv('SITES_VERIFICACAO_SEGUNDOS', 60))
+
+# Com vários processos (workers) no mesmo armazenamento, a cada
+# SINCRONIZACAO_INTERVALO_SEGUNDOS a thread de manutenção aplica as visitas
+# gravadas pelos outros: total, hoje e /api/status (lidos sem trava) ficam
+# no máximo esse tempo atrás dos outros processos (0 desliga)
+SINCRONIZACAO_INTERVALO_SEGUNDOS = float(os.getenv('SINCRONIZACAO_INTERVALO_SEGUNDOS', 1.0))
 
 # Configurações do servidor
 HOST = os.getenv('HOST', '0.0.0.0')
@@ -20,6 +60,58 @@ API_DESCRIPTION = 'API para contagem e registro de visitas'
 # Configurações de formato padrão
 FORMATO_PADRAO = os.getenv('FORMATO_PADRAO', 'real')  # 'real' ou 'compacto'
 
+# Cache das respostas de /api/visitas/total e /api/visitas/hoje:
+# por quantos segundos uma resposta pronta é reaproveitada, por formato
+# (0 desliga o cache no servidor; o ETag/304 funciona sempre)
+CACHE_TTL_SEGUNDOS = {
+    'real': float(os.getenv('CACHE_TTL_REAL', 0)),
+    'compacto': float(os.getenv('CACHE_TTL_COMPACTO', 0)),
+}
+
+# Deduplicação: o mesmo par (IP, User-Agent) registrado de novo dentro de
+# DEDUP_JANELA_SEGUNDOS é contado uma vez (0 desliga); no máximo
+# DEDUP_MAXIMO_PARES pares ficam em memória por site
+DEDUP_JANELA_SEGUNDOS = float(os.getenv('DEDUP_JANELA_SEGUNDOS', 0))
+DEDUP_MAXIMO_PARES = int(os.getenv('DEDUP_MAXIMO_PARES', 100000))
+
+# Retenção: visitas com mais de RETENCAO_DIAS dias (contados a partir do
+# início do dia atual) saem do armazenamento e ficam só como agregados
+# diários em ARQUIVO_AGREGADOS: total, visitas por hora, esboço de únicos e
+# os RETENCAO_TOP_USER_AGENTS User-Agents mais frequentes (0 desliga)
+RETENCAO_DIAS = int(os.getenv('RETENCAO_DIAS', 0))
+RETENCAO_TOP_USER_AGENTS = int(os.getenv('RETENCAO_TOP_USER_AGENTS', 20))
+
+# Checkpoint do estado em memória de cada site (contadores, mais frequentes e
+# índice temporal), gravado a cada CHECKPOINT_INTERVALO_SEGUNDOS e no
+# encerramento: na inicialização só as visitas gravadas depois dele são
+# relidas (0 desliga e a inicialização relê todo o armazenamento)
+CHECKPOINT_INTERVALO_SEGUNDOS = float(os.getenv('CHECKPOINT_INTERVALO_SEGUNDOS', 300))
+
+# Exportação (/api/visitas/exportar): as visitas são divididas em segmentos de
+# EXPORTACAO_VISITAS_POR_SEGMENTO visitas; os completos são codificados uma vez
+# em PASTA_EXPORTACAO (PASTA_SITES/<site>/exportacao nos demais sites) e
+# servidos direto do disco
+PASTA_EXPORTACAO = os.getenv('PASTA_EXPORTACAO', 'exportacao')
+EXPORTACAO_VISITAS_POR_SEGMENTO = int(os.getenv('EXPORTACAO_VISITAS_POR_SEGMENTO', 100000))
+
+# Configurações de paginação de /api/visitas/todas
+PAGINA_LIMITE_MAXIMO = int(os.getenv('PAGINA_LIMITE_MAXIMO', 1000))
+
+# Máximo de visitas por chamada de POST /api/visitas/registrar/lote
+LOTE_INGESTAO_MAXIMO = int(os.getenv('LOTE_INGESTAO_MAXIMO', 10000))
+
+# Janela máxima (em dias) de /api/visitas/historico
+HISTORICO_DIAS_MAXIMO = int(os.getenv('HISTORICO_DIAS_MAXIMO', 90))
+
+# Precisão dos esboços HyperLogLog de visitantes únicos
+# (2**precisao bytes por dia; 12 -> 4 KB, erro típico de ~1,6%)
+UNICOS_PRECISAO = int(os.getenv('UNICOS_PRECISAO', 12))
+
+# IPs e User-Agents mais frequentes (/api/visitas/top): contadores
+# Space-Saving por campo e por dia, e quantos dias ficam em memória
+TOP_CAPACIDADE = int(os.getenv('TOP_CAPACIDADE', 200))
+TOP_DIAS_MANTIDOS = int(os.getenv('TOP_DIAS_MANTIDOS', 7))
+
 # Configurações de CORS
 CORS_ORIGINS = os.getenv('CORS_ORIGINS', '*')
 
@@ -31,6 +123,8 @@ BACKUP_INTERVALO_HORAS = int(os.getenv('BACKUP_INTERVALO_HORAS', 24))
 LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
 LOG_FILE = os.getenv('LOG_FILE', 'api.log')
 
-# Configurações de rate limiting (futuro)
+# Limite de registros por IP em cada site (token bucket em memória, por processo)
 RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', 'False').lower() == 'true'
-RATE_LIMIT_PER_MINUTE = int(os.getenv('RATE_LIMIT_PER_MINUTE', 60))
\ No newline at end of file
+RATE_LIMIT_PER_MINUTE = int(os.getenv('RATE_LIMIT_PER_MINUTE', 60))
+# Máximo de IPs acompanhados ao mesmo tempo (os menos recentes saem primeiro)
+RATE_LIMIT_MAX_IPS = int(os.getenv('RATE_LIMIT_MAX_IPS', 100000))
\ No newline at end of file
@@ -0,0 +1,68 @@
+"""
+Janela de deduplicação de visitas
+
+Um mesmo par (IP, User-Agent) registrado de novo dentro de
+`janela_segundos` da última visita contabilizada (um F5 repetido, um
+SPA remontando o componente) é contado uma única vez.
+
+Os pares ficam em um OrderedDict na ordem do último acesso (LRU): uma
+repetição suprimida leva o par para o fim, então quem continua repetindo
+não é descartado enquanto está ativo. Quando há mais de `maximo` pares,
+os acessados há mais tempo saem primeiro. Cada par guarda o instante em
+que foi contabilizado: os vencidos saem do início da fila e, como a
+ordem é de acesso, um par vencido mais atrás é reconhecido ao ser
+consultado. Cada verificação é O(1) amortizado.
+"""
+
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+class JanelaDeduplicacao:
+    """Cache com tempo de vida e tamanho máximo dos pares já contabilizados."""
+
+    def __init__(self, janela_segundos, maximo=100000):
+        self.janela_segundos = janela_segundos
+        self.maximo = maximo
+        self._bloqueio = Lock()
+        # chave -> instante em que foi contabilizada, na ordem do último acesso
+        self._vistos = OrderedDict()
+        self.suprimidas = 0
+
+    def repetida(self, chave, agora=None):
+        """
+        Retorna True (e conta como suprimida) se `chave` foi contabilizada
+        há menos de `janela_segundos`; senão a registra e retorna False.
+        """
+        agora = time.monotonic() if agora is None else agora
+        with self._bloqueio:
+            while self._vistos:
+                mais_antiga, instante = next(iter(self._vistos.items()))
+                if agora - instante < self.janela_segundos:
+                    break
+                del self._vistos[mais_antiga]
+            instante = self._vistos.get(chave)
+            if instante is not None and agora - instante < self.janela_segundos:
+                self._vistos.move_to_end(chave)
+                self.suprimidas += 1
+                return True
+            self._vistos[chave] = agora
+            self._vistos.move_to_end(chave)
+            if len(self._vistos) > self.maximo:
+                self._vistos.popitem(last=False)
+            return False
+
+    def esquecer(self, chave):
+        """Remove `chave`, como se nunca tivesse sido contabilizada."""
+        with self._bloqueio:
+            self._vistos.pop(chave, None)
+
+    def estado(self):
+        """Resumo para /api/status."""
+        with self._bloqueio:
+            return {
+                'janela_segundos': self.janela_segundos,
+                'pares_monitorados': len(self._vistos),
+                'suprimidas': self.suprimidas
+            }
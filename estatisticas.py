@@ -0,0 +1,596 @@
+"""
+Estruturas em memória para as estatísticas de visitas
+"""
+
+import base64
+import hashlib
+import json
+import math
+import os
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta
+
+
+def dia_da_visita(visita):
+    """Retorna o dia (AAAA-MM-DD) de uma visita a partir do campo 'tempo'."""
+    return visita['tempo'][:10]
+
+
+def para_epoch(tempo):
+    """Converte uma data/hora ISO (horário local) em segundos desde a época."""
+    return datetime.fromisoformat(tempo).timestamp()
+
+
+def hora_da_visita(visita):
+    """Retorna a hora (AAAA-MM-DDTHH) de uma visita a partir do campo 'tempo'."""
+    return visita['tempo'][:13]
+
+
+def dia_atual():
+    """Retorna o dia atual no formato AAAA-MM-DD."""
+    return datetime.now().strftime('%Y-%m-%d')
+
+
+class ContadorVisitas:
+    """
+    Contadores em memória com o total geral e as visitas por dia.
+    São montados uma única vez na inicialização (do checkpoint e das
+    visitas posteriores, ver Site.carregar_estado) e atualizados a cada
+    nova visita, então as consultas não leem o arquivo. A virada do dia
+    não exige nenhuma ação: quem consulta informa o dia.
+    """
+
+    def __init__(self):
+        self.total = 0
+        self.por_dia = {}
+
+    def registrar(self, visita):
+        """Contabiliza uma nova visita."""
+        dia = dia_da_visita(visita)
+        self.total += 1
+        self.por_dia[dia] = self.por_dia.get(dia, 0) + 1
+
+    def incluir_dia(self, dia, visitas):
+        """Soma as visitas de um dia já agregado (retenção)."""
+        self.total += visitas
+        self.por_dia[dia] = self.por_dia.get(dia, 0) + visitas
+
+    def visitas_no_dia(self, dia):
+        """Retorna o número de visitas de um dia (AAAA-MM-DD)."""
+        return self.por_dia.get(dia, 0)
+
+    def serie(self, inicio, fim):
+        """
+        Lista [(AAAA-MM-DD, visitas)] de cada dia entre as datas
+        `inicio` e `fim` (inclusivo), incluindo dias sem visitas.
+        """
+        atual = inicio
+        serie = []
+        while atual <= fim:
+            dia = atual.strftime('%Y-%m-%d')
+            serie.append((dia, self.por_dia.get(dia, 0)))
+            atual += timedelta(days=1)
+        return serie
+
+
+class HistogramaHorario:
+    """
+    Visitas agregadas por hora (chave AAAA-MM-DDTHH), mantidas
+    incrementalmente a cada visita. Uma série de N horas custa
+    O(N) consultas ao dicionário, independente do total de visitas.
+    """
+
+    def __init__(self):
+        self.por_hora = {}
+
+    def registrar(self, visita):
+        """Contabiliza uma nova visita no balde da sua hora."""
+        hora = hora_da_visita(visita)
+        self.por_hora[hora] = self.por_hora.get(hora, 0) + 1
+
+    def incluir_hora(self, hora, visitas):
+        """Soma as visitas de uma hora (AAAA-MM-DDTHH) já agregada."""
+        self.por_hora[hora] = self.por_hora.get(hora, 0) + visitas
+
+    def serie(self, inicio, fim):
+        """
+        Lista [(AAAA-MM-DDTHH, visitas)] de cada hora entre os
+        datetimes `inicio` e `fim` (exclusivo), incluindo horas sem visitas.
+        """
+        atual = inicio.replace(minute=0, second=0, microsecond=0)
+        serie = []
+        while atual < fim:
+            hora = atual.strftime('%Y-%m-%dT%H')
+            serie.append((hora, self.por_hora.get(hora, 0)))
+            atual += timedelta(hours=1)
+        return serie
+
+
+class IndiceTemporal:
+    """
+    Instantes das visitas (epoch) em um array ordenado, em paralelo
+    com a posição de cada visita no armazenamento.
+    Como as visitas chegam em ordem de tempo, inserir é um append;
+    contar um intervalo são duas buscas binárias, O(log n), e listar
+    um intervalo só lê do armazenamento as visitas encontradas.
+    """
+
+    def __init__(self):
+        self.tempos = array('d')
+        self.posicoes = array('q')
+
+    def __len__(self):
+        return len(self.tempos)
+
+    def adicionar(self, instante, posicao):
+        """Inclui uma visita, mantendo o array ordenado por tempo."""
+        if not self.tempos or instante >= self.tempos[-1]:
+            self.tempos.append(instante)
+            self.posicoes.append(posicao)
+        else:
+            i = bisect_right(self.tempos, instante)
+            self.tempos.insert(i, instante)
+            self.posicoes.insert(i, posicao)
+
+    def _faixa(self, inicio, fim):
+        return (bisect_left(self.tempos, inicio),
+                bisect_left(self.tempos, fim))
+
+    def contar(self, inicio, fim):
+        """Conta as visitas com inicio <= instante < fim."""
+        i, j = self._faixa(inicio, fim)
+        return j - i
+
+    def posicoes_intervalo(self, inicio, fim, limite=None):
+        """Posições das visitas no intervalo, em ordem de tempo."""
+        i, j = self._faixa(inicio, fim)
+        if limite is not None:
+            j = min(j, i + limite)
+        return self.posicoes[i:j].tolist()
+
+    def copiar(self):
+        """Cópias (tempos, posições) dos arrays, para o checkpoint."""
+        return array('d', self.tempos), array('q', self.posicoes)
+
+
+class HyperLogLog:
+    """
+    Esboço HyperLogLog para estimar a quantidade de elementos distintos
+    com memória fixa: 2**precisao registradores de um byte (4 KB com a
+    precisão padrão 12, erro típico de ~1,6%). Esboços com a mesma
+    precisão podem ser mesclados sem perda.
+    A soma harmônica dos registradores e a quantidade de zeros são
+    mantidas a cada alteração (a soma em inteiros, escalada por 2**64,
+    para não acumular erro), então estimar custa O(1).
+    """
+
+    def __init__(self, precisao=12, registradores=None):
+        self.precisao = precisao
+        self.m = 1 << precisao
+        self.registradores = (bytearray(registradores) if registradores
+                              else bytearray(self.m))
+        self._totalizar()
+
+    def _totalizar(self):
+        """Recalcula a soma e os zeros a partir dos registradores."""
+        self._soma = sum(1 << (64 - r) for r in self.registradores)
+        self._zeros = self.registradores.count(0)
+        self._estimativa = None
+
+    def adicionar(self, valor):
+        """Inclui um valor (str) no esboço."""
+        h = int.from_bytes(
+            hashlib.blake2b(valor.encode(), digest_size=8).digest(), 'big')
+        bits_restantes = 64 - self.precisao
+        indice = h >> bits_restantes
+        resto = h & ((1 << bits_restantes) - 1)
+        rho = bits_restantes - resto.bit_length() + 1
+        anterior = self.registradores[indice]
+        if rho > anterior:
+            self.registradores[indice] = rho
+            self._soma += (1 << (64 - rho)) - (1 << (64 - anterior))
+            if anterior == 0:
+                self._zeros -= 1
+            self._estimativa = None
+
+    def mesclar(self, outro):
+        """Incorpora outro esboço (união dos conjuntos)."""
+        self.registradores = bytearray(
+            map(max, self.registradores, outro.registradores))
+        self._totalizar()
+
+    def estimar(self):
+        """Retorna a estimativa de elementos distintos."""
+        if self._estimativa is None:
+            m = self.m
+            alfa = 0.7213 / (1 + 1.079 / m)
+            soma = self._soma / (1 << 64)
+            estimativa = alfa * m * m / soma
+            zeros = self._zeros
+            if estimativa <= 2.5 * m and zeros:
+                # Correção para cardinalidades pequenas (contagem linear)
+                estimativa = m * math.log(m / zeros)
+            self._estimativa = round(estimativa)
+        return self._estimativa
+
+
+def chave_visitante(visita):
+    """Identifica um visitante pelo par IP + User-Agent."""
+    return f"{visita.get('ip')}|{visita.get('user_agent')}"
+
+
+class VisitantesUnicos:
+    """
+    Esboços HyperLogLog de visitantes únicos (IP + User-Agent) por dia
+    e por mês, atualizados a cada visita. Períodos maiores são obtidos
+    mesclando os esboços diários. Os esboços diários são persistidos
+    em arquivo junto com o cursor do armazenamento até onde cobrem.
+    """
+
+    def __init__(self, precisao=12):
+        self.precisao = precisao
+        self.por_dia = {}
+        self.por_mes = {}
+
+    def _esboco(self, tabela, chave):
+        esboco = tabela.get(chave)
+        if esboco is None:
+            esboco = tabela[chave] = HyperLogLog(self.precisao)
+        return esboco
+
+    def registrar(self, visita):
+        """Inclui o visitante da visita nos esboços do dia e do mês."""
+        dia = dia_da_visita(visita)
+        chave = chave_visitante(visita)
+        self._esboco(self.por_dia, dia).adicionar(chave)
+        self._esboco(self.por_mes, dia[:7]).adicionar(chave)
+
+    def unicos_no_dia(self, dia):
+        """Estimativa de visitantes únicos em um dia (AAAA-MM-DD)."""
+        esboco = self.por_dia.get(dia)
+        return esboco.estimar() if esboco else 0
+
+    def unicos_no_mes(self, mes):
+        """Estimativa de visitantes únicos em um mês (AAAA-MM)."""
+        esboco = self.por_mes.get(mes)
+        return esboco.estimar() if esboco else 0
+
+    def unicos_no_periodo(self, inicio, fim):
+        """
+        Estimativa de visitantes únicos entre as datas `inicio`
+        e `fim` (inclusivo), mesclando os esboços diários.
+        """
+        total = HyperLogLog(self.precisao)
+        atual = inicio
+        while atual <= fim:
+            esboco = self.por_dia.get(atual.strftime('%Y-%m-%d'))
+            if esboco:
+                total.mesclar(esboco)
+            atual += timedelta(days=1)
+        return total.estimar()
+
+    def incluir_dia(self, dia, esboco):
+        """Inclui o esboço de um dia já agregado (retenção)."""
+        self._esboco(self.por_dia, dia).mesclar(esboco)
+        self._esboco(self.por_mes, dia[:7]).mesclar(esboco)
+
+    def salvar(self, arquivo, cursor, geracao=0):
+        """
+        Grava os esboços diários e o cursor até onde cobrem, junto com a
+        geração do armazenamento (a retenção muda o significado do cursor).
+        """
+        dados = {
+            'precisao': self.precisao,
+            'cursor': cursor,
+            'geracao': geracao,
+            'dias': {
+                dia: base64.b64encode(bytes(esboco.registradores)).decode()
+                for dia, esboco in self.por_dia.items()
+            }
+        }
+        temporario = f'{arquivo}.{os.getpid()}.tmp'
+        with open(temporario, 'w') as f:
+            json.dump(dados, f)
+        os.replace(temporario, arquivo)
+
+    def carregar(self, arquivo, geracao=0):
+        """
+        Carrega os esboços salvos e remonta os mensais.
+        Retorna o cursor do armazenamento coberto, ou None se não
+        houver arquivo compatível (ou se for de outra geração).
+        """
+        try:
+            with open(arquivo, 'r') as f:
+                dados = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if dados.get('precisao') != self.precisao or 'cursor' not in dados \
+                or dados.get('geracao', 0) != geracao:
+            return None
+        self.por_dia = {
+            dia: HyperLogLog(self.precisao, base64.b64decode(registradores))
+            for dia, registradores in dados['dias'].items()
+        }
+        self.por_mes = {}
+        for dia, esboco in self.por_dia.items():
+            self._esboco(self.por_mes, dia[:7]).mesclar(esboco)
+        return dados['cursor']
+
+    def recalcular(self, visitas):
+        """Recria todos os esboços a partir das visitas."""
+        self.por_dia = {}
+        self.por_mes = {}
+        for visita in visitas:
+            self.registrar(visita)
+
+
+class SpaceSaving:
+    """
+    Algoritmo Space-Saving para os itens mais frequentes de um fluxo,
+    com no máximo `capacidade` contadores. Quando todos estão ocupados,
+    um item novo herda o contador do menos frequente (e registra essa
+    contagem herdada como erro máximo). Todo item com mais de
+    total / capacidade ocorrências está garantidamente entre os
+    monitorados, e a contagem de cada um nunca é menor que a real.
+
+    Os itens ficam agrupados por contagem, então cada atualização é O(1).
+    """
+
+    def __init__(self, capacidade):
+        self.capacidade = capacidade
+        self.total = 0
+        # item -> [contagem, erro]
+        self.contadores = {}
+        # contagem -> itens com essa contagem
+        self.grupos = {}
+        self.minimo = 0
+        self.substituicoes = 0
+
+    def _mover(self, item, de, para):
+        grupo = self.grupos[de]
+        grupo.discard(item)
+        if not grupo:
+            del self.grupos[de]
+            if self.minimo == de:
+                self.minimo = para
+        self.grupos.setdefault(para, set()).add(item)
+
+    def adicionar(self, item):
+        """Conta uma ocorrência de `item`."""
+        self.total += 1
+        contador = self.contadores.get(item)
+        if contador is not None:
+            contador[0] += 1
+            self._mover(item, contador[0] - 1, contador[0])
+        elif len(self.contadores) < self.capacidade:
+            self.contadores[item] = [1, 0]
+            self.grupos.setdefault(1, set()).add(item)
+            self.minimo = 1
+        else:
+            # Substitui um dos itens com a menor contagem
+            minimo = self.minimo
+            substituido = next(iter(self.grupos[minimo]))
+            self.grupos[minimo].discard(substituido)
+            self.grupos[minimo].add(item)
+            self.contadores[item] = [minimo + 1, minimo]
+            del self.contadores[substituido]
+            self.substituicoes += 1
+            self._mover(item, minimo, minimo + 1)
+
+    @property
+    def exato(self):
+        """Verdadeiro enquanto nenhum item foi descartado."""
+        return self.substituicoes == 0
+
+    def mais_frequentes(self, n):
+        """Lista [(item, contagem, erro)] dos `n` itens mais frequentes."""
+        return sorted(
+            ((item, contagem, erro) for item, (contagem, erro) in self.contadores.items()),
+            key=lambda entrada: (-entrada[1], str(entrada[0])))[:n]
+
+    def exportar(self):
+        """Estado em estruturas simples (JSON), para o checkpoint."""
+        return {
+            'total': self.total,
+            'substituicoes': self.substituicoes,
+            'contadores': [[item, contagem, erro] for item, (contagem, erro)
+                           in self.contadores.items()]
+        }
+
+    def importar(self, dados):
+        """Restaura o estado gerado por `exportar`, remontando os grupos."""
+        self.total = dados['total']
+        self.substituicoes = dados['substituicoes']
+        self.contadores = {}
+        self.grupos = {}
+        for item, contagem, erro in dados['contadores']:
+            self.contadores[item] = [contagem, erro]
+            self.grupos.setdefault(contagem, set()).add(item)
+        self.minimo = min(self.grupos, default=0)
+
+
+class MaisFrequentes:
+    """
+    Itens mais frequentes (IPs e User-Agents) por dia, com um
+    Space-Saving de `capacidade` contadores por campo e por dia.
+    Só os `dias_mantidos` dias mais recentes ficam em memória.
+    """
+
+    CAMPOS = ('ip', 'user_agent')
+
+    def __init__(self, capacidade=200, dias_mantidos=7):
+        self.capacidade = capacidade
+        self.dias_mantidos = dias_mantidos
+        self.por_dia = {}
+
+    def registrar(self, visita):
+        """Conta o IP e o User-Agent da visita no dia dela."""
+        dia = dia_da_visita(visita)
+        esbocos = self.por_dia.get(dia)
+        if esbocos is None:
+            if len(self.por_dia) >= self.dias_mantidos:
+                mais_antigo = min(self.por_dia)
+                if dia < mais_antigo:
+                    return
+                del self.por_dia[mais_antigo]
+            esbocos = self.por_dia[dia] = {
+                campo: SpaceSaving(self.capacidade) for campo in self.CAMPOS}
+        for campo in self.CAMPOS:
+            esbocos[campo].adicionar(visita.get(campo))
+
+    def mais_frequentes(self, dia, campo, n):
+        """
+        Retorna (itens, exato): os `n` valores de `campo` mais frequentes
+        no dia, como [(valor, contagem, erro)], e se as contagens são
+        exatas. Lança ValueError se o campo ou o dia não for suportado.
+        """
+        if campo not in self.CAMPOS:
+            raise ValueError("Parâmetro 'campo' deve ser 'ip' ou 'user_agent'")
+        esbocos = self.por_dia.get(dia)
+        if esbocos is None:
+            # Com todos os dias ocupados, os anteriores foram descartados
+            if len(self.por_dia) >= self.dias_mantidos and dia < min(self.por_dia):
+                raise ValueError(
+                    f"Dia fora dos {self.dias_mantidos} dias mantidos em memória")
+            return [], True
+        return esbocos[campo].mais_frequentes(n), esbocos[campo].exato
+
+    def exportar(self):
+        """Estado em estruturas simples (JSON), para o checkpoint."""
+        return {dia: {campo: esboco.exportar() for campo, esboco in esbocos.items()}
+                for dia, esbocos in self.por_dia.items()}
+
+    def importar(self, dados):
+        """Restaura o estado gerado por `exportar`."""
+        self.por_dia = {}
+        for dia, esbocos in dados.items():
+            self.por_dia[dia] = {}
+            for campo in self.CAMPOS:
+                esboco = self.por_dia[dia][campo] = SpaceSaving(self.capacidade)
+                esboco.importar(esbocos[campo])
+
+
+class AgregadosDiarios:
+    """
+    Resumo por dia das visitas anteriores ao corte de retenção, que já
+    não estão no armazenamento: total, visitas por hora, esboço de
+    visitantes únicos e os User-Agents mais frequentes.
+
+    `corte` é o primeiro dia mantido como visitas brutas: uma visita
+    bruta de um dia anterior já está nos agregados e não é contada de
+    novo. `geracao` cresce a cada aplicação da retenção, que reescreve
+    o armazenamento e muda as posições das visitas.
+    """
+
+    def __init__(self, precisao=12):
+        self.precisao = precisao
+        self.corte = None
+        self.geracao = 0
+        # dia -> {'visitas', 'por_hora': {HH: n}, 'unicos': HyperLogLog,
+        #         'user_agents': [[user_agent, visitas, erro máximo], ...]}
+        self.dias = {}
+
+    def agregada(self, visita):
+        """Verdadeiro se a visita é de um dia anterior ao corte."""
+        return self.corte is not None and visita['tempo'] < self.corte
+
+    def agregar(self, visitas, corte, maximo_user_agents=20, capacidade=200):
+        """
+        Resume as visitas dos dias entre o corte atual e o novo `corte`
+        (AAAA-MM-DD), avança o corte e a geração. As demais visitas são
+        ignoradas. Retorna quantas visitas foram agregadas.
+        """
+        novos = {}
+        agregadas = 0
+        for visita in visitas:
+            if self.agregada(visita) or visita['tempo'] >= corte:
+                continue
+            dia = dia_da_visita(visita)
+            acumulado = novos.get(dia)
+            if acumulado is None:
+                acumulado = novos[dia] = {
+                    'visitas': 0,
+                    'por_hora': {},
+                    'unicos': HyperLogLog(self.precisao),
+                    'user_agents': SpaceSaving(capacidade)
+                }
+            hora = visita['tempo'][11:13]
+            acumulado['visitas'] += 1
+            acumulado['por_hora'][hora] = acumulado['por_hora'].get(hora, 0) + 1
+            acumulado['unicos'].adicionar(chave_visitante(visita))
+            acumulado['user_agents'].adicionar(visita.get('user_agent'))
+            agregadas += 1
+
+        for dia, acumulado in novos.items():
+            acumulado['user_agents'] = [
+                list(item) for item in
+                acumulado['user_agents'].mais_frequentes(maximo_user_agents)]
+            self.dias[dia] = acumulado
+        self.corte = corte
+        self.geracao += 1
+        return agregadas
+
+    def contar(self, inicio, fim):
+        """
+        Visitas agregadas nas horas inteiramente dentro do intervalo
+        inicio <= tempo < fim (datetime): a resolução é de uma hora.
+        """
+        if self.corte is None or inicio >= datetime.fromisoformat(self.corte):
+            return 0
+        total = 0
+        for dia, dados in self.dias.items():
+            for hora, visitas in dados['por_hora'].items():
+                instante = datetime.fromisoformat(f'{dia}T{hora}:00:00')
+                if inicio <= instante and instante + timedelta(hours=1) <= fim:
+                    total += visitas
+        return total
+
+    def salvar(self, arquivo):
+        """Grava os agregados (via arquivo temporário e troca atômica)."""
+        dados = {
+            'precisao': self.precisao,
+            'corte': self.corte,
+            'geracao': self.geracao,
+            'dias': {
+                dia: {
+                    'visitas': dados['visitas'],
+                    'por_hora': dados['por_hora'],
+                    'unicos': base64.b64encode(bytes(dados['unicos'].registradores)).decode(),
+                    'user_agents': dados['user_agents']
+                }
+                for dia, dados in sorted(self.dias.items())
+            }
+        }
+        temporario = f'{arquivo}.{os.getpid()}.tmp'
+        with open(temporario, 'w') as f:
+            json.dump(dados, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporario, arquivo)
+
+    def carregar(self, arquivo):
+        """
+        Carrega os agregados salvos. Sem arquivo, fica vazio (sem corte).
+        Lança ValueError se a precisão dos esboços não for a configurada.
+        """
+        try:
+            with open(arquivo, 'r') as f:
+                dados = json.load(f)
+        except FileNotFoundError:
+            return
+        if dados['precisao'] != self.precisao:
+            raise ValueError(
+                f"Agregados de {arquivo} usam precisão {dados['precisao']}, "
+                f"mas UNICOS_PRECISAO é {self.precisao}")
+        self.corte = dados['corte']
+        self.geracao = dados['geracao']
+        self.dias = {
+            dia: {
+                'visitas': dados_dia['visitas'],
+                'por_hora': dados_dia['por_hora'],
+                'unicos': HyperLogLog(self.precisao, base64.b64decode(dados_dia['unicos'])),
+                'user_agents': dados_dia['user_agents']
+            }
+            for dia, dados_dia in dados['dias'].items()
+        }
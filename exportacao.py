@@ -0,0 +1,251 @@
+"""
+Exportação das visitas em segmentos imutáveis
+
+O armazenamento é dividido, em ordem de gravação, em segmentos de
+EXPORTACAO_VISITAS_POR_SEGMENTO visitas. Um segmento completo não muda
+mais (o armazenamento só cresce no fim), então é codificado uma única
+vez por formato (NDJSON ou CSV, com ou sem gzip) em um arquivo na pasta
+de exportação e, daí em diante, servido direto do disco, sem decodificar
+nem recodificar visitas. Só o segmento ativo, ainda incompleto, é lido
+do armazenamento e codificado a cada exportação.
+
+Com gzip, cada segmento é um membro gzip independente: a concatenação
+dos membros é um arquivo gzip válido (RFC 1952), que gunzip e o módulo
+gzip do Python leem inteiro.
+
+O índice dos segmentos (`segmentos.json`) registra o backend e a geração
+da retenção para os quais vale, e a posição e o instante da última
+visita de cada segmento. A retenção (que reescreve o armazenamento) ou
+um armazenamento restaurado invalidam o índice, e os segmentos são
+refeitos na exportação seguinte.
+"""
+
+import csv
+import io
+import json
+import os
+import zlib
+from itertools import islice
+from threading import Lock
+
+from armazenamento import trava_entre_processos
+from metricas import metricas
+
+# Muda quando o formato dos arquivos muda: segmentos antigos são refeitos
+VERSAO = 1
+
+# Formatos de exportação (também a extensão dos arquivos) e tipo de conteúdo
+FORMATOS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv; charset=utf-8'
+}
+COMPRESSOES = ('gzip',)
+
+# Colunas do CSV, na ordem dos campos de uma visita
+COLUNAS_CSV = ('tempo', 'ip', 'user_agent')
+
+
+def codificar(visitas, formato, tamanho_bloco=1000):
+    """Gera as visitas codificadas em `formato`, em blocos de texto."""
+    if formato == 'ndjson':
+        bloco = []
+        for visita in visitas:
+            bloco.append(json.dumps(visita) + '\n')
+            if len(bloco) >= tamanho_bloco:
+                yield ''.join(bloco)
+                bloco = []
+        if bloco:
+            yield ''.join(bloco)
+        return
+
+    saida = io.StringIO()
+    escritor = csv.writer(saida, lineterminator='\n')
+    linhas = 0
+    for visita in visitas:
+        escritor.writerow([visita.get(coluna) for coluna in COLUNAS_CSV])
+        linhas += 1
+        if linhas >= tamanho_bloco:
+            yield saida.getvalue()
+            saida.seek(0)
+            saida.truncate()
+            linhas = 0
+    if linhas:
+        yield saida.getvalue()
+
+
+def cabecalho(formato):
+    """Primeira linha da exportação (só o CSV tem cabeçalho)."""
+    return ','.join(COLUNAS_CSV) + '\n' if formato == 'csv' else ''
+
+
+def comprimir(blocos):
+    """Comprime os blocos de texto em um único membro gzip, aos poucos."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for bloco in blocos:
+        comprimido = compressor.compress(bloco.encode())
+        if comprimido:
+            yield comprimido
+    yield compressor.flush()
+
+
+def gerar_exportacao(arquivos, formato, compressao, visitas_ativas,
+                     tamanho_leitura=1 << 20):
+    """
+    Gera o corpo completo da exportação: cabeçalho, os arquivos dos
+    segmentos selados (copiados do disco como estão) e as visitas do
+    segmento ativo, codificadas na hora.
+    """
+    def codificados(blocos):
+        if compressao == 'gzip':
+            return comprimir(blocos)
+        return (bloco.encode() for bloco in blocos)
+
+    if cabecalho(formato):
+        yield from codificados([cabecalho(formato)])
+    for arquivo in arquivos:
+        with open(arquivo, 'rb') as f:
+            for bloco in iter(lambda: f.read(tamanho_leitura), b''):
+                yield bloco
+    yield from codificados(codificar(visitas_ativas, formato))
+
+
+class ExportacaoVisitas:
+    """
+    Segmentos selados de um site, na pasta `pasta`. Várias threads e
+    processos podem exportar ao mesmo tempo: o índice é atualizado sob
+    uma trava entre processos, e cada arquivo de segmento é publicado de
+    forma atômica e nunca sobrescrito.
+    """
+
+    def __init__(self, pasta, visitas_por_segmento):
+        self.pasta = pasta
+        self.visitas_por_segmento = visitas_por_segmento
+        self.arquivo_indice = os.path.join(pasta, 'segmentos.json')
+        self._bloqueio = Lock()
+        # Até onde o segmento ativo já foi contado neste processo:
+        # (início, cursor, visitas), para não recontá-lo a cada exportação
+        self._ativo = None
+
+    def arquivo_segmento(self, numero, formato, compressao=None):
+        nome = f'segmento-{numero:06d}.{formato}'
+        return os.path.join(self.pasta, nome + ('.gz' if compressao else ''))
+
+    def _ler_indice(self):
+        try:
+            with open(self.arquivo_indice, 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _gravar_indice(self, indice):
+        temporario = f'{self.arquivo_indice}.{os.getpid()}.tmp'
+        with open(temporario, 'w') as f:
+            json.dump(indice, f)
+        os.replace(temporario, self.arquivo_indice)
+
+    def _indice_valido(self, indice, armazenamento, geracao):
+        """
+        O índice vale se for desta versão, do mesmo backend, geração e
+        tamanho de segmento, e se a última visita do último segmento
+        ainda estiver na mesma posição do armazenamento.
+        """
+        if indice is None or indice.get('versao') != VERSAO or \
+                indice['armazenamento'] != armazenamento.nome or \
+                indice['geracao'] != geracao or \
+                indice['visitas_por_segmento'] != self.visitas_por_segmento:
+            return False
+        if not indice['segmentos']:
+            return True
+        ultimo = indice['segmentos'][-1]
+        if ultimo['fim'] > armazenamento.fim():
+            return False
+        try:
+            visitas = armazenamento.obter([ultimo['ultima']])
+        except (ValueError, KeyError):
+            return False
+        return bool(visitas) and visitas[0]['tempo'] == ultimo['tempo_ultima']
+
+    def _limpar(self):
+        """Apaga os arquivos de segmentos de um índice que não vale mais."""
+        for nome in os.listdir(self.pasta):
+            if nome.startswith('segmento-'):
+                os.remove(os.path.join(self.pasta, nome))
+        self._ativo = None
+
+    def atualizar(self, armazenamento, geracao):
+        """
+        Sela os segmentos que se completaram desde a última chamada.
+        Retorna (segmentos selados, cursor do início do segmento ativo);
+        cada segmento é {'inicio', 'fim', 'visitas', 'ultima',
+        'tempo_ultima'}, com os cursores do armazenamento.
+        Deve ser chamada sem que a retenção possa rodar ao mesmo tempo
+        (ver Site.exportar).
+        """
+        os.makedirs(self.pasta, exist_ok=True)
+        with self._bloqueio, trava_entre_processos(self.arquivo_indice):
+            indice = self._ler_indice()
+            if not self._indice_valido(indice, armazenamento, geracao):
+                self._limpar()
+                indice = {
+                    'versao': VERSAO,
+                    'armazenamento': armazenamento.nome,
+                    'geracao': geracao,
+                    'visitas_por_segmento': self.visitas_por_segmento,
+                    'segmentos': []
+                }
+                self._gravar_indice(indice)
+            segmentos = indice['segmentos']
+
+            inicio = segmentos[-1]['fim'] if segmentos else 0
+            if self._ativo is not None and self._ativo[0] == inicio and \
+                    self._ativo[1] <= armazenamento.fim():
+                _, cursor, visitas = self._ativo
+            else:
+                cursor, visitas = inicio, 0
+
+            selados = len(segmentos)
+            for posicao, cursor, visita in armazenamento.ler_desde(cursor):
+                visitas += 1
+                if visitas == self.visitas_por_segmento:
+                    segmentos.append({
+                        'inicio': inicio,
+                        'fim': cursor,
+                        'visitas': visitas,
+                        'ultima': posicao,
+                        'tempo_ultima': visita['tempo']
+                    })
+                    inicio, visitas = cursor, 0
+            if len(segmentos) > selados:
+                self._gravar_indice(indice)
+            self._ativo = (inicio, cursor, visitas)
+            return segmentos, inicio
+
+    def preparar_arquivo(self, armazenamento, numero, segmento, formato,
+                         compressao=None):
+        """
+        Retorna o arquivo do segmento selado `numero` no formato pedido,
+        codificando-o na primeira vez. Dois processos que codifiquem o
+        mesmo segmento produzem o mesmo conteúdo; o primeiro a terminar
+        publica o arquivo, que não é mais substituído (o ETag de quem já
+        baixou parte dele continua valendo).
+        """
+        arquivo = self.arquivo_segmento(numero, formato, compressao)
+        if os.path.exists(arquivo):
+            return arquivo
+
+        visitas = (visita for _, _, visita in islice(
+            armazenamento.ler_desde(segmento['inicio']), segmento['visitas']))
+        blocos = codificar(visitas, formato)
+        blocos = comprimir(blocos) if compressao else (b.encode() for b in blocos)
+        temporario = f'{arquivo}.{os.getpid()}.tmp'
+        with open(temporario, 'wb') as f:
+            for bloco in blocos:
+                f.write(bloco)
+            metricas.contar_bytes('gravados', f.tell())
+        try:
+            os.link(temporario, arquivo)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(temporario)
+        return arquivo
@@ -0,0 +1,74 @@
+"""
+Limite de taxa de registros por cliente (token bucket)
+
+Cada cliente (IP, em cada site) tem um balde de `capacidade` fichas que
+se reabastece a `por_minuto` fichas por minuto; cada visita consome uma
+ficha e, sem fichas, a visita é recusada antes de chegar ao
+armazenamento.
+
+Os baldes ficam em um OrderedDict na ordem do último acesso, então a
+verificação é O(1): os baldes ociosos por tempo suficiente para estarem
+cheios (equivalentes a um balde novo) saem do início da fila, e o total
+de baldes nunca passa de `maximo_clientes`.
+"""
+
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+class LimitadorTaxa:
+    """Token bucket por chave, com memória limitada."""
+
+    def __init__(self, por_minuto, maximo_clientes=100000, capacidade=None):
+        self.por_segundo = por_minuto / 60
+        self.capacidade = capacidade or por_minuto
+        self.maximo_clientes = maximo_clientes
+        # Tempo para um balde vazio voltar a ficar cheio
+        self.ociosidade = self.capacidade / self.por_segundo if self.por_segundo else 0
+        self._bloqueio = Lock()
+        # chave -> [fichas, instante da última atualização]
+        self._baldes = OrderedDict()
+        self.recusadas = 0
+
+    def permitir(self, chave, agora=None):
+        """
+        Consome uma ficha do balde de `chave`. Retorna 0 se a requisição
+        pode seguir, ou os segundos até a próxima ficha se foi recusada.
+        """
+        agora = time.monotonic() if agora is None else agora
+        with self._bloqueio:
+            self._remover_ociosos(agora)
+            balde = self._baldes.get(chave)
+            if balde is None:
+                balde = self._baldes[chave] = [self.capacidade, agora]
+                if len(self._baldes) > self.maximo_clientes:
+                    self._baldes.popitem(last=False)
+            else:
+                self._baldes.move_to_end(chave)
+                balde[0] = min(self.capacidade,
+                               balde[0] + (agora - balde[1]) * self.por_segundo)
+                balde[1] = agora
+            if balde[0] >= 1:
+                balde[0] -= 1
+                return 0
+            self.recusadas += 1
+            if not self.por_segundo:
+                return 60
+            return (1 - balde[0]) / self.por_segundo
+
+    def _remover_ociosos(self, agora):
+        """Descarta, do início da fila, os baldes que já estariam cheios."""
+        while self._baldes:
+            chave, (_, ultimo) = next(iter(self._baldes.items()))
+            if agora - ultimo < self.ociosidade:
+                break
+            del self._baldes[chave]
+
+    def estado(self):
+        """Resumo para /api/status."""
+        with self._bloqueio:
+            return {
+                'clientes_monitorados': len(self._baldes),
+                'recusadas': self.recusadas
+            }
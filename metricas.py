@@ -0,0 +1,303 @@
+"""
+Métricas da API no formato de texto do Prometheus
+
+Acumuladores em memória, sem dependências externas:
+- requisições e histograma de latência por rota
+- tempo de espera e de posse das travas dos sites
+- tempo das operações de armazenamento e bytes lidos/gravados
+
+Cada thread soma nos seus próprios acumuladores, sem trava: o registro
+de visitas de um site não disputa uma trava global com os demais. Os
+acumuladores de todas as threads só são somados quando /metrics é lido;
+os de uma thread encerrada são incorporados a um total dos encerrados.
+"""
+
+import weakref
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock, RLock, local
+from time import perf_counter
+
+# Limites (em segundos) dos baldes do histograma de latência
+BALDES_LATENCIA = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+PREFIXO = 'contador_visitas'
+
+
+class Histograma:
+    """Histograma cumulativo com baldes fixos, como no Prometheus."""
+
+    def __init__(self, baldes=BALDES_LATENCIA):
+        self.baldes = baldes
+        self.contagens = [0] * (len(baldes) + 1)
+        self.soma = 0.0
+        self.total = 0
+
+    def observar(self, valor):
+        self.contagens[bisect_left(self.baldes, valor)] += 1
+        self.soma += valor
+        self.total += 1
+
+    def somar(self, contagens, soma, total):
+        for i, contagem in enumerate(contagens):
+            self.contagens[i] += contagem
+        self.soma += soma
+        self.total += total
+
+
+class Acumuladores:
+    """Somas de uma thread (ou das threads já encerradas)."""
+
+    def __init__(self):
+        self.requisicoes = {}
+        self.latencias = {}
+        self.travas = {}
+        self.armazenamento = {}
+        self.bytes = {'lidos': 0, 'gravados': 0}
+
+    def somar_em(self, destino):
+        """
+        Soma estes acumuladores em `destino`. As cópias (list/dict) são
+        atômicas sob o GIL, então a thread dona pode continuar somando.
+        """
+        for chave, total in list(self.requisicoes.items()):
+            destino.requisicoes[chave] = destino.requisicoes.get(chave, 0) + total
+        for chave, h in list(self.latencias.items()):
+            if chave not in destino.latencias:
+                destino.latencias[chave] = Histograma()
+            destino.latencias[chave].somar(list(h.contagens), h.soma, h.total)
+        for campo in ('travas', 'armazenamento'):
+            origem, alvo = getattr(self, campo), getattr(destino, campo)
+            for nome, medidas in list(origem.items()):
+                medidas = list(medidas)
+                if nome not in alvo:
+                    alvo[nome] = [0] * len(medidas)
+                for i, valor in enumerate(medidas):
+                    alvo[nome][i] += valor
+        for direcao, quantidade in list(self.bytes.items()):
+            destino.bytes[direcao] += quantidade
+
+
+class Metricas:
+    """
+    Métricas do processo: acumuladores por thread, somados na leitura.
+    A trava só é usada quando uma thread faz sua primeira medição, quando
+    ela termina e quando /metrics é lido.
+    """
+
+    def __init__(self):
+        # Reentrante: um finalizador pode rodar durante a leitura
+        self._bloqueio = RLock()
+        self._local = local()
+        self._ativos = set()
+        self._encerrados = Acumuladores()
+
+    def _acumuladores(self):
+        """Acumuladores da thread atual, criados na primeira medição."""
+        try:
+            return self._local.acumuladores
+        except AttributeError:
+            pass
+        acumuladores = self._local.acumuladores = Acumuladores()
+        # `marca` só é referenciada pelo armazenamento local da thread:
+        # quando a thread termina, ela é coletada e os acumuladores
+        # passam para o total dos encerrados
+        marca = self._local.marca = Marca()
+        with self._bloqueio:
+            self._ativos.add(acumuladores)
+        weakref.finalize(marca, self._encerrar, acumuladores)
+        return acumuladores
+
+    def _encerrar(self, acumuladores):
+        with self._bloqueio:
+            self._ativos.discard(acumuladores)
+            acumuladores.somar_em(self._encerrados)
+
+    def consolidar(self):
+        """Soma os acumuladores de todas as threads, para leitura."""
+        total = Acumuladores()
+        with self._bloqueio:
+            self._encerrados.somar_em(total)
+            for acumuladores in list(self._ativos):
+                acumuladores.somar_em(total)
+        return total
+
+    def registrar_requisicao(self, metodo, rota, status, duracao):
+        acumuladores = self._acumuladores()
+        chave = (metodo, rota, status)
+        acumuladores.requisicoes[chave] = acumuladores.requisicoes.get(chave, 0) + 1
+        histograma = acumuladores.latencias.get((metodo, rota))
+        if histograma is None:
+            histograma = acumuladores.latencias[(metodo, rota)] = Histograma()
+        histograma.observar(duracao)
+
+    def registrar_trava(self, nome, espera, posse):
+        travas = self._acumuladores().travas
+        medidas = travas.get(nome)
+        if medidas is None:
+            medidas = travas[nome] = [0, 0.0, 0.0]
+        medidas[0] += 1
+        medidas[1] += espera
+        medidas[2] += posse
+
+    def registrar_operacao(self, operacao, duracao):
+        armazenamento = self._acumuladores().armazenamento
+        medidas = armazenamento.get(operacao)
+        if medidas is None:
+            medidas = armazenamento[operacao] = [0, 0.0]
+        medidas[0] += 1
+        medidas[1] += duracao
+
+    def contar_bytes(self, direcao, quantidade):
+        self._acumuladores().bytes[direcao] += quantidade
+
+    def formatar(self, sites=()):
+        """
+        Texto no formato de exposição do Prometheus. `sites` é uma
+        lista de (nome, visitas, tamanho em bytes) dos sites carregados.
+        """
+        linhas = []
+
+        def cabecalho(nome, tipo, ajuda):
+            linhas.append(f'# HELP {PREFIXO}_{nome} {ajuda}')
+            linhas.append(f'# TYPE {PREFIXO}_{nome} {tipo}')
+
+        def amostra(nome, rotulos, valor):
+            if rotulos:
+                texto = ','.join(f'{chave}="{escapar(valor_rotulo)}"'
+                                 for chave, valor_rotulo in rotulos.items())
+                linhas.append(f'{PREFIXO}_{nome}{{{texto}}} {valor}')
+            else:
+                linhas.append(f'{PREFIXO}_{nome} {valor}')
+
+        total = self.consolidar()
+        requisicoes = sorted(total.requisicoes.items())
+        latencias = sorted(
+            (chave, h.contagens, h.soma, h.total)
+            for chave, h in total.latencias.items())
+        travas = sorted(total.travas.items())
+        armazenamento = sorted(total.armazenamento.items())
+        bytes_ = total.bytes
+
+        cabecalho('requisicoes_total', 'counter',
+                  'Requisições HTTP por método, rota e status')
+        for (metodo, rota, status), total in requisicoes:
+            amostra('requisicoes_total',
+                    {'metodo': metodo, 'rota': rota, 'status': status}, total)
+
+        cabecalho('requisicao_segundos', 'histogram',
+                  'Latência das requisições HTTP por método e rota')
+        for (metodo, rota), contagens, soma, total in latencias:
+            acumulado = 0
+            for limite, contagem in zip(BALDES_LATENCIA + ('+Inf',), contagens):
+                acumulado += contagem
+                amostra('requisicao_segundos_bucket',
+                        {'metodo': metodo, 'rota': rota, 'le': limite}, acumulado)
+            amostra('requisicao_segundos_sum',
+                    {'metodo': metodo, 'rota': rota}, soma)
+            amostra('requisicao_segundos_count',
+                    {'metodo': metodo, 'rota': rota}, total)
+
+        cabecalho('trava_aquisicoes_total', 'counter',
+                  'Aquisições das travas dos sites')
+        for nome, (aquisicoes, _, _) in travas:
+            amostra('trava_aquisicoes_total', {'trava': nome}, aquisicoes)
+        cabecalho('trava_espera_segundos_total', 'counter',
+                  'Tempo esperando para adquirir as travas dos sites')
+        for nome, (_, espera, _) in travas:
+            amostra('trava_espera_segundos_total', {'trava': nome}, espera)
+        cabecalho('trava_posse_segundos_total', 'counter',
+                  'Tempo com as travas dos sites adquiridas')
+        for nome, (_, _, posse) in travas:
+            amostra('trava_posse_segundos_total', {'trava': nome}, posse)
+
+        cabecalho('armazenamento_operacoes_total', 'counter',
+                  'Operações de armazenamento (carregar, gravar, sincronizar)')
+        for nome, (operacoes, _) in armazenamento:
+            amostra('armazenamento_operacoes_total', {'operacao': nome}, operacoes)
+        cabecalho('armazenamento_segundos_total', 'counter',
+                  'Tempo gasto nas operações de armazenamento')
+        for nome, (_, segundos) in armazenamento:
+            amostra('armazenamento_segundos_total', {'operacao': nome}, segundos)
+
+        cabecalho('armazenamento_bytes_lidos_total', 'counter',
+                  'Bytes lidos do armazenamento')
+        amostra('armazenamento_bytes_lidos_total', {}, bytes_['lidos'])
+        cabecalho('armazenamento_bytes_gravados_total', 'counter',
+                  'Bytes gravados no armazenamento')
+        amostra('armazenamento_bytes_gravados_total', {}, bytes_['gravados'])
+
+        cabecalho('visitas', 'gauge', 'Total de visitas de cada site carregado')
+        for nome, visitas, _ in sites:
+            amostra('visitas', {'site': nome}, visitas)
+        cabecalho('armazenamento_tamanho_bytes', 'gauge',
+                  'Tamanho em disco do armazenamento de cada site carregado')
+        for nome, _, tamanho in sites:
+            amostra('armazenamento_tamanho_bytes', {'site': nome}, tamanho)
+
+        return '\n'.join(linhas) + '\n'
+
+
+class Marca:
+    """Objeto vazio cuja coleta indica o fim de uma thread (ver Metricas)."""
+
+
+def escapar(valor):
+    """Escapa um valor de rótulo do Prometheus."""
+    return (str(valor).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+# Acumuladores do processo, usados pela API, pelos sites e pelos backends
+metricas = Metricas()
+
+
+@contextmanager
+def medir_operacao(operacao):
+    """Soma a duração do bloco ao tempo da operação de armazenamento."""
+    inicio = perf_counter()
+    try:
+        yield
+    finally:
+        metricas.registrar_operacao(operacao, perf_counter() - inicio)
+
+
+class TravaMedida:
+    """
+    Lock que mede o tempo de espera para adquiri-lo e o tempo em que
+    fica adquirido, somados por nome em `metricas`. Usado como
+    threading.Lock (with, acquire, release).
+    """
+
+    __slots__ = ('nome', '_trava', '_adquirida_em', '_espera')
+
+    def __init__(self, nome):
+        self.nome = nome
+        self._trava = Lock()
+        self._adquirida_em = 0.0
+        self._espera = 0.0
+
+    def acquire(self, blocking=True, timeout=-1):
+        inicio = perf_counter()
+        if not self._trava.acquire(blocking, timeout):
+            return False
+        self._adquirida_em = perf_counter()
+        self._espera = self._adquirida_em - inicio
+        return True
+
+    def release(self):
+        posse = perf_counter() - self._adquirida_em
+        espera = self._espera
+        self._trava.release()
+        metricas.registrar_trava(self.nome, espera, posse)
+
+    def locked(self):
+        return self._trava.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *_):
+        self.release()
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+"""
+Migração do arquivo legado visitas.json para outro formato de armazenamento
+
+O arquivo legado é um único array JSON, que `json.load` precisaria ler
+inteiro na memória. Aqui ele é lido em blocos, um elemento por vez
+(`json.JSONDecoder.raw_decode`), e as visitas são gravadas no formato de
+destino em lotes: a memória não depende do tamanho do arquivo.
+
+A origem também pode ser NDJSON (uma visita por linha), como a cadeia de
+backups descompactada: é assim que um backup é restaurado em qualquer
+formato, inclusive 'json' (ver backup_script.py).
+
+Depois de cada lote, o ponto da migração (byte da origem, visitas
+migradas e cursor do destino) é gravado em `<destino>.migracao`. Se a
+migração for interrompida, rodar o mesmo comando continua desse ponto;
+visitas de um lote gravado logo antes da interrupção, mas ainda fora
+do ponto, são encontradas no destino e não são gravadas de novo.
+
+Ao final, as visitas por dia da origem e do destino são comparadas.
+Rode com a API parada: outras gravações no destino atrapalham a retomada.
+
+Uso:
+    python migrar.py --formato sqlite               # visitas.json -> visitas.db
+    python migrar.py --formato jsonl --lote 50000
+    python migrar.py --formato binario --pasta sites/blog --origem sites/blog/visitas.json
+    python migrar.py --formato sqlite --so-verificar
+    python migrar.py --origem restaurar.jsonl       # backup -> FORMATO_ARMAZENAMENTO
+"""
+
+import argparse
+import codecs
+import json
+import os
+import sys
+import time
+from collections import Counter
+
+import config
+from armazenamento import criar_armazenamento
+
+# Caracteres que o JSON aceita entre os elementos
+ESPACOS = ' \t\r\n'
+
+
+def ler_array_json(caminho, deslocamento=0, tamanho_bloco=1 << 20):
+    """
+    Lê um array JSON incrementalmente, em blocos de `tamanho_bloco`
+    bytes. Gera (elemento, byte logo após o elemento). Com
+    `deslocamento`, retoma logo após o elemento que termina nesse byte.
+    Lança ValueError se o arquivo não for um array JSON válido.
+    """
+    decodificador = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    texto = ''
+    posicao = 0
+    ascii = True
+    fim_do_arquivo = False
+
+    with open(caminho, 'rb') as f:
+        f.seek(deslocamento)
+        byte = deslocamento
+        estado = 'separador' if deslocamento else 'abertura'
+
+        def ler_bloco():
+            nonlocal texto, posicao, ascii, fim_do_arquivo
+            bloco = f.read(tamanho_bloco)
+            fim_do_arquivo = not bloco
+            texto = texto[posicao:] + utf8.decode(bloco, final=fim_do_arquivo)
+            posicao = 0
+            ascii = texto.isascii()
+
+        while True:
+            inicio = posicao
+            while posicao < len(texto) and texto[posicao] in ESPACOS:
+                posicao += 1
+            byte += posicao - inicio
+            if posicao == len(texto):
+                if fim_do_arquivo:
+                    raise ValueError(f"{caminho} termina antes do fim do array (byte {byte})")
+                ler_bloco()
+                continue
+
+            caractere = texto[posicao]
+            if estado == 'abertura':
+                if caractere != '[':
+                    raise ValueError(f"{caminho} não é um array JSON")
+                estado = 'primeiro'
+                posicao += 1
+                byte += 1
+            elif estado == 'separador':
+                if caractere == ']':
+                    return
+                if caractere != ',':
+                    raise ValueError(f"Esperado ',' ou ']' no byte {byte} de {caminho}")
+                estado = 'elemento'
+                posicao += 1
+                byte += 1
+            elif caractere == ']' and estado == 'primeiro':
+                return
+            else:
+                try:
+                    elemento, fim = decodificador.raw_decode(texto, posicao)
+                except json.JSONDecodeError:
+                    # Elemento cortado pelo fim do bloco: lê mais e tenta de novo
+                    if fim_do_arquivo:
+                        raise ValueError(f"JSON inválido no byte {byte} de {caminho}")
+                    ler_bloco()
+                    continue
+                seguinte = texto[fim:fim + 1]
+                if not fim_do_arquivo and seguinte not in tuple(',]' + ESPACOS) \
+                        and len(texto) - fim < 64:
+                    # Um número no fim do bloco pode continuar no próximo
+                    ler_bloco()
+                    continue
+                byte += (fim - posicao) if ascii else len(texto[posicao:fim].encode())
+                posicao = fim
+                estado = 'separador'
+                yield elemento, byte
+
+
+def ler_ndjson(caminho, deslocamento=0):
+    """
+    Lê um arquivo NDJSON linha a linha. Gera (elemento, byte logo após
+    a linha); com `deslocamento`, retoma a partir desse byte.
+    Lança ValueError se uma linha não for JSON válido.
+    """
+    with open(caminho, 'rb') as f:
+        f.seek(deslocamento)
+        byte = deslocamento
+        for linha in f:
+            byte += len(linha)
+            if not linha.strip():
+                continue
+            try:
+                elemento = json.loads(linha)
+            except ValueError:
+                raise ValueError(f"JSON inválido na linha que termina no byte {byte} de {caminho}")
+            yield elemento, byte
+
+
+def ler_visitas(caminho, deslocamento=0):
+    """
+    Lê as visitas de `caminho`, um array JSON (ler_array_json) ou NDJSON
+    (ler_ndjson), conforme o primeiro caractere do arquivo.
+    """
+    with open(caminho, 'rb') as f:
+        inicio = f.read(4096).lstrip()
+    if inicio.startswith(b'['):
+        return ler_array_json(caminho, deslocamento)
+    return ler_ndjson(caminho, deslocamento)
+
+
+def ler_ponto(arquivo):
+    """Ponto salvo da migração, ou None se ela ainda não começou."""
+    try:
+        with open(arquivo, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def salvar_ponto(arquivo, ponto):
+    """Grava o ponto da migração (via arquivo temporário e troca atômica)."""
+    with open(arquivo + '.tmp', 'w') as f:
+        json.dump(ponto, f, indent=2)
+    os.replace(arquivo + '.tmp', arquivo)
+
+
+def mostrar_progresso(ponto, tamanho, inicio, deslocamento_inicial):
+    """Uma linha de progresso, reescrita no lugar (stderr)."""
+    decorrido = max(time.monotonic() - inicio, 1e-9)
+    percentual = 100 * ponto['deslocamento'] / tamanho if tamanho else 100
+    velocidade = (ponto['deslocamento'] - deslocamento_inicial) / decorrido / 1e6
+    print(f"\r   {percentual:5.1f}%  {ponto['visitas']} visitas  "
+          f"{velocidade:.1f} MB/s",
+          end='', file=sys.stderr, flush=True)
+
+
+def migrar(armazenamento, origem, formato, tamanho_lote=10000):
+    """
+    Copia as visitas de `origem` (array JSON ou NDJSON) para `armazenamento`, em
+    lotes, retomando do ponto salvo se houver. Lança ValueError se o
+    destino já tiver visitas de outra origem ou se a origem mudou desde
+    o início da migração.
+    """
+    arquivo_ponto = armazenamento.arquivo + '.migracao'
+    estado = os.stat(origem)
+    identidade = {
+        'origem': os.path.abspath(origem),
+        'origem_tamanho': estado.st_size,
+        'origem_mtime_ns': estado.st_mtime_ns,
+        'formato': formato
+    }
+
+    ponto = ler_ponto(arquivo_ponto)
+    pular = 0
+    if ponto is None:
+        if armazenamento.fim() != 0:
+            raise ValueError(
+                f"{armazenamento.arquivo} já tem visitas: migre para um armazenamento vazio")
+        ponto = dict(identidade, deslocamento=0, visitas=0, cursor=0, concluida=False)
+    else:
+        if any(ponto.get(chave) != valor for chave, valor in identidade.items()):
+            raise ValueError(
+                f"{origem} mudou desde o início da migração; "
+                f"apague {arquivo_ponto} e o destino para recomeçar")
+        if ponto['concluida']:
+            print(f" Migração já concluída: {ponto['visitas']} visitas")
+            return ponto
+        # Lote gravado antes da interrupção, mas que não chegou ao ponto
+        pular = sum(1 for _ in armazenamento.ler_desde(ponto['cursor']))
+        print(f" Retomando no byte {ponto['deslocamento']} "
+              f"({ponto['visitas'] + pular} visitas já migradas)")
+
+    inicio = time.monotonic()
+    lote = []
+    deslocamento = deslocamento_inicial = ponto['deslocamento']
+
+    def gravar_lote():
+        _, _, cursor = armazenamento.gravar(lote)
+        ponto.update(deslocamento=deslocamento, cursor=cursor,
+                     visitas=ponto['visitas'] + len(lote))
+        salvar_ponto(arquivo_ponto, ponto)
+        lote.clear()
+        mostrar_progresso(ponto, estado.st_size, inicio, deslocamento_inicial)
+
+    for visita, deslocamento in ler_visitas(origem, ponto['deslocamento']):
+        if pular:
+            pular -= 1
+            ponto['visitas'] += 1
+            continue
+        lote.append(visita)
+        if len(lote) >= tamanho_lote:
+            gravar_lote()
+    if lote:
+        gravar_lote()
+
+    ponto['concluida'] = True
+    salvar_ponto(arquivo_ponto, ponto)
+    print(file=sys.stderr)
+    print(f" {ponto['visitas']} visitas migradas para {armazenamento.arquivo}")
+    return ponto
+
+
+def verificar(armazenamento, origem):
+    """
+    Compara as visitas por dia da origem (lida de novo, incrementalmente)
+    com as do destino. Retorna True se forem iguais.
+    """
+    na_origem = Counter(visita['tempo'][:10] for visita, _ in ler_visitas(origem))
+    no_destino = armazenamento.contagem_por_dia()
+    diferentes = sorted(dia for dia in set(na_origem) | set(no_destino)
+                        if na_origem.get(dia, 0) != no_destino.get(dia, 0))
+
+    total_origem = sum(na_origem.values())
+    total_destino = sum(no_destino.values())
+    print(f" Origem: {total_origem} visitas em {len(na_origem)} dias; "
+          f"destino: {total_destino} visitas em {len(no_destino)} dias")
+    for dia in diferentes[:20]:
+        print(f"   {dia}: origem {na_origem.get(dia, 0)}, destino {no_destino.get(dia, 0)}")
+    if len(diferentes) > 20:
+        print(f"   ... e mais {len(diferentes) - 20} dias")
+    if diferentes:
+        print(f" Verificação falhou: {len(diferentes)} dias com contagens diferentes")
+        return False
+    print(" Verificação ok: as visitas por dia conferem")
+    return True
+
+
+def ler_argumentos(argumentos=None):
+    parser = argparse.ArgumentParser(
+        description='Migra o arquivo legado visitas.json (ou um backup NDJSON) '
+                    'para um formato de armazenamento')
+    parser.add_argument('--origem', default=config.ARQUIVO_VISITAS,
+                        help='array JSON legado ou NDJSON (padrão: ARQUIVO_VISITAS)')
+    parser.add_argument('--formato', choices=['json', 'jsonl', 'sqlite', 'binario'],
+                        default=config.FORMATO_ARMAZENAMENTO,
+                        help='formato de destino (padrão: FORMATO_ARMAZENAMENTO)')
+    parser.add_argument('--pasta',
+                        help='pasta do destino, como PASTA_SITES/<site> (padrão: caminhos configurados)')
+    parser.add_argument('--lote', type=int, default=10000,
+                        help='visitas gravadas por lote')
+    parser.add_argument('--so-verificar', action='store_true',
+                        help='só compara as visitas por dia da origem e do destino')
+    return parser.parse_args(argumentos)
+
+
+def main(argumentos=None):
+    args = ler_argumentos(argumentos)
+    armazenamento = criar_armazenamento(args.formato, args.pasta, importar_legado=False)
+    try:
+        if os.path.abspath(args.origem) == os.path.abspath(armazenamento.arquivo):
+            raise ValueError(f"{args.origem} já é o armazenamento '{args.formato}'; "
+                             "informe outra --origem ou outro --formato")
+        if args.pasta:
+            os.makedirs(args.pasta, exist_ok=True)
+        armazenamento.preparar()
+        if not args.so_verificar:
+            migrar(armazenamento, args.origem, args.formato, args.lote)
+        return 0 if verificar(armazenamento, args.origem) else 1
+    except (OSError, ValueError) as e:
+        print(f"\n Erro na migração: {e}")
+        return 1
+    finally:
+        armazenamento.fechar()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
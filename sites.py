@@ -0,0 +1,1012 @@
+"""
+Sites atendidos pela API e o estado em memória de cada um
+
+Cada site tem seu próprio armazenamento, contadores, índice e travas,
+então a concorrência em um site movimentado não atrasa os demais.
+O site padrão (rotas /api/visitas/...) usa os arquivos configurados;
+os demais (rotas /api/sites/<site>/...) ficam em PASTA_SITES/<site>/,
+são carregados no primeiro acesso e descarregados quando ficam ociosos.
+"""
+
+import os
+import re
+import time
+from collections import namedtuple
+from contextlib import nullcontext
+from datetime import datetime, timedelta
+from itertools import chain
+from threading import Event, Lock, Thread
+
+import config
+from armazenamento import CursorInvalido, criar_armazenamento, trava_entre_processos
+from checkpoint import carregar_checkpoint, salvar_checkpoint
+from deduplicacao import JanelaDeduplicacao
+from exportacao import ExportacaoVisitas
+from estatisticas import (AgregadosDiarios, ContadorVisitas, HistogramaHorario,
+                          IndiceTemporal, MaisFrequentes, VisitantesUnicos,
+                          dia_atual, para_epoch)
+from metricas import TravaMedida, medir_operacao
+
+# Modelo de leitura de um site, republicado a cada alteração. É imutável:
+# os leitores pegam a referência atual sem travas e sempre veem total,
+# visitas e únicos do dia e do mês e sequência de um mesmo momento
+Instantaneo = namedtuple(
+    'Instantaneo',
+    'sequencia ultima_alteracao total dia visitas_dia unicos_dia unicos_mes')
+
+# Nomes de site aceitos: viram nomes de pasta, então nada de '/' ou '..'
+PADRAO_NOME_SITE = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+
+def validar_nome_site(nome):
+    """Lança ValueError se `nome` não for um nome de site válido."""
+    if not PADRAO_NOME_SITE.match(nome):
+        raise ValueError(
+            "Nome de site inválido: use até 64 letras, números, '-' ou '_'")
+    return nome
+
+
+class Site:
+    """
+    Estado de um site: armazenamento, fila do modo 'lote', contadores,
+    histograma, esboços de únicos e índice temporal, com as travas
+    que os protegem.
+    """
+
+    def __init__(self, nome, armazenamento, arquivo_unicos, arquivo_agregados,
+                 arquivo_checkpoint, pasta_exportacao, durabilidade, evento_descarga):
+        self.nome = nome
+        self.armazenamento = armazenamento
+        self.arquivo_unicos = arquivo_unicos
+        self.arquivo_agregados = arquivo_agregados
+        self.arquivo_checkpoint = arquivo_checkpoint
+
+        # 'imediata' (grava antes de responder) ou 'lote' (fila + gravação em segundo plano)
+        self.durabilidade = durabilidade
+
+        # Trava para evitar problemas de acesso concorrente ao arquivo
+        # (com espera e posse medidas em /metrics)
+        self.bloqueio = TravaMedida('bloqueio')
+
+        # Fila de visitas aguardando gravação no modo 'lote' (protegida por `bloqueio`)
+        self.fila_visitas = []
+
+        # Serializa as gravações e sincronizações deste processo, mantendo a ordem
+        # das visitas no armazenamento. Ordem de aquisição: bloqueio_gravacao -> bloqueio
+        self.bloqueio_gravacao = TravaMedida('bloqueio_gravacao')
+
+        # Posição no armazenamento até onde as estruturas em memória estão
+        # atualizadas, incluindo visitas gravadas por outros processos
+        self.cursor_sincronizado = 0
+
+        # Acorda a thread de descarga antes do intervalo quando o lote enche
+        self.evento_descarga = evento_descarga
+
+        # Total e visitas por dia mantidos em memória (atualizados a cada visita)
+        self.contador = ContadorVisitas()
+
+        # Visitas por hora, para o histórico servido por /api/visitas/historico
+        self.histograma = HistogramaHorario()
+
+        # Esboços HyperLogLog de visitantes únicos (IP + User-Agent) por dia e mês
+        self.unicos = VisitantesUnicos(config.UNICOS_PRECISAO)
+
+        # IPs e User-Agents mais frequentes por dia (Space-Saving, memória fixa)
+        self.frequentes = MaisFrequentes(config.TOP_CAPACIDADE,
+                                         config.TOP_DIAS_MANTIDOS)
+
+        # Instantes das visitas gravadas, ordenados, para consultas por intervalo
+        self.indice = IndiceTemporal()
+
+        # Resumo diário das visitas mais antigas que RETENCAO_DIAS, já
+        # apagadas do armazenamento, e a assinatura (inode, mtime) do
+        # arquivo de onde foi lido, para notar a retenção de outro processo
+        self.agregados = AgregadosDiarios(config.UNICOS_PRECISAO)
+        self.assinatura_agregados = None
+
+        # Cursor do último checkpoint gravado ou carregado (None: nenhum) e
+        # como foi a última carga do estado, para /api/status
+        self.cursor_checkpoint = None
+        self.estado_carga = None
+
+        # Segmentos selados da exportação, codificados uma vez e servidos do disco
+        self.exportacao = ExportacaoVisitas(pasta_exportacao,
+                                            config.EXPORTACAO_VISITAS_POR_SEGMENTO)
+
+        # Pares (IP, User-Agent) contabilizados recentemente, para não contar
+        # de novo um F5 repetido (None quando DEDUP_JANELA_SEGUNDOS é 0)
+        self.deduplicacao = None
+        if config.DEDUP_JANELA_SEGUNDOS > 0:
+            self.deduplicacao = JanelaDeduplicacao(
+                config.DEDUP_JANELA_SEGUNDOS, config.DEDUP_MAXIMO_PARES)
+
+        # Número de sequência que cresce a cada visita contabilizada e o
+        # instante (epoch) da última, para ETag/Last-Modified das respostas
+        self.sequencia = 0
+        self.ultima_alteracao = time.time()
+
+        # Instantâneo publicado para as leituras sem trava (ver `_publicar`)
+        self.instantaneo = None
+        self._publicar()
+
+        # Respostas prontas das rotas de leitura, {chave: entrada} (ver app.py)
+        self.cache_respostas = {}
+
+        # Abertura preguiçosa (no primeiro acesso) e descarga por ociosidade
+        self._bloqueio_abertura = Lock()
+        self.aberto = False
+        self.encerrado = False
+        self.ultimo_acesso = time.monotonic()
+        # Requisições em andamento que usam o site (ver RegistroSites.obter),
+        # protegido pela trava do registro: um site em uso não é descarregado
+        self.usos = 0
+
+    def abrir(self):
+        """
+        Prepara o armazenamento e monta o estado em memória,
+        uma única vez (chamadas seguintes não fazem nada).
+        """
+        with self._bloqueio_abertura:
+            if self.aberto:
+                return
+            pasta = os.path.dirname(self.arquivo_unicos)
+            if pasta:
+                os.makedirs(pasta, exist_ok=True)
+            self.armazenamento.preparar()
+            self.carregar_estado()
+            self.aberto = True
+
+    def encerrar(self):
+        """
+        Grava a fila pendente e persiste o checkpoint e os esboços de
+        únicos. Visitas que ainda chegarem (requisições em andamento)
+        passam a ser gravadas de imediato, mesmo no modo 'lote'.
+        """
+        with self.bloqueio:
+            self.encerrado = True
+        self.descarregar_fila()
+        self.salvar_checkpoint()
+
+    def fechar(self):
+        """Encerra o site e libera o armazenamento."""
+        with self._bloqueio_abertura:
+            if not self.aberto:
+                return
+            self.encerrar()
+            self.armazenamento.fechar()
+            self.aberto = False
+
+    def contabilizar_visita(self, visita):
+        """
+        Contabiliza uma visita nos contadores, no histograma, nos
+        esboços de únicos e nos mais frequentes. Deve ser chamada com
+        `bloqueio` adquirido; o chamador publica o novo instantâneo
+        depois do lote (`_publicar`).
+        """
+        self.contador.registrar(visita)
+        self.histograma.registrar(visita)
+        self.unicos.registrar(visita)
+        self.frequentes.registrar(visita)
+        self.sequencia += 1
+        self.ultima_alteracao = time.time()
+
+    def indexar_visitas(self, visitas, posicoes):
+        """
+        Inclui visitas já gravadas no índice temporal.
+        Deve ser chamada com `bloqueio` adquirido.
+        """
+        for visita, posicao in zip(visitas, posicoes):
+            self.indice.adicionar(para_epoch(visita['tempo']), posicao)
+
+    def aplicar_alheias(self, alheias):
+        """
+        Aplica às estruturas em memória as visitas [(posição, visita)]
+        gravadas por outros processos. Deve ser chamada com `bloqueio`
+        adquirido.
+        """
+        for posicao, visita in alheias:
+            self.contabilizar_visita(visita)
+            self.indice.adicionar(para_epoch(visita['tempo']), posicao)
+        if alheias:
+            self._publicar()
+
+    def _publicar(self):
+        """
+        Monta um novo instantâneo a partir dos contadores e o publica
+        trocando a referência (atômico: nenhum leitor vê um instantâneo
+        pela metade). Deve ser chamada com `bloqueio` adquirido.
+        """
+        dia = dia_atual()
+        self.instantaneo = Instantaneo(
+            self.sequencia, self.ultima_alteracao, self.contador.total,
+            dia, self.contador.visitas_no_dia(dia),
+            self.unicos.unicos_no_dia(dia), self.unicos.unicos_no_mes(dia[:7]))
+
+    def instantaneo_atual(self):
+        """
+        Retorna o instantâneo publicado, sem adquirir travas nem consultar
+        o armazenamento. As visitas de outros processos entram nele pela
+        sincronização periódica da thread de manutenção (ver
+        RegistroSites.sincronizar_sites) ou na próxima gravação deste
+        processo. Só na virada do dia (sem visitas desde então) ele é
+        republicado sob a trava.
+        """
+        instantaneo = self.instantaneo
+        if instantaneo.dia != dia_atual():
+            with self.bloqueio:
+                self._publicar()
+                instantaneo = self.instantaneo
+        return instantaneo
+
+    def gravar_visitas(self, novas, da_fila=False):
+        """
+        Grava um lote de visitas no armazenamento e o inclui no índice
+        temporal. Nos backends 'jsonl', 'sqlite' e 'binario' o lote é gravado sem
+        reescrever as visitas anteriores.
+        A gravação acontece sob a trava entre processos; as visitas que
+        outros processos gravaram desde a última sincronização chegam
+        junto e também são aplicadas. Com `da_fila`, o lote sai da fila
+        do modo 'lote' (onde já foi contabilizado) no mesmo passo em que
+        entra no índice; senão, só é contabilizado depois de gravado, então
+        uma falha na gravação não deixa nos contadores visitas que não
+        existem no armazenamento.
+        Deve ser chamada com `bloqueio_gravacao` adquirido.
+        Retorna a posição de cada visita no armazenamento.
+        """
+        with self.trava_retencao():
+            self._verificar_retencao()
+            with medir_operacao('gravar'):
+                posicoes, alheias, fim = self.armazenamento.gravar(
+                    novas, self.cursor_sincronizado)
+        with self.bloqueio:
+            if da_fila:
+                del self.fila_visitas[:len(novas)]
+            self.aplicar_alheias(alheias)
+            if not da_fila:
+                for visita in novas:
+                    self.contabilizar_visita(visita)
+                self._publicar()
+            self.indexar_visitas(novas, posicoes)
+            self.cursor_sincronizado = fim
+        return posicoes
+
+    def sincronizar(self):
+        """
+        Aplica às estruturas em memória as visitas gravadas por outros
+        processos (vários workers do gunicorn, por exemplo) desde a última
+        gravação ou sincronização. Quando nada mudou, custa só a consulta
+        ao fim do armazenamento (tamanho do log ou último id) e, com a
+        retenção ligada, um stat do arquivo de agregados.
+        """
+        if self.armazenamento.fim() == self.cursor_sincronizado and \
+                not self._retencao_alheia():
+            return
+        with self.bloqueio_gravacao, self.trava_retencao():
+            if self._verificar_retencao():
+                return
+            alheias = []
+            cursor = self.cursor_sincronizado
+            with medir_operacao('sincronizar'):
+                for posicao, cursor, visita in self.armazenamento.ler_desde(cursor):
+                    alheias.append((posicao, visita))
+            with self.bloqueio:
+                self.aplicar_alheias(alheias)
+                self.cursor_sincronizado = cursor
+
+    def adicionar_visita(self, ip, user_agent):
+        """
+        Adiciona uma nova visita com IP e user agent,
+        registrando a data e hora atual no formato ISO.
+        A operação é protegida com um bloqueio para evitar
+        acessos simultâneos conflitantes.
+        No modo de durabilidade 'imediata' a visita só é contabilizada
+        depois de gravada. No modo 'lote' ela só entra na fila (já
+        contabilizada); a gravação fica a cargo da thread de descarga.
+        Com a deduplicação ligada, um par (IP, User-Agent) repetido
+        dentro da janela não é contabilizado nem gravado.
+        Retorna False se a visita foi suprimida como repetida.
+        """
+        if self.deduplicacao is not None and \
+                self.deduplicacao.repetida((ip, user_agent)):
+            return False
+
+        if self.durabilidade == 'lote':
+            with self.bloqueio:
+                if not self.encerrado:
+                    visita = {
+                        'tempo': datetime.now().isoformat(),
+                        'ip': ip,
+                        'user_agent': user_agent
+                    }
+                    self.contabilizar_visita(visita)
+                    self._publicar()
+                    self.fila_visitas.append(visita)
+                    if len(self.fila_visitas) >= config.LOTE_TAMANHO_MAXIMO:
+                        self.evento_descarga.set()
+                    return True
+
+        with self.bloqueio_gravacao:
+            visita = {
+                'tempo': datetime.now().isoformat(),
+                'ip': ip,
+                'user_agent': user_agent
+            }
+            try:
+                self.gravar_visitas([visita])
+            except Exception:
+                # Não gravada: uma nova tentativa não deve ser suprimida
+                if self.deduplicacao is not None:
+                    self.deduplicacao.esquecer((ip, user_agent))
+                raise
+        return True
+
+    def adicionar_visitas(self, visitas):
+        """
+        Registra um lote de visitas já validadas (com 'tempo' próprio),
+        como as encaminhadas pela borda/CDN. O lote é gravado em uma
+        única operação sob as travas, em qualquer modo de durabilidade,
+        e contabilizado de uma vez depois de gravado.
+        """
+        if not visitas:
+            return
+        with self.bloqueio_gravacao:
+            self.gravar_visitas(visitas)
+
+    def descarregar_fila(self):
+        """
+        Grava no armazenamento todas as visitas pendentes na fila.
+        O lote é copiado sob o bloqueio principal, mas a escrita em disco
+        acontece fora dele, sem atrasar novos registros. As visitas só
+        saem da fila (e entram no índice) depois de gravadas.
+        """
+        with self.bloqueio_gravacao:
+            with self.bloqueio:
+                lote = self.fila_visitas[:]
+            if not lote:
+                return
+            self.gravar_visitas(lote, da_fila=True)
+
+    def estado_durabilidade(self):
+        """Descreve o modo de durabilidade e o tamanho atual da fila."""
+        with self.bloqueio:
+            pendentes = len(self.fila_visitas)
+        estado = {
+            'modo': self.durabilidade,
+            'pendentes': pendentes
+        }
+        if self.durabilidade == 'lote':
+            estado['lote_tamanho_maximo'] = config.LOTE_TAMANHO_MAXIMO
+            estado['lote_intervalo_segundos'] = config.LOTE_INTERVALO_SEGUNDOS
+        return estado
+
+    def carregar_estado(self):
+        """
+        Monta em memória os contadores, o histograma por hora, o índice
+        temporal e os esboços de visitantes únicos em uma única passagem
+        pelo armazenamento. Os esboços salvos em `arquivo_unicos` só
+        recebem as visitas posteriores ao cursor que já cobrem; se não
+        houver arquivo compatível, são recalculados desde o início.
+        Os dias anteriores ao corte da retenção vêm dos agregados.
+        """
+        with self.bloqueio_gravacao, self.trava_retencao(), self.bloqueio, \
+                medir_operacao('carregar'):
+            self._montar_estado()
+
+    def _montar_estado(self):
+        """
+        Remonta do zero as estruturas em memória: agregados da retenção,
+        checkpoint (se ainda valer) e visitas do armazenamento depois
+        dele, e as visitas já contabilizadas que ainda não foram gravadas
+        (a fila do modo 'lote').
+        Deve ser chamada com `bloqueio_gravacao`, a trava da retenção e
+        `bloqueio` adquiridos.
+        """
+        inicio = time.monotonic()
+        self.assinatura_agregados = self._assinatura_agregados()
+        agregados = AgregadosDiarios(config.UNICOS_PRECISAO)
+        agregados.carregar(self.arquivo_agregados)
+        checkpoint = self._ler_checkpoint(agregados)
+        try:
+            estado = self._ler_armazenamento(agregados, checkpoint)
+        except CursorInvalido:
+            # O armazenamento não é mais o do checkpoint ou dos únicos
+            # salvos (restaurado de um backup, por exemplo)
+            checkpoint = None
+            estado = self._ler_armazenamento(agregados, None, recalcular_unicos=True)
+        contador, histograma, unicos, frequentes, indice, cursor, relidas = estado
+
+        for visita in self.fila_visitas:
+            contador.registrar(visita)
+            histograma.registrar(visita)
+            unicos.registrar(visita)
+            frequentes.registrar(visita)
+
+        self.agregados = agregados
+        self.contador = contador
+        self.histograma = histograma
+        self.unicos = unicos
+        self.frequentes = frequentes
+        self.indice = indice
+        self.cursor_sincronizado = cursor
+        self.cursor_checkpoint = checkpoint[0]['cursor'] if checkpoint else None
+        self.estado_carga = {
+            'checkpoint': checkpoint is not None,
+            'visitas_relidas': relidas,
+            'segundos': round(time.monotonic() - inicio, 3)
+        }
+        # A sequência nunca volta atrás, para não repetir um ETag já servido
+        self.sequencia = max(self.sequencia, contador.total)
+        self.ultima_alteracao = time.time()
+        self._publicar()
+
+    def _ler_checkpoint(self, agregados):
+        """
+        Lê o checkpoint do site se ele ainda valer para o armazenamento:
+        mesmo formato, mesma geração da retenção e mesma configuração dos
+        mais frequentes, cursor dentro do armazenamento e a última visita
+        do índice ainda na mesma posição. Senão, retorna None.
+        """
+        if not config.CHECKPOINT_INTERVALO_SEGUNDOS:
+            return None
+        checkpoint = carregar_checkpoint(self.arquivo_checkpoint)
+        if checkpoint is None:
+            return None
+        cabecalho, tempos, posicoes = checkpoint
+        if cabecalho['formato'] != self.armazenamento.nome or \
+                cabecalho['geracao'] != agregados.geracao or \
+                cabecalho['frequentes'] is None or \
+                cabecalho['top'] != [config.TOP_CAPACIDADE, config.TOP_DIAS_MANTIDOS] or \
+                cabecalho['cursor'] > self.armazenamento.fim():
+            return None
+        if posicoes:
+            try:
+                visitas = self.armazenamento.obter([posicoes[-1]])
+            except (ValueError, KeyError):
+                return None
+            if not visitas or para_epoch(visitas[0]['tempo']) != tempos[-1]:
+                return None
+        return checkpoint
+
+    def _ler_armazenamento(self, agregados, checkpoint, recalcular_unicos=False):
+        """
+        Monta contadores, histograma, únicos, mais frequentes e índice a
+        partir dos agregados e do checkpoint (se houver), lendo do
+        armazenamento só as visitas que eles ainda não cobrem. Retorna
+        (contador, histograma, únicos, frequentes, índice, cursor final,
+        visitas lidas).
+        """
+        contador = ContadorVisitas()
+        histograma = HistogramaHorario()
+        unicos = VisitantesUnicos(config.UNICOS_PRECISAO)
+        frequentes = MaisFrequentes(config.TOP_CAPACIDADE, config.TOP_DIAS_MANTIDOS)
+        indice = IndiceTemporal()
+
+        desde = 0
+        if checkpoint is not None:
+            # O checkpoint já inclui os agregados
+            cabecalho, indice.tempos, indice.posicoes = checkpoint
+            contador.total = cabecalho['total']
+            contador.por_dia = cabecalho['por_dia']
+            histograma.por_hora = cabecalho['por_hora']
+            frequentes.importar(cabecalho['frequentes'])
+            desde = cabecalho['cursor']
+        else:
+            for dia, dados in agregados.dias.items():
+                contador.incluir_dia(dia, dados['visitas'])
+                for hora, visitas in dados['por_hora'].items():
+                    histograma.incluir_hora(f'{dia}T{hora}', visitas)
+
+        unicos_desde = None
+        if not recalcular_unicos:
+            unicos_desde = unicos.carregar(self.arquivo_unicos, agregados.geracao)
+        if unicos_desde is None or unicos_desde > self.armazenamento.fim():
+            unicos.recalcular([])
+            unicos_desde = 0
+        for dia, dados in agregados.dias.items():
+            # Mesclar um esboço que já está nos únicos salvos não muda nada
+            unicos.incluir_dia(dia, dados['unicos'])
+
+        cursor = min(desde, unicos_desde)
+        lidas = 0
+        for posicao, cursor, visita in self.armazenamento.ler_desde(cursor):
+            lidas += 1
+            # Visita de um dia já agregado, gravada antes de a retenção
+            # ser interrompida: os agregados já a contam
+            if agregados.agregada(visita):
+                continue
+            if posicao >= desde:
+                contador.registrar(visita)
+                histograma.registrar(visita)
+                frequentes.registrar(visita)
+                indice.adicionar(para_epoch(visita['tempo']), posicao)
+            if posicao >= unicos_desde:
+                unicos.registrar(visita)
+        return contador, histograma, unicos, frequentes, indice, cursor, lidas
+
+    def salvar_checkpoint(self):
+        """
+        Grava o checkpoint do estado em memória e os esboços de únicos,
+        se algo foi gravado desde o último. O estado só pode cobrir
+        visitas já gravadas: a fila do modo 'lote' é descarregada antes
+        e, se novas visitas entrarem nela nesse meio tempo, o checkpoint
+        fica para a próxima vez. Retorna True se gravou.
+        """
+        if not config.CHECKPOINT_INTERVALO_SEGUNDOS:
+            self.salvar_unicos()
+            return False
+        self.descarregar_fila()
+        with self.bloqueio_gravacao, self.bloqueio:
+            cursor = self.cursor_sincronizado
+            if self.fila_visitas or cursor == self.cursor_checkpoint:
+                return False
+            cabecalho = {
+                'formato': self.armazenamento.nome,
+                'geracao': self.agregados.geracao,
+                'cursor': cursor,
+                'top': [config.TOP_CAPACIDADE, config.TOP_DIAS_MANTIDOS],
+                'total': self.contador.total,
+                'por_dia': dict(self.contador.por_dia),
+                'por_hora': dict(self.histograma.por_hora),
+                'frequentes': self.frequentes.exportar()
+            }
+            tempos, posicoes = self.indice.copiar()
+            self.unicos.salvar(self.arquivo_unicos, cursor, self.agregados.geracao)
+        # A escrita do arquivo (o índice pode ser grande) fica fora das travas
+        with medir_operacao('checkpoint'):
+            salvar_checkpoint(self.arquivo_checkpoint, cabecalho, tempos, posicoes)
+        self.cursor_checkpoint = cursor
+        return True
+
+    def trava_retencao(self, exclusiva=False):
+        """
+        Trava entre processos da retenção: compartilhada para gravar e
+        sincronizar, exclusiva enquanto a retenção reescreve o
+        armazenamento. Sem retenção configurada, não trava nada.
+        """
+        if not config.RETENCAO_DIAS:
+            return nullcontext()
+        return trava_entre_processos(self.arquivo_agregados, exclusiva)
+
+    def _assinatura_agregados(self):
+        try:
+            estado = os.stat(self.arquivo_agregados)
+        except FileNotFoundError:
+            return None
+        return estado.st_ino, estado.st_mtime_ns
+
+    def _retencao_alheia(self):
+        """Verdadeiro se outro processo aplicou a retenção desde a última carga."""
+        return bool(config.RETENCAO_DIAS) and \
+            self._assinatura_agregados() != self.assinatura_agregados
+
+    def _verificar_retencao(self):
+        """
+        Se outro processo aplicou a retenção, as posições no armazenamento
+        mudaram: remonta o estado e retorna True. Deve ser chamada com
+        `bloqueio_gravacao` e a trava da retenção adquiridos.
+        """
+        if not self._retencao_alheia():
+            return False
+        with self.bloqueio, medir_operacao('carregar'):
+            self._montar_estado()
+        return True
+
+    def aplicar_retencao(self):
+        """
+        Resume em agregados diários as visitas de antes de RETENCAO_DIAS
+        dias atrás e as apaga do armazenamento. Os agregados são gravados
+        antes do descarte: se o processo cair no meio, as visitas que
+        sobrarem de dias agregados são ignoradas na carga. Entre
+        processos, só um aplica cada corte. Retorna quantas visitas
+        foram agregadas.
+        """
+        if not config.RETENCAO_DIAS:
+            return 0
+        hoje = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        corte = (hoje - timedelta(days=config.RETENCAO_DIAS)).strftime('%Y-%m-%d')
+        if self.agregados.corte is not None and corte <= self.agregados.corte:
+            return 0
+
+        self.descarregar_fila()
+        agregadas = 0
+        with self.bloqueio_gravacao, self.trava_retencao(exclusiva=True), \
+                medir_operacao('reter'):
+            agregados = AgregadosDiarios(config.UNICOS_PRECISAO)
+            agregados.carregar(self.arquivo_agregados)
+            # Outro processo pode ter aplicado este corte enquanto esperávamos
+            if agregados.corte is None or corte > agregados.corte:
+                agregadas = agregados.agregar(
+                    (visita for _, _, visita in self.armazenamento.ler_desde(0)),
+                    corte, config.RETENCAO_TOP_USER_AGENTS, config.TOP_CAPACIDADE)
+                agregados.salvar(self.arquivo_agregados)
+                self.armazenamento.descartar_anteriores(corte)
+            with self.bloqueio:
+                self._montar_estado()
+        self.salvar_unicos()
+        return agregadas
+
+    def estado_retencao(self):
+        """Resumo da retenção para /api/status (None se desligada)."""
+        if not config.RETENCAO_DIAS:
+            return None
+        with self.bloqueio:
+            return {
+                'dias': config.RETENCAO_DIAS,
+                'corte': self.agregados.corte,
+                'dias_agregados': len(self.agregados.dias),
+                'visitas_agregadas': sum(
+                    dados['visitas'] for dados in self.agregados.dias.values())
+            }
+
+    def versao(self):
+        """
+        Retorna (sequência, instante da última alteração) do instantâneo
+        publicado, sem travas.
+        """
+        instantaneo = self.instantaneo_atual()
+        return instantaneo.sequencia, instantaneo.ultima_alteracao
+
+    def salvar_unicos(self):
+        """Persiste os esboços de visitantes únicos em `arquivo_unicos`."""
+        with self.bloqueio:
+            self.unicos.salvar(self.arquivo_unicos, self.cursor_sincronizado,
+                               self.agregados.geracao)
+
+    def contar_unicos(self, inicio, fim):
+        """
+        Estima os visitantes únicos (IP + User-Agent) entre as datas
+        `inicio` e `fim` (inclusivo). Mês corrente e dia atual vêm
+        direto dos esboços mantidos a cada visita.
+        """
+        self.sincronizar()
+        with self.bloqueio:
+            return self.unicos.unicos_no_periodo(inicio, fim)
+
+    def contar_unicos_hoje(self):
+        """
+        Estima os visitantes únicos do dia atual,
+        lendo o instantâneo publicado (sem travas).
+        """
+        return self.instantaneo_atual().unicos_dia
+
+    def contar_unicos_mes(self):
+        """
+        Estima os visitantes únicos do mês atual,
+        lendo o instantâneo publicado (sem travas).
+        """
+        return self.instantaneo_atual().unicos_mes
+
+    def obter_mais_frequentes(self, campo, n, dia=None):
+        """
+        Retorna (itens, exato) com os `n` valores de `campo` ('ip' ou
+        'user_agent') mais frequentes no dia (padrão: hoje), como
+        [(valor, visitas, erro máximo)]. Dos dias já agregados pela
+        retenção só restam os User-Agents mais frequentes.
+        """
+        self.sincronizar()
+        dia = dia or datetime.now().strftime('%Y-%m-%d')
+        with self.bloqueio:
+            if self.agregados.corte is not None and dia < self.agregados.corte \
+                    and campo in MaisFrequentes.CAMPOS:
+                if campo != 'user_agent':
+                    raise ValueError(
+                        "Dias anteriores à retenção só guardam 'user_agent'")
+                dados = self.agregados.dias.get(dia)
+                if dados is None:
+                    return [], True
+                itens = [tuple(item) for item in dados['user_agents'][:n]]
+                return itens, all(erro == 0 for _, _, erro in itens)
+            return self.frequentes.mais_frequentes(dia, campo, n)
+
+    def contar_visitas_hoje(self):
+        """
+        Conta quantas visitas foram feitas no dia atual,
+        lendo o instantâneo publicado (sem travas).
+        """
+        return self.instantaneo_atual().visitas_dia
+
+    def contar_visitas_no_dia(self, dia):
+        """
+        Conta as visitas de um dia qualquer (AAAA-MM-DD),
+        consultando o contador por dia em memória.
+        """
+        self.sincronizar()
+        with self.bloqueio:
+            return self.contador.visitas_no_dia(dia)
+
+    def contar_visitas_intervalo(self, inicio, fim):
+        """
+        Conta as visitas com inicio <= tempo < fim (datetime),
+        em O(log n) pelo índice temporal. Visitas ainda na fila
+        do modo 'lote' são somadas à parte, e as de dias já agregados
+        pela retenção vêm dos agregados, com resolução de uma hora.
+        """
+        self.sincronizar()
+        with self.bloqueio:
+            total = self.agregados.contar(inicio, fim)
+            inicio, fim = inicio.timestamp(), fim.timestamp()
+            total += self.indice.contar(inicio, fim)
+            total += sum(1 for visita in self.fila_visitas
+                         if inicio <= para_epoch(visita['tempo']) < fim)
+        return total
+
+    def listar_visitas_intervalo(self, inicio, fim, limite):
+        """
+        Retorna até `limite` visitas com inicio <= tempo < fim (datetime),
+        em ordem de tempo. O índice fornece as posições e só essas
+        visitas são lidas do armazenamento.
+        """
+        self.sincronizar()
+        self.descarregar_fila()
+        with self.bloqueio:
+            posicoes = self.indice.posicoes_intervalo(
+                inicio.timestamp(), fim.timestamp(), limite)
+        return self.armazenamento.obter(posicoes)
+
+    def obter_historico(self, granularidade, dias):
+        """
+        Retorna [(período, visitas)] dos últimos `dias` dias,
+        por hora ('hora') ou por dia ('dia'), a partir dos agregados
+        em memória: o custo é proporcional ao número de baldes.
+        """
+        self.sincronizar()
+        agora = datetime.now()
+        hoje = agora.replace(hour=0, minute=0, second=0, microsecond=0)
+        inicio = hoje - timedelta(days=dias - 1)
+        with self.bloqueio:
+            if granularidade == 'dia':
+                return self.contador.serie(inicio, hoje)
+            return self.histograma.serie(inicio, agora)
+
+    def contar_total_visitas(self):
+        """
+        Conta o total de visitas registradas,
+        lendo o instantâneo publicado (sem travas).
+        """
+        return self.instantaneo_atual().total
+
+    def paginar_visitas(self, cursor, limite):
+        """
+        Retorna até `limite` visitas a partir do cursor e o cursor
+        da próxima página. O cursor 0 aponta para a primeira visita.
+        """
+        self.descarregar_fila()
+        return self.armazenamento.paginar(cursor, limite)
+
+    def exportar(self, formato, compressao=None, numero=None):
+        """
+        Prepara a exportação das visitas em `formato`: sela os segmentos
+        que se completaram e garante o arquivo de cada um (ou só o do
+        segmento `numero`) já codificado. Retorna (segmentos, arquivos,
+        cursor do segmento ativo); `arquivos` acompanha `segmentos`,
+        com None nos que não foram pedidos.
+        A trava da retenção fica compartilhada enquanto os segmentos são
+        lidos do armazenamento, para que as posições não mudem no meio.
+        """
+        self.descarregar_fila()
+        while True:
+            self.sincronizar()
+            with self.trava_retencao():
+                if self._retencao_alheia():
+                    # Retenção aplicada por outro processo agora há pouco
+                    continue
+                with self.bloqueio:
+                    geracao = self.agregados.geracao
+                with medir_operacao('exportar'):
+                    segmentos, cursor = self.exportacao.atualizar(
+                        self.armazenamento, geracao)
+                    arquivos = [
+                        self.exportacao.preparar_arquivo(
+                            self.armazenamento, i, segmento, formato, compressao)
+                        if numero is None or i == numero else None
+                        for i, segmento in enumerate(segmentos)]
+                return segmentos, arquivos, cursor
+
+    def iterar_visitas(self, cursor=0):
+        """
+        Retorna um gerador das visitas a partir do cursor,
+        lidas do armazenamento página a página.
+        Um cursor inválido é detectado já nesta chamada.
+        """
+        self.descarregar_fila()
+        visitas = self.armazenamento.iterar(cursor)
+        primeira = next(visitas, None)
+        if primeira is None:
+            return iter(())
+        return chain([primeira], visitas)
+
+
+class RegistroSites:
+    """
+    Sites carregados neste processo. O site padrão é aberto em segundo
+    plano logo na inicialização (ou no primeiro acesso, se vier antes) e
+    nunca é descarregado; os demais são abertos no primeiro acesso e
+    descarregados (fila gravada, esboços salvos, armazenamento fechado)
+    após SITES_OCIOSIDADE_SEGUNDOS sem acesso e sem requisições em
+    andamento. A trava do registro só protege o dicionário de sites e as
+    contagens de uso: abrir um site não bloqueia os outros.
+    """
+
+    def __init__(self, formato, durabilidade):
+        self.formato = formato
+        self.durabilidade = durabilidade
+        self._bloqueio = Lock()
+        self._sites = {}
+
+        # Compartilhado pelos sites: qualquer lote cheio acorda a descarga
+        self.evento_descarga = Event()
+
+        # Aberto em segundo plano pela thread de manutenção (ver `pronto`)
+        # ou pelo primeiro acesso, o que vier antes
+        self.padrao = Site(None, criar_armazenamento(formato),
+                           config.ARQUIVO_UNICOS, config.ARQUIVO_AGREGADOS,
+                           config.ARQUIVO_CHECKPOINT, config.PASTA_EXPORTACAO,
+                           durabilidade, self.evento_descarga)
+
+    def _criar_site(self, nome):
+        pasta = os.path.join(config.PASTA_SITES, nome)
+        arquivo_unicos = os.path.join(
+            pasta, os.path.basename(config.ARQUIVO_UNICOS))
+        arquivo_agregados = os.path.join(
+            pasta, os.path.basename(config.ARQUIVO_AGREGADOS))
+        arquivo_checkpoint = os.path.join(
+            pasta, os.path.basename(config.ARQUIVO_CHECKPOINT))
+        pasta_exportacao = os.path.join(
+            pasta, os.path.basename(config.PASTA_EXPORTACAO))
+        return Site(nome, criar_armazenamento(self.formato, pasta),
+                    arquivo_unicos, arquivo_agregados, arquivo_checkpoint,
+                    pasta_exportacao, self.durabilidade, self.evento_descarga)
+
+    def obter(self, nome=None, em_uso=False):
+        """
+        Retorna o site `nome` (o padrão se for None), abrindo-o
+        no primeiro acesso. Lança ValueError se o nome for inválido.
+        Com `em_uso`, o site fica marcado como usado por uma requisição
+        até `liberar(site)` e não é descarregado nesse meio tempo (o
+        padrão nunca é descarregado e não é contado).
+        """
+        if nome is None:
+            if not self.padrao.aberto:
+                self.padrao.abrir()
+            return self.padrao
+        validar_nome_site(nome)
+        with self._bloqueio:
+            site = self._sites.get(nome)
+            if site is None:
+                site = self._sites[nome] = self._criar_site(nome)
+            site.ultimo_acesso = time.monotonic()
+            if em_uso:
+                site.usos += 1
+        try:
+            site.abrir()
+        except Exception:
+            if em_uso:
+                self.liberar(site)
+            raise
+        return site
+
+    def liberar(self, site):
+        """Encerra um uso de `site` marcado por `obter(..., em_uso=True)`."""
+        if site is self.padrao:
+            return
+        with self._bloqueio:
+            site.usos -= 1
+            site.ultimo_acesso = time.monotonic()
+
+    def pronto(self):
+        """Verdadeiro quando o site padrão já está carregado em memória."""
+        return self.padrao.aberto
+
+    def carregados(self):
+        """Lista os sites atualmente em memória, incluindo o padrão."""
+        with self._bloqueio:
+            return [self.padrao] + list(self._sites.values())
+
+    def descarregar_filas(self):
+        """Grava a fila do modo 'lote' de todos os sites carregados."""
+        for site in self.carregados():
+            if site.aberto:
+                site.descarregar_fila()
+
+    def aplicar_retencao(self):
+        """Aplica a retenção a todos os sites carregados."""
+        for site in self.carregados():
+            if site.aberto:
+                site.aplicar_retencao()
+
+    def sincronizar_sites(self):
+        """
+        Aplica aos sites carregados as visitas gravadas por outros
+        processos, mantendo atualizados os instantâneos lidos sem trava.
+        """
+        for site in self.carregados():
+            if site.aberto:
+                site.sincronizar()
+
+    def salvar_checkpoints(self):
+        """Grava o checkpoint de todos os sites carregados."""
+        for site in self.carregados():
+            if site.aberto:
+                site.salvar_checkpoint()
+
+    def remover_ociosos(self):
+        """
+        Descarrega da memória os sites sem acesso há mais de
+        SITES_OCIOSIDADE_SEGUNDOS e sem requisições em andamento, e
+        fecha seus armazenamentos (conexão SQLite, descritores de
+        arquivo). Como a remoção do dicionário e a contagem de usos
+        acontecem sob a mesma trava, nenhuma requisição chega a um site
+        removido; o próximo acesso carrega o site de novo.
+        """
+        limite = time.monotonic() - config.SITES_OCIOSIDADE_SEGUNDOS
+        with self._bloqueio:
+            ociosos = [nome for nome, site in self._sites.items()
+                       if site.ultimo_acesso < limite and not site.usos]
+            removidos = [self._sites.pop(nome) for nome in ociosos]
+        for site in removidos:
+            site.fechar()
+        return len(removidos)
+
+    def executar_manutencao(self):
+        """
+        Laço da thread de manutenção: no modo 'lote', grava as filas
+        a cada LOTE_INTERVALO_SEGUNDOS ou assim que algum lote atinge
+        LOTE_TAMANHO_MAXIMO visitas; a cada SINCRONIZACAO_INTERVALO_SEGUNDOS,
+        aplica as visitas gravadas por outros processos; a cada
+        SITES_VERIFICACAO_SEGUNDOS,
+        descarrega os sites ociosos e aplica a retenção (que só trabalha
+        quando o dia de corte avança); a cada CHECKPOINT_INTERVALO_SEGUNDOS,
+        grava os checkpoints. Antes de tudo, carrega o site padrão.
+        """
+        try:
+            self.padrao.abrir()
+        except Exception as e:
+            print(f" Erro ao carregar o site padrão: {e}")
+
+        if self.durabilidade == 'lote':
+            intervalo = config.LOTE_INTERVALO_SEGUNDOS
+        else:
+            intervalo = config.SITES_VERIFICACAO_SEGUNDOS
+        if config.CHECKPOINT_INTERVALO_SEGUNDOS:
+            intervalo = min(intervalo, config.CHECKPOINT_INTERVALO_SEGUNDOS)
+        if config.SINCRONIZACAO_INTERVALO_SEGUNDOS:
+            intervalo = min(intervalo, config.SINCRONIZACAO_INTERVALO_SEGUNDOS)
+        proxima_verificacao = time.monotonic() + config.SITES_VERIFICACAO_SEGUNDOS
+        proximo_checkpoint = time.monotonic() + config.CHECKPOINT_INTERVALO_SEGUNDOS
+        while True:
+            self.evento_descarga.wait(intervalo)
+            self.evento_descarga.clear()
+            try:
+                if self.durabilidade == 'lote':
+                    self.descarregar_filas()
+                if config.SINCRONIZACAO_INTERVALO_SEGUNDOS:
+                    self.sincronizar_sites()
+                if time.monotonic() >= proxima_verificacao:
+                    self.remover_ociosos()
+                    self.aplicar_retencao()
+                    proxima_verificacao = (time.monotonic() +
+                                           config.SITES_VERIFICACAO_SEGUNDOS)
+                if config.CHECKPOINT_INTERVALO_SEGUNDOS and \
+                        time.monotonic() >= proximo_checkpoint:
+                    self.salvar_checkpoints()
+                    proximo_checkpoint = (time.monotonic() +
+                                          config.CHECKPOINT_INTERVALO_SEGUNDOS)
+            except Exception as e:
+                print(f" Erro na manutenção dos sites: {e}")
+
+    def iniciar_manutencao(self):
+        """
+        Inicia a thread de manutenção (carga do site padrão, descarga das
+        filas e dos sites ociosos, sincronização entre processos, retenção
+        e checkpoints).
+        """
+        Thread(target=self.executar_manutencao, daemon=True).start()
+
+    def fechar_todos(self):
+        """Encerra todos os sites carregados, no encerramento do processo."""
+        with self._bloqueio:
+            sites = list(self._sites.values())
+            self._sites.clear()
+        for site in [self.padrao] + sites:
+            if site.aberto:
+                site.fechar()
@@ -5,6 +5,7 @@ Testes básicos para a API do Contador de Visitas
 
 import requests
 import json
+import os
 import time
 from datetime import datetime
 
@@ -101,10 +102,65 @@ def executar_testes():
             'metodo': 'POST',
             'endpoint': '/api/visitas/registrar'
         },
+        {
+            'nome': 'Registrar visitas em lote',
+            'metodo': 'POST',
+            'endpoint': '/api/visitas/registrar/lote',
+            'dados': [
+                {'tempo': datetime.now().isoformat(), 'ip': '203.0.113.7', 'user_agent': 'teste'},
+                {'tempo': datetime.now().isoformat(), 'ip': '198.51.100.4', 'user_agent': 'teste'}
+            ]
+        },
         {
             'nome': 'Todas as visitas',
             'metodo': 'GET',
             'endpoint': '/api/visitas/todas'
+        },
+        {
+            'nome': 'Todas as visitas (paginado)',
+            'metodo': 'GET',
+            'endpoint': '/api/visitas/todas',
+            'params': {'limite': 10}
+        },
+        {
+            'nome': 'Segmentos da exportação (CSV gzip)',
+            'metodo': 'GET',
+            'endpoint': '/api/visitas/exportar/segmentos',
+            'params': {'formato': 'csv', 'compressao': 'gzip'}
+        },
+        {
+            'nome': 'Visitas por intervalo',
+            'metodo': 'GET',
+            'endpoint': '/api/visitas/intervalo',
+            'params': {'de': datetime.now().strftime('%Y-%m-%d')}
+        },
+        {
+            'nome': 'Histórico por dia',
+            'metodo': 'GET',
+            'endpoint': '/api/visitas/historico',
+            'params': {'granularidade': 'dia', 'dias': 7}
+        },
+        {
+            'nome': 'Visitantes únicos no mês',
+            'metodo': 'GET',
+            'endpoint': '/api/visitas/unicos',
+            'params': {'periodo': 'mes'}
+        },
+        {
+            'nome': 'IPs mais frequentes hoje',
+            'metodo': 'GET',
+            'endpoint': '/api/visitas/top',
+            'params': {'campo': 'ip', 'n': 20}
+        },
+        {
+            'nome': 'Registrar visita em outro site',
+            'metodo': 'POST',
+            'endpoint': '/api/sites/teste/visitas/registrar'
+        },
+        {
+            'nome': 'Status de outro site',
+            'metodo': 'GET',
+            'endpoint': '/api/sites/teste/status'
         }
     ]
     
@@ -141,39 +197,93 @@ def executar_testes():
         return False
 
 def testar_performance():
-    """Testa a performance da API"""
+    """
+    Testa a performance da API rodando em BASE_URL com uma carga curta
+    do benchmark (veja benchmark.py para comparar formatos e históricos)
+    """
+    import benchmark
+
     print("\n⚡ Teste de Performance")
     print("-" * 30)
-    
-    # Testa múltiplas requisições
-    num_requisicoes = 10
-    tempos = []
-    
-    for i in range(num_requisicoes):
-        start_time = time.time()
-        response = requests.get(f"{BASE_URL}/api/visitas/total")
-        end_time = time.time()
-        
-        tempo = (end_time - start_time) * 1000  # em milissegundos
-        tempos.append(tempo)
-        
-        print(f"   Requisição {i+1}: {tempo:.2f}ms")
-    
-    # Estatísticas
-    tempo_medio = sum(tempos) / len(tempos)
-    tempo_min = min(tempos)
-    tempo_max = max(tempos)
-    
-    print(f"\n📊 Estatísticas ({num_requisicoes} requisições):")
-    print(f"   ⏱️  Tempo médio: {tempo_medio:.2f}ms")
-    print(f"   🚀 Mais rápida: {tempo_min:.2f}ms")
-    print(f"   🐌 Mais lenta: {tempo_max:.2f}ms")
+
+    resultado = benchmark.main([
+        '--modo', 'servidor', '--url', BASE_URL,
+        '--trabalhadores', '4', '--requisicoes', '200',
+        '--saida', os.devnull
+    ])
+    geral = resultado['cenarios'][0]['geral']
+
+    print(f"\n📊 Estatísticas ({geral['requisicoes']} requisições, 4 trabalhadores):")
+    print(f"   🚀 Vazão: {geral['vazao_rps']} req/s")
+    print(f"   ⏱️  p50: {geral['p50_ms']:.2f}ms")
+    print(f"   🐌 p95: {geral['p95_ms']:.2f}ms / p99: {geral['p99_ms']:.2f}ms")
+
+def gravar_visitas_processo(pasta, formato, quantidade, processo):
+    """Processo filho do teste de estresse: grava visitas pelo app"""
+    import os
+    os.chdir(pasta)
+    os.environ['FORMATO_ARMAZENAMENTO'] = formato
+    import app
+    for i in range(quantidade):
+        app.sites.obter().adicionar_visita(f'10.0.{processo}.{i % 256}', 'estresse')
+    return app.sites.obter().contar_total_visitas()
+
+def contar_visitas_processo(pasta, formato):
+    """
+    Processo filho do teste de estresse: conta as visitas gravadas por
+    todos (a leitura do total não sincroniza, então sincroniza antes)
+    """
+    import os
+    os.chdir(pasta)
+    os.environ['FORMATO_ARMAZENAMENTO'] = formato
+    import app
+    site = app.sites.obter()
+    site.sincronizar()
+    return site.contar_total_visitas()
+
+def testar_concorrencia_processos(num_processos=4, visitas_por_processo=200):
+    """
+    Vários processos gravando no mesmo armazenamento ao mesmo tempo
+    (como workers do gunicorn): nenhuma visita pode ser perdida.
+    Não precisa do servidor rodando.
+    """
+    import multiprocessing
+    import tempfile
+
+    print("\n🔀 Teste de Estresse com Vários Processos")
+    print("-" * 30)
+
+    contexto = multiprocessing.get_context('spawn')
+    esperado = num_processos * visitas_por_processo
+    todos_passaram = True
+
+    for formato in ('json', 'jsonl', 'sqlite', 'binario'):
+        with tempfile.TemporaryDirectory() as pasta:
+            inicio = time.time()
+            with contexto.Pool(num_processos) as pool:
+                vistos = pool.starmap(gravar_visitas_processo, [
+                    (pasta, formato, visitas_por_processo, p)
+                    for p in range(num_processos)
+                ])
+                total = pool.apply(contar_visitas_processo, (pasta, formato))
+            duracao = time.time() - inicio
+
+            passou = (total == esperado and
+                      all(visitas_por_processo <= v <= esperado for v in vistos))
+            todos_passaram = todos_passaram and passou
+            status = "✅" if passou else "❌"
+            print(f"   {status} {formato}: {total}/{esperado} visitas gravadas, "
+                  f"contadores dos processos {vistos} ({duracao:.2f}s)")
+
+    return todos_passaram
 
 if __name__ == '__main__':
     import sys
     
     if len(sys.argv) > 1 and sys.argv[1] == 'performance':
         testar_performance()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'estresse':
+        sys.exit(0 if testar_concorrencia_processos() else 1)
     else:
         if executar_testes():
             print("\n🎯 Executando teste de performance...")